@@ -8,7 +8,7 @@ import { TicketModal } from './components/TicketModal';
 import { Ticket, ViewMode } from './types';
 import { LayoutDashboard, Database, BarChart2, Users, Map as MapIcon, Book, Mail } from 'lucide-react';
 import { MOCK_TICKETS } from './constants';
-import { initSupabase, fetchTickets, subscribeToTickets, updateTicketStatus, seedDatabase, clearDatabase } from './services/supabaseService';
+import { initSupabase, fetchTickets, subscribeToTickets, subscribeToMessages, subscribeToChanges, fetchChanges, applyTicketChanges, hydrateChanges, realtimeToChange, ChangeBatch, getBotUrl, updateTicketStatus, seedDatabase, clearDatabase } from './services/supabaseService';
 
 const App: React.FC = () => {
   const [currentView, setCurrentView] = useState<ViewMode>('dashboard');
@@ -29,9 +29,31 @@ const App: React.FC = () => {
       try {
           setIsLoading(true);
           initSupabase(url, key);
+          // Cursor before the initial load, so the feed continues from it instead of starting with a reset
+          const cursor = getBotUrl() ? await fetchChanges().then(b => b.cursor).catch(() => undefined) : undefined;
           const liveTickets = await fetchTickets();
           if (liveTickets.length > 0) setTickets(liveTickets);
           setIsLiveMode(true); 
+          if (getBotUrl()) {
+             const applyBatch = async (batch: ChangeBatch) => {
+                 if (batch.changes.some(c => c.table === 'complaints' && c.op === 'insert')) {
+                     setNotification(`Новая заявка из Telegram!`);
+                     setTimeout(() => setNotification(null), 3000);
+                 }
+                 if (batch.reset) {
+                     setTickets(await fetchTickets());
+                     return;
+                 }
+                 setTickets(prev => applyTicketChanges(prev, batch) ?? prev);
+             };
+             // Delta feed from the bot: only changed rows travel, a full reload happens only on reset
+             subscribeToChanges(batch => hydrateChanges(batch).then(applyBatch).catch(e => console.error("Change feed failed:", e)), cursor);
+             // The feed only sees writes made through this bot replica; Supabase realtime covers the rest
+             // (other replicas, direct writes) and keeps the board live if the bot is down
+             subscribeToTickets(payload => applyBatch({ cursor: '', reset: false, changes: [realtimeToChange('complaints', payload)] }));
+             subscribeToMessages(payload => applyBatch({ cursor: '', reset: false, changes: [realtimeToChange('ticket_messages', payload)] }));
+             return;
+          }
           subscribeToTickets(async (payload) => {
              if (payload.eventType === 'INSERT') {
                  setNotification(`Новая заявка из Telegram!`);
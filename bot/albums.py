@@ -0,0 +1,56 @@
+import asyncio
+import logging
+import weakref
+
+logger = logging.getLogger(__name__)
+
+class AlbumCollector:
+    """
+    Собирает сообщения одного альбома (media_group_id): Telegram присылает их отдельными апдейтами.
+    Через window секунд после последнего сообщения группы вызывает on_complete(items) один раз, в фоне,
+    чтобы хендлер не спал и не держал очередь апдейтов чата.
+    """
+    def __init__(self, window):
+        self.window = window
+        self._groups = {}  # key -> [items, TimerHandle, on_complete]
+        self._tasks = set()
+
+    def add(self, key, item, on_complete):
+        loop = asyncio.get_running_loop()
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = [[], None, on_complete]
+        else:
+            group[1].cancel()
+        group[0].append(item)
+        group[1] = loop.call_later(self.window, self._flush, key)
+
+    def _flush(self, key):
+        items, _, on_complete = self._groups.pop(key)
+        task = asyncio.create_task(on_complete(items))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Album handling failed: {task.exception()}")
+
+    def pending(self):
+        return len(self._groups)
+
+    async def flush_all(self):
+        """При остановке: не дожидаясь окна, обрабатывает собранные группы и ждет всех обработчиков"""
+        for key, group in list(self._groups.items()):
+            group[1].cancel()
+            self._flush(key)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+_locks = weakref.WeakValueDictionary()
+
+def chat_lock(chat_id):
+    """Замок на чат: живет, пока его кто-то держит или ждет"""
+    lock = _locks.get(chat_id)
+    if lock is None:
+        lock = _locks[chat_id] = asyncio.Lock()
+    return lock
@@ -0,0 +1,228 @@
+import json
+import logging
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import database
+
+logger = logging.getLogger(__name__)
+
+# Корзины времени до первого ответа оператора (сек): 1м, 5м, 15м, 30м, 1ч, 2ч, 4ч, 8ч, 12ч, 1д, 2д, 3д, 7д, 14д, 30д
+RESPONSE_BUCKETS = (60, 300, 900, 1800, 3600, 7200, 14400, 28800, 43200, 86400, 172800, 259200, 604800, 1209600, 2592000)
+
+def _percentile(counts, total, q):
+    """Верхняя граница корзины, в которую попадает q-квантиль"""
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for bound, count in zip(RESPONSE_BUCKETS, counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None  # дольше последней корзины
+
+class Rollups:
+    """
+    Счетчики для дашборда аналитики, обновляемые на месте:
+    заявки по (день, категория, подкатегория, статус, приоритет), по (день, час)
+    и распределение времени до первого ответа по категориям.
+    Ответ /api/stats зависит от размера свертки (дни x категории x статусы), а не от числа заявок,
+    и кэшируется до следующего изменения.
+    """
+    def __init__(self, utc_offset_hours, listen=True):
+        self.tz = timezone(timedelta(hours=utc_offset_hours))
+        self._tickets = {}  # id -> [day, category, sub_category, status, priority, created_ts, responded]
+        self._daily = Counter()  # (day, category, sub_category, status, priority) -> n
+        self._hourly = Counter()  # (day, hour) -> n
+        self._response = {}  # category -> [counts по корзинам, сумма секунд, n, дольше последней корзины]
+        # Растет при каждом изменении; по нему сбрасывается кэш ответа
+        self.version = 0
+        self.ready = False
+        self._pending = None
+        self._cache = {}  # since -> (version, bytes)
+        self.stats = {"rebuilds": 0, "rebuild_seconds": 0.0, "cache_hits": 0, "cache_misses": 0}
+        if listen:
+            database.add_listener(self.on_event)
+
+    def _parse(self, value):
+        try:
+            return datetime.fromisoformat(value).astimezone(self.tz)
+        except (TypeError, ValueError):
+            return datetime.now(self.tz)
+
+    def add_ticket(self, row):
+        ticket_id = row.get("id")
+        if not ticket_id or ticket_id in self._tickets or row.get("is_deleted"):
+            return
+        created = self._parse(row.get("created_at"))
+        day = created.date().isoformat()
+        entry = [day, row.get("category") or "Прочее", row.get("sub_category") or "Общее",
+                 row.get("status") or "new", row.get("priority") or "medium", created.timestamp(), False]
+        self._tickets[ticket_id] = entry
+        self._daily[tuple(entry[:5])] += 1
+        self._hourly[(day, created.hour)] += 1
+        self.version += 1
+
+    def remove_ticket(self, ticket_id):
+        entry = self._tickets.pop(ticket_id, None)
+        if entry is None:
+            return
+        self._decrement(self._daily, tuple(entry[:5]))
+        self._decrement(self._hourly, (entry[0], datetime.fromtimestamp(entry[5], self.tz).hour))
+        self.version += 1
+
+    def _decrement(self, counter, key):
+        counter[key] -= 1
+        if counter[key] <= 0:
+            del counter[key]
+
+    def update_ticket(self, ticket_id, **fields):
+        """Переносит заявку между ячейками свертки при смене статуса/приоритета/категории"""
+        entry = self._tickets.get(ticket_id)
+        if entry is None:
+            return
+        new = list(entry)
+        for i, name in ((1, "category"), (2, "sub_category"), (3, "status"), (4, "priority")):
+            if fields.get(name):
+                new[i] = fields[name]
+        if new[:5] == entry[:5]:
+            return
+        self._decrement(self._daily, tuple(entry[:5]))
+        self._daily[tuple(new[:5])] += 1
+        entry[:5] = new[:5]
+        self.version += 1
+
+    def first_response(self, ticket_id, responded_at):
+        entry = self._tickets.get(ticket_id)
+        if entry is None or entry[6]:
+            return
+        entry[6] = True
+        seconds = max(0.0, self._parse(responded_at).timestamp() - entry[5])
+        state = self._response.get(entry[1])
+        if state is None:
+            state = self._response[entry[1]] = [[0] * len(RESPONSE_BUCKETS), 0.0, 0, 0]
+        for i, bound in enumerate(RESPONSE_BUCKETS):
+            if seconds <= bound:
+                state[0][i] += 1
+                break
+        else:
+            state[3] += 1
+        state[1] += seconds
+        state[2] += 1
+        self.version += 1
+
+    def on_event(self, event, row):
+        if self._pending is not None:
+            self._pending.append((event, row))
+        if event == "complaint_created":
+            self.add_ticket(row)
+        elif event == "status_changed":
+            self.update_ticket(row["id"], status=row["status"])
+        elif event == "complaint_updated":
+            if row.get("is_deleted"):
+                self.remove_ticket(row["id"])
+            elif row["id"] in self._tickets:
+                self.update_ticket(row["id"], **row)
+            else:
+                self.add_ticket(row)
+        elif event == "message_saved" and row.get("sender") == "operator":
+            self.first_response(row["ticket_id"], row.get("created_at"))
+
+    async def rebuild(self):
+        """Полный пересчет в новой свертке: один проход по complaints и по ответам операторов"""
+        start = time.perf_counter()
+        fresh = Rollups(0, listen=False)
+        fresh.tz = self.tz
+        self._pending = []
+        try:
+            async for rows in database.iter_rows(
+                "complaints", "id, created_at, category, sub_category, status, priority, is_deleted",
+                where=lambda q: q.eq("is_deleted", False), op="analytics_rebuild",
+            ):
+                for row in rows:
+                    fresh.add_ticket(row)
+            # Ответы идут по возрастанию времени, так что первый встреченный — первый ответ
+            async for rows in database.iter_rows(
+                "ticket_messages", "id, ticket_id, created_at",
+                where=lambda q: q.eq("sender", "operator"), op="analytics_rebuild",
+            ):
+                for row in rows:
+                    fresh.first_response(row["ticket_id"], row["created_at"])
+        finally:
+            pending, self._pending = self._pending, None
+        self._tickets, self._daily, self._hourly, self._response = fresh._tickets, fresh._daily, fresh._hourly, fresh._response
+        self.version += 1
+        for event, row in pending:
+            self.on_event(event, row)
+        self.ready = True
+        self.stats["rebuilds"] += 1
+        self.stats["rebuild_seconds"] = round(time.perf_counter() - start, 3)
+        logger.info(f"Analytics rollups: {len(self._tickets)} complaints in {self.stats['rebuild_seconds']}s")
+
+    def _response_summary(self, state):
+        counts, total_seconds, n, overflow = state
+        return {
+            "count": n,
+            "avg_seconds": round(total_seconds / n, 1) if n else None,
+            "p50_seconds": _percentile(counts, n, 0.5),
+            "p90_seconds": _percentile(counts, n, 0.9),
+            "buckets": dict(zip(map(str, RESPONSE_BUCKETS), counts)) | {"+Inf": overflow},
+        }
+
+    def build(self, since=None):
+        daily = [
+            {"day": day, "category": cat, "sub_category": sub, "status": status, "priority": priority, "count": n}
+            for (day, cat, sub, status, priority), n in self._daily.items()
+            if not since or day >= since
+        ]
+        daily.sort(key=lambda r: (r["day"], r["category"], r["sub_category"], r["status"], r["priority"]))
+        by_status, by_category, by_priority, by_weekday = Counter(), Counter(), Counter(), [0] * 7
+        for row in daily:
+            by_status[row["status"]] += row["count"]
+            by_category[row["category"]] += row["count"]
+            by_priority[row["priority"]] += row["count"]
+        by_hour = [0] * 24
+        for (day, hour), n in self._hourly.items():
+            if not since or day >= since:
+                by_hour[hour] += n
+                by_weekday[datetime.fromisoformat(day).weekday()] += n
+
+        overall = [[0] * len(RESPONSE_BUCKETS), 0.0, 0, 0]
+        for counts, total_seconds, n, overflow in self._response.values():
+            overall[0] = [a + b for a, b in zip(overall[0], counts)]
+            overall[1] += total_seconds
+            overall[2] += n
+            overall[3] += overflow
+        return {
+            "version": self.version,
+            "generated_at": datetime.now(timezone.utc).isoformat(),
+            "since": since,
+            "total": sum(by_status.values()),
+            "by_status": dict(by_status),
+            "by_category": dict(by_category),
+            "by_priority": dict(by_priority),
+            "by_hour": by_hour,
+            "by_weekday": by_weekday,  # 0 — понедельник
+            "daily": daily,
+            "first_response": {
+                "overall": self._response_summary(overall),
+                "by_category": {cat: self._response_summary(state) for cat, state in self._response.items()},
+            },
+        }
+
+    def render(self, since=None):
+        """Сериализованный ответ; пересобирается только если свертка изменилась"""
+        cached = self._cache.get(since)
+        if cached is not None and cached[0] == self.version:
+            self.stats["cache_hits"] += 1
+            return cached[1]
+        self.stats["cache_misses"] += 1
+        body = json.dumps(self.build(since), ensure_ascii=False, separators=(",", ":")).encode()
+        if len(self._cache) > 32:
+            self._cache.clear()
+        self._cache[since] = (self.version, body)
+        return body
+
+    def snapshot(self):
+        return {**self.stats, "complaints": len(self._tickets), "rollup_rows": len(self._daily), "ready": int(self.ready)}
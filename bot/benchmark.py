@@ -0,0 +1,465 @@
+"""
+Нагрузочный бенчмарк бота без внешних сервисов.
+
+Поднимает в этом же процессе фейковый Telegram Bot API и фейковый PostgREST (Supabase),
+прогоняет полный мастер заявки handlers.router для N «жителей», дергает /images/{file_id}
+и /api/reply и пишет p50/p95/p99, пропускную способность и пиковый RSS в JSON.
+
+    python benchmark.py --citizens 2000 --concurrency 500 --output benchmark_results.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+FAKE_TOKEN = "123456:BENCHMARK-TOKEN"
+# Похож на JWT, клиенту Supabase этого достаточно
+FAKE_KEY = "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.benchmark"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--citizens", type=int, default=1000, help="сколько жителей проходят мастер заявки")
+    parser.add_argument("--concurrency", type=int, default=200, help="сколько жителей одновременно")
+    parser.add_argument("--image-requests", type=int, default=2000)
+    parser.add_argument("--image-files", type=int, default=200, help="число разных file_id для /images")
+    parser.add_argument("--image-size", type=int, default=150 * 1024)
+    parser.add_argument("--replies", type=int, default=200, help="запросов /api/reply")
+    parser.add_argument("--http-concurrency", type=int, default=50)
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="задержка фейкового Bot API, сек")
+    parser.add_argument("--db-latency", type=float, default=0.01, help="задержка фейкового PostgREST, сек")
+    parser.add_argument("--realistic-limits", action="store_true", help="не снимать лимиты отправки Telegram")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_results.json")
+    return parser.parse_args()
+
+def configure_env(args, workdir, telegram_port, db_port, web_port):
+    """Окружение задается до импорта модулей бота: config читает его при импорте"""
+    os.environ.update({
+        "BOT_TOKEN": FAKE_TOKEN,
+        "SUPABASE_URL": f"http://127.0.0.1:{db_port}",
+        "SUPABASE_KEY": FAKE_KEY,
+        "PORT": str(web_port),
+        "FSM_STORAGE": "memory",
+        "OUTBOX_PATH": os.path.join(workdir, "outbox.jsonl"),
+        "IMAGE_CACHE_DIR": os.path.join(workdir, "images"),
+        "DELIVERY_ENABLED": "0",
+        # Шаблонные описания склеивались бы в дубликаты, и мастер не доходил бы до создания заявки
+        "DEDUP_ENABLED": "0",
+    })
+    if not args.realistic_limits:
+        os.environ.update({"SEND_GLOBAL_RATE": "1000000", "SEND_CHAT_RATE": "1000000", "SEND_CHAT_BURST": "1000"})
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.started = {}
+        self.finished = {}
+
+    def begin(self, scenario):
+        self.started.setdefault(scenario, time.perf_counter())
+
+    def add(self, scenario, seconds, ok=True):
+        self.samples.setdefault(scenario, []).append(seconds)
+        if not ok:
+            self.errors[scenario] = self.errors.get(scenario, 0) + 1
+        self.finished[scenario] = time.perf_counter()
+
+    def report(self):
+        result = {}
+        for scenario, values in self.samples.items():
+            values = sorted(values)
+            elapsed = self.finished[scenario] - self.started.get(scenario, self.finished[scenario])
+            result[scenario] = {
+                "count": len(values),
+                "errors": self.errors.get(scenario, 0),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p95_ms": round(percentile(values, 95) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3),
+                "max_ms": round(values[-1] * 1000, 3),
+                "throughput_per_s": round(len(values) / elapsed, 2) if elapsed > 0 else None,
+            }
+        return result
+
+# --- Фейковый Telegram Bot API ---
+
+class FakeTelegram:
+    def __init__(self, latency, image_size):
+        self.latency = latency
+        self.image_size = image_size
+        self._ids = itertools.count(1)
+        self.calls = {}
+
+    def _message(self, chat_id, **extra):
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            **extra,
+        }
+
+    def _photo(self):
+        n = next(self._ids)
+        return [{"file_id": f"bench-photo-{n}", "file_unique_id": f"u{n}", "width": 1280, "height": 960}]
+
+    async def handle_method(self, request):
+        from aiohttp import web
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = form.get("chat_id", 1)
+        if method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text=form.get("text", ""))
+        elif method == "sendPhoto":
+            result = self._message(chat_id, photo=self._photo(), caption=form.get("caption"))
+        elif method == "sendMediaGroup":
+            media = json.loads(form.get("media", "[]"))
+            result = [self._message(chat_id, photo=self._photo(), media_group_id="bench") for _ in media]
+        elif method == "getFile":
+            file_id = form.get("file_id")
+            result = {"file_id": file_id, "file_unique_id": f"u-{file_id}", "file_size": self.image_size, "file_path": f"photos/{file_id}.jpg"}
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request):
+        from aiohttp import web
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        # Псевдо-JPEG: содержимое не важно, важен размер
+        seed = request.match_info["path"].encode()
+        body = (b"\xff\xd8\xff\xe0" + seed * (self.image_size // max(len(seed), 1) + 1))[:self.image_size]
+        return web.Response(body=body, content_type="image/jpeg")
+
+    def app(self):
+        from aiohttp import web
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        return app
+
+# --- Фейковый PostgREST ---
+
+class FakePostgrest:
+    """Минимальный PostgREST: eq/lt/gt/in/is-фильтры, order, limit, upsert и встраивание complaints(user_id)"""
+    def __init__(self, latency):
+        self.latency = latency
+        self.tables = {"complaints": {}, "ticket_messages": {}}
+        self.requests = 0
+
+    def _match(self, row, column, expr):
+        op, _, value = expr.partition(".")
+        current = row.get(column)
+        if op == "eq":
+            return str(current).lower() == value.lower() if isinstance(current, bool) else str(current) == value
+        if op == "neq":
+            return str(current) != value
+        if op == "lt":
+            return current is not None and str(current) < value
+        if op == "gt":
+            return current is not None and str(current) > value
+        if op == "in":
+            return str(current) in value.strip("()").split(",")
+        if op == "is":
+            return current is None if value == "null" else str(current).lower() == value
+        return True
+
+    def _filter(self, table, query):
+        rows = list(self.tables.setdefault(table, {}).values())
+        for column, expr in query.items():
+            if column in ("select", "order", "limit", "offset", "on_conflict", "columns"):
+                continue
+            rows = [r for r in rows if self._match(r, column, expr)]
+        if "order" in query:
+            column, _, direction = query["order"].partition(".")
+            rows.sort(key=lambda r: str(r.get(column) or ""), reverse=direction.startswith("desc"))
+        if "limit" in query:
+            rows = rows[:int(query["limit"])]
+        return rows
+
+    def _project(self, rows, select):
+        if not select or select == "*":
+            return rows
+        result = []
+        for row in rows:
+            item = dict(row) if "*" in select else {}
+            for column in select.split(","):
+                column = column.strip()
+                if column.startswith("complaints("):
+                    owner = self.tables["complaints"].get(row.get("ticket_id"), {})
+                    item["complaints"] = {"user_id": owner.get("user_id")}
+                elif column and column != "*":
+                    item[column] = row.get(column)
+            result.append(item)
+        return result
+
+    async def handle(self, request):
+        from aiohttp import web
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        table = request.match_info["table"]
+        query = dict(request.query)
+        store = self.tables.setdefault(table, {})
+
+        if request.method == "POST":
+            body = await request.json()
+            rows = body if isinstance(body, list) else [body]
+            inserted = []
+            for row in rows:
+                row.setdefault("id", str(uuid.uuid4()))
+                row.setdefault("created_at", datetime.now(timezone.utc).isoformat())
+                if row["id"] not in store:
+                    store[row["id"]] = row
+                    inserted.append(row)
+            return web.json_response(inserted, status=201)
+
+        rows = self._filter(table, query)
+        if request.method == "PATCH":
+            changes = await request.json()
+            for row in rows:
+                row.update(changes)
+        elif request.method == "DELETE":
+            for row in rows:
+                store.pop(row["id"], None)
+        rows = self._project(rows, query.get("select"))
+
+        if "vnd.pgrst.object" in request.headers.get("Accept", ""):
+            if len(rows) != 1:
+                return web.json_response({"message": "JSON object requested, multiple (or no) rows returned"}, status=406)
+            return web.json_response(rows[0])
+        return web.json_response(rows)
+
+    def app(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_route("*", "/rest/v1/{table}", self.handle)
+        return app
+
+# --- Сценарии ---
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"Citizen{uid}", "username": f"citizen{uid}"}
+
+class Citizen:
+    """Один житель: шаг за шагом проходит мастер, как живой пользователь"""
+    _update_ids = itertools.count(1)
+    _message_ids = itertools.count(1)
+
+    def __init__(self, uid):
+        self.uid = uid
+
+    def _message(self, **extra):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.uid, "type": "private"},
+            "from": _user(self.uid),
+            **extra,
+        }
+
+    def _update(self, **event):
+        return {"update_id": next(self._update_ids), **event}
+
+    def steps(self, cat):
+        lat, lon = 51.45 + random.random() * 0.07, 46.08 + random.random() * 0.07
+        bot_message = {"message_id": 1, "date": int(time.time()), "chat": {"id": self.uid, "type": "private"},
+                       "from": {"id": 123456, "is_bot": True, "first_name": "Benchmark"}, "text": "..."}
+        callback = lambda data: self._update(callback_query={
+            "id": str(uuid.uuid4()), "from": _user(self.uid), "chat_instance": "bench", "data": data, "message": bot_message,
+        })
+        yield "new_complaint", self._update(message=self._message(text="📝 Новая заявка"))
+        yield "category", callback(cat.callback)
+        yield "subcategory", callback(cat.sub_callbacks[0])
+        if cat.simple:
+            yield "description", self._update(message=self._message(text="Спасибо за работу!"))
+        else:
+            if cat.req_extra:
+                yield "extra", self._update(message=self._message(text="Маршрут 5, А123ВС164"))
+            n = next(self._message_ids)
+            yield "photo", self._update(message=self._message(photo=[
+                {"file_id": f"citizen-{self.uid}-{n}", "file_unique_id": f"cu-{self.uid}-{n}", "width": 1280, "height": 960}
+            ]))
+            yield "skip_photo", self._update(message=self._message(text="Пропустить"))
+            yield "location", self._update(message=self._message(location={"latitude": lat, "longitude": lon}))
+            yield "description", self._update(message=self._message(text=f"Проблема во дворе дома {self.uid % 300}, прошу разобраться"))
+        yield "phone", self._update(message=self._message(contact={
+            "phone_number": f"+7917{self.uid:07d}"[:12], "first_name": "Citizen", "user_id": self.uid,
+        }))
+
+async def run_wizard(args, bot, dp, categories, recorder):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    cats = list(categories.ALL)
+
+    async def citizen(uid):
+        async with semaphore:
+            started = time.perf_counter()
+            ok = True
+            for step, update in Citizen(uid).steps(random.choice(cats)):
+                t0 = time.perf_counter()
+                try:
+                    await dp.feed_raw_update(bot, update)
+                    recorder.add(f"wizard.{step}", time.perf_counter() - t0)
+                except Exception:
+                    recorder.add(f"wizard.{step}", time.perf_counter() - t0, ok=False)
+                    ok = False
+            recorder.add("wizard.complete", time.perf_counter() - started, ok=ok)
+
+    recorder.begin("wizard.complete")
+    for step in ("new_complaint", "category", "subcategory", "extra", "photo", "skip_photo", "location", "description", "phone"):
+        recorder.begin(f"wizard.{step}")
+    await asyncio.gather(*(citizen(1_000_000 + i) for i in range(args.citizens)))
+
+async def run_images(args, session, base_url, recorder):
+    # Популярность фото по закону Ципфа — как у карточек на канбане
+    weights = [1 / (i + 1) for i in range(args.image_files)]
+    file_ids = [f"bench-image-{i}" for i in range(args.image_files)]
+    semaphore = asyncio.Semaphore(args.http_concurrency)
+
+    async def fetch(file_id):
+        async with semaphore:
+            t0 = time.perf_counter()
+            try:
+                async with session.get(f"{base_url}/images/{file_id}") as resp:
+                    await resp.read()
+                    recorder.add("http.images", time.perf_counter() - t0, ok=resp.status == 200)
+            except Exception:
+                recorder.add("http.images", time.perf_counter() - t0, ok=False)
+
+    recorder.begin("http.images")
+    await asyncio.gather(*(fetch(fid) for fid in random.choices(file_ids, weights, k=args.image_requests)))
+
+async def run_replies(args, session, base_url, fake_db, recorder):
+    import aiohttp
+    tickets = list(fake_db.tables["complaints"])
+    if not tickets:
+        return
+    photo = os.urandom(300 * 1024)
+    semaphore = asyncio.Semaphore(args.http_concurrency)
+
+    async def reply(i):
+        async with semaphore:
+            # Multipart и без файла: FormData из одних строк ушла бы как urlencoded, а /api/reply читает multipart
+            form = aiohttp.MultipartWriter("form-data")
+            for name, value in (("ticket_id", random.choice(tickets)), ("text", f"Ответ оператора №{i}: заявка принята в работу.")):
+                form.append(value).set_content_disposition("form-data", name=name)
+            if i % 2 == 0:
+                form.append(photo, {"Content-Type": "image/jpeg"}).set_content_disposition("form-data", name="file", filename="reply.jpg")
+            t0 = time.perf_counter()
+            try:
+                async with session.post(f"{base_url}/api/reply", data=form) as resp:
+                    await resp.read()
+                    recorder.add("http.reply", time.perf_counter() - t0, ok=resp.status == 200)
+            except Exception:
+                recorder.add("http.reply", time.perf_counter() - t0, ok=False)
+
+    recorder.begin("http.reply")
+    await asyncio.gather(*(reply(i) for i in range(args.replies)))
+
+async def start_app(app, port):
+    from aiohttp import web
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+async def run(args):
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    telegram_port, db_port, web_port = free_port(), free_port(), free_port()
+    configure_env(args, workdir, telegram_port, db_port, web_port)
+
+    import aiohttp
+    from aiogram.client.telegram import TelegramAPIServer
+
+    fake_telegram = FakeTelegram(args.telegram_latency, args.image_size)
+    fake_db = FakePostgrest(args.db_latency)
+    runners = [await start_app(fake_telegram.app(), telegram_port), await start_app(fake_db.app(), db_port)]
+
+    import main
+    import categories
+    import outbox
+    import lifecycle
+    bot = main.create_bot()
+    bot.session.api = TelegramAPIServer.from_base(f"http://127.0.0.1:{telegram_port}")
+    dp = main.create_dispatcher()
+    health = lifecycle.Health()
+    health.started = True
+    await outbox.journal.start()
+    web_runner = await main.start_web_server(main.build_web_app(bot, health))
+    base_url = f"http://127.0.0.1:{web_port}"
+
+    recorder = Recorder()
+    started = time.perf_counter()
+    await run_wizard(args, bot, dp, categories, recorder)
+    # Дожидаемся, пока outbox отправит заявки в «базу»
+    while outbox.journal.pending_count():
+        await asyncio.sleep(0.05)
+    recorder.add("outbox.drain", time.perf_counter() - started)
+
+    async with aiohttp.ClientSession() as session:
+        await run_images(args, session, base_url, recorder)
+        await run_replies(args, session, base_url, fake_db, recorder)
+    total = time.perf_counter() - started
+
+    await outbox.journal.stop()
+    await bot.session.close()
+    await web_runner.cleanup()
+    for runner in runners:
+        await runner.cleanup()
+
+    # ru_maxrss в Linux — в килобайтах, в macOS — в байтах
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss = maxrss * 1024 if sys.platform != "darwin" else maxrss
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": vars(args),
+        "total_seconds": round(total, 3),
+        "peak_rss_bytes": peak_rss,
+        "scenarios": recorder.report(),
+        "telegram_calls": fake_telegram.calls,
+        "db_requests": fake_db.requests,
+        "complaints_stored": len(fake_db.tables["complaints"]),
+    }
+
+def main():
+    args = parse_args()
+    result = asyncio.run(run(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    for scenario, stats in sorted(result["scenarios"].items()):
+        print(f"{scenario:24} n={stats['count']:6} err={stats['errors']:4} "
+              f"p50={stats['p50_ms']:9.2f}ms p95={stats['p95_ms']:9.2f}ms p99={stats['p99_ms']:9.2f}ms "
+              f"{stats['throughput_per_s'] or 0:9.1f}/s")
+    print(f"peak RSS: {result['peak_rss_bytes'] / 1024 / 1024:.1f} MiB, results -> {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import logging
+import os
+import re
+import sys
+import zlib
+from collections import namedtuple
+from types import MappingProxyType
+from config import CATEGORIES
+
+logger = logging.getLogger(__name__)
+
+FRONTEND_CONSTANTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "constants.ts")
+
+# Скомпилированная категория: неизменяемая, подкатегории и их коды — кортежи
+Category = namedtuple("Category", "key index name emoji subs req_geo req_photo req_extra simple callback sub_callbacks")
+
+# Коды callback_data: "c:<ключ>" — категория, "s:<ключ>:<crc32 названия>" — подкатегория.
+# Не зависят от порядка в CATEGORIES: кнопки, уже отправленные пользователям, после перестановки
+# ведут туда же; переименованная подкатегория дает новый код, а старая кнопка — просьбу начать заново
+CATEGORY_PREFIX = "c:"
+SUB_PREFIX = "s:"
+# Лимит Telegram на callback_data
+MAX_CALLBACK_BYTES = 64
+
+def category_code(key):
+    return sys.intern(f"{CATEGORY_PREFIX}{key}")
+
+def sub_code(key, sub):
+    return sys.intern(f"{SUB_PREFIX}{key}:{zlib.crc32(sub.encode()):08x}")
+
+def _compile(categories):
+    items = []
+    for index, (key, conf) in enumerate(categories.items()):
+        items.append(Category(
+            key=sys.intern(key),
+            index=index,
+            name=conf['name'],
+            emoji=conf['emoji'],
+            subs=tuple(conf['subs']),
+            req_geo=conf.get('req_geo', False),
+            req_photo=conf.get('req_photo', False),
+            req_extra=conf.get('req_extra', False),
+            simple=conf.get('simple', False),
+            callback=category_code(key),
+            sub_callbacks=tuple(sub_code(key, sub) for sub in conf['subs']),
+        ))
+    return tuple(items)
+
+def _decode_table(items):
+    table = {}
+    for cat in items:
+        codes = [(cat.callback, None)] + list(zip(cat.sub_callbacks, cat.subs))
+        for code, sub in codes:
+            if code in table:
+                raise ValueError(f"Duplicate callback code {code} for category '{cat.key}'")
+            if len(code.encode()) > MAX_CALLBACK_BYTES:
+                raise ValueError(f"Callback code {code} is longer than {MAX_CALLBACK_BYTES} bytes")
+            table[code] = (cat, sub)
+    return MappingProxyType(table)
+
+def _parse_frontend(path):
+    """Достает из constants.ts словарь key -> (name, [subs])"""
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    match = re.search(r"export const CATEGORIES\s*=\s*\{(.*?)\n\};", source, re.S)
+    if not match:
+        return None
+    result = {}
+    for key, body in re.findall(r"'(\w+)'\s*:\s*\{(.*?)\}", match.group(1), re.S):
+        name = re.search(r"name:\s*'([^']*)'", body)
+        subs = re.search(r"subs:\s*\[(.*?)\]", body, re.S)
+        result[key] = (
+            name.group(1) if name else None,
+            re.findall(r"'([^']*)'", subs.group(1)) if subs else [],
+        )
+    return result
+
+def validate_against_frontend(path=FRONTEND_CONSTANTS):
+    """
+    Сверяет таксономию бота с фронтендом. Обязаны совпадать ключи и названия: дашборд группирует
+    и подбирает эмодзи по названию категории из заявки. Подкатегории фронтенд берет из самих заявок.
+    """
+    if not os.path.exists(path):
+        logger.debug(f"Frontend constants not found at {path}, skipping validation")
+        return True
+    frontend = _parse_frontend(path)
+    if frontend is None:
+        logger.warning(f"CATEGORIES not found in {path}")
+        return False
+
+    ok = True
+    missing = set(frontend) - set(BY_KEY)
+    extra = set(BY_KEY) - set(frontend)
+    if missing:
+        logger.warning(f"Categories missing in bot: {sorted(missing)}")
+        ok = False
+    if extra:
+        logger.warning(f"Categories missing in frontend: {sorted(extra)}")
+        ok = False
+    renamed = {
+        key: (BY_KEY[key].name, name) for key, (name, _) in frontend.items()
+        if key in BY_KEY and name != BY_KEY[key].name
+    }
+    if renamed:
+        logger.warning(f"Category names differ (bot -> frontend), such complaints miss their dashboard column: {renamed}")
+        ok = False
+    return ok
+
+def decode(data):
+    """callback_data -> (Category, подкатегория или None); None, если код неизвестен"""
+    return CALLBACKS.get(data)
+
+ALL = _compile(CATEGORIES)
+BY_KEY = MappingProxyType({cat.key: cat for cat in ALL})
+CALLBACKS = _decode_table(ALL)
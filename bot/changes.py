@@ -0,0 +1,156 @@
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from aiohttp import web
+import database
+
+logger = logging.getLogger(__name__)
+
+# Лента открыта без авторизации (CORS *): наружу уходят только служебные поля, без телефонов,
+# Telegram-id и текстов — полные строки дашборд читает из Supabase
+PUBLIC_FIELDS = {
+    "complaints": ("status", "priority", "category", "sub_category", "is_deleted", "created_at", "updated_at"),
+    "ticket_messages": ("ticket_id", "sender", "created_at"),
+}
+
+class CursorError(Exception):
+    pass
+
+class ChangeFeed:
+    """
+    Лента изменений для дашборда: кольцевой буфер дельт строк с монотонным номером.
+    Курсор — "эпоха:номер"; эпоха меняется при каждом запуске, так что курсор старого процесса
+    (или ушедший за пределы буфера) дает reset, и клиент один раз перечитывает доску целиком.
+    Несколько изменений одной строки внутри ответа сливаются в одну дельту.
+    В дельтах только поля из PUBLIC_FIELDS.
+    """
+    def __init__(self, capacity, listen=True):
+        self.epoch = os.urandom(4).hex()
+        self.seq = 0
+        self._buffer = deque(maxlen=capacity)  # (seq, table, op, id, fields)
+        self._subscribers = set()
+        self.closed = False
+        self.stats = {"changes": 0, "resets": 0, "batches": 0}
+        if listen:
+            database.add_listener(self.on_event)
+
+    @property
+    def cursor(self):
+        return f"{self.epoch}:{self.seq}"
+
+    def append(self, table, op, row_id, fields):
+        if fields is not None:
+            fields = {key: fields[key] for key in PUBLIC_FIELDS[table] if key in fields}
+        self.seq += 1
+        self._buffer.append((self.seq, table, op, row_id, fields))
+        self.stats["changes"] += 1
+        for event in self._subscribers:
+            event.set()
+
+    def on_event(self, event, row):
+        if event == "complaint_created":
+            self.append("complaints", "insert", row["id"], row)
+        elif event == "status_changed":
+            self.append("complaints", "upsert", row["id"], {"status": row["status"]})
+        elif event == "complaint_updated":
+            if row.get("is_deleted"):
+                self.append("complaints", "delete", row["id"], None)
+            else:
+                self.append("complaints", "upsert", row["id"], row)
+        elif event == "message_saved":
+            self.append("ticket_messages", "insert", row["id"], row)
+
+    def _position(self, cursor):
+        """Номер, после которого отдавать изменения; None — нужен полный перезапрос"""
+        if not cursor:
+            return None
+        epoch, _, seq = cursor.partition(":")
+        try:
+            seq = int(seq)
+        except ValueError:
+            raise CursorError("cursor must look like 'epoch:number'")
+        if epoch != self.epoch or seq > self.seq:
+            return None
+        oldest = self._buffer[0][0] if self._buffer else self.seq + 1
+        # Изменения между seq и самым старым в буфере уже вытеснены
+        if seq < oldest - 1:
+            return None
+        return seq
+
+    def since(self, cursor):
+        """{"cursor", "reset", "changes"}: дельты после cursor, по одной на строку"""
+        position = self._position(cursor)
+        if position is None:
+            if cursor:
+                self.stats["resets"] += 1
+            return {"cursor": self.cursor, "reset": True, "changes": []}
+        merged = {}
+        for seq, table, op, row_id, fields in reversed(self._buffer):
+            if seq <= position:
+                break
+            merged.setdefault((table, row_id), []).append((op, fields))
+        changes = []
+        for (table, row_id), history in merged.items():
+            op, fields = "upsert", {}
+            # history — от новых к старым; delete перекрывает все, что было до него
+            for item_op, item_fields in reversed(history):
+                if item_op == "delete":
+                    op, fields = "delete", {}
+                else:
+                    # insert + последующие правки — все еще новая строка
+                    op = "insert" if "insert" in (op, item_op) else "upsert"
+                    fields.update(item_fields)
+            change = {"table": table, "op": op, "id": row_id}
+            if op != "delete":
+                change["fields"] = fields
+            changes.append(change)
+        # merged заполнялся от новых к старым; клиенту удобнее в порядке изменений
+        changes.reverse()
+        return {"cursor": self.cursor, "reset": False, "changes": changes}
+
+    def close(self):
+        """Завершить открытые потоки (остановка процесса)"""
+        self.closed = True
+        for event in self._subscribers:
+            event.set()
+
+    async def stream(self, request, cursor, coalesce, heartbeat):
+        """
+        SSE: после изменения ждем coalesce секунд, чтобы пачка изменений ушла одним событием;
+        без изменений раз в heartbeat шлем комментарий, чтобы прокси не рвали соединение.
+        """
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no",
+        })
+        await response.prepare(request)
+        wakeup = asyncio.Event()
+        self._subscribers.add(wakeup)
+        try:
+            batch = self.since(cursor)
+            while not self.closed:
+                if batch["reset"] or batch["changes"]:
+                    payload = json.dumps(batch, ensure_ascii=False, separators=(",", ":"), default=str)
+                    await response.write(f"id: {batch['cursor']}\nevent: changes\ndata: {payload}\n\n".encode())
+                    self.stats["batches"] += 1
+                cursor = batch["cursor"]
+                try:
+                    await asyncio.wait_for(wakeup.wait(), heartbeat)
+                except asyncio.TimeoutError:
+                    await response.write(b": ping\n\n")
+                    batch = self.since(cursor)
+                    continue
+                await asyncio.sleep(coalesce)
+                wakeup.clear()
+                batch = self.since(cursor)
+        except ConnectionResetError:
+            pass
+        finally:
+            self._subscribers.discard(wakeup)
+        return response
+
+    def snapshot(self):
+        return {**self.stats, "seq": self.seq, "buffered": len(self._buffer), "subscribers": len(self._subscribers)}
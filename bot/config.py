@@ -8,6 +8,123 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 PORT = int(os.getenv("PORT", 8000))
 
+# База данных: максимум одновременных запросов к Supabase и таймаут одного запроса (сек)
+DB_MAX_CONCURRENCY = int(os.getenv("DB_MAX_CONCURRENCY", 20))
+DB_TIMEOUT = float(os.getenv("DB_TIMEOUT", 10))
+
+# Кэш фото для /images/{file_id}: каталог на диске и лимиты (байты)
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "cache/images")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+IMAGE_MEMORY_CACHE_MAX_BYTES = int(os.getenv("IMAGE_MEMORY_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+IMAGE_MEMORY_ITEM_MAX_BYTES = int(os.getenv("IMAGE_MEMORY_ITEM_MAX_BYTES", 512 * 1024))
+
+# Режим вебхука: если задан WEBHOOK_URL (публичный адрес бота), polling не используется
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Обработка апдейтов: число воркеров, емкость очереди и сколько ждать места в ней (сек)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv("UPDATE_ENQUEUE_TIMEOUT", 5))
+
+# Хранилище состояний FSM (черновики заявок): sqlite или memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_DB_PATH = os.getenv("FSM_DB_PATH", "data/fsm.sqlite3")
+# Через сколько секунд без активности брошенный черновик удаляется
+FSM_TTL = int(os.getenv("FSM_TTL", 7 * 24 * 3600))
+# Окно пакетной записи (сек); 0 — писать сразу
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 0.05))
+
+# Outbox: журнал записей в БД, размер пачки и период отправки (сек)
+# Процесс занимает журнал flock'ом; следующий процесс на хосте берет outbox.1.jsonl и т.д.
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "data/outbox.jsonl")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 100))
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("OUTBOX_FLUSH_INTERVAL", 0.2))
+
+# Кэш "Мои заявки": сколько пользователей держать в памяти и сколько секунд
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", 10000))
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", 60))
+
+# Вложения /api/reply: лимит на файл, порог сброса на диск (байты) и число файлов (альбом — до 10)
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 10 * 1024 * 1024))
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", 1024 * 1024))
+UPLOAD_MAX_FILES = min(int(os.getenv("UPLOAD_MAX_FILES", 10)), 10)
+
+# Доставка ответов, записанных в ticket_messages мимо бота (дашборд, старый код)
+DELIVERY_ENABLED = os.getenv("DELIVERY_ENABLED", "1") == "1"
+DELIVERY_REALTIME = os.getenv("DELIVERY_REALTIME", "1") == "1"
+DELIVERY_BATCH_SIZE = int(os.getenv("DELIVERY_BATCH_SIZE", 50))
+DELIVERY_POLL_INTERVAL = float(os.getenv("DELIVERY_POLL_INTERVAL", 30))
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", 10))
+# Аренда захваченной пачки (сек): если процесс упал до отметки об отправке, после нее пачка уходит повторно
+DELIVERY_LEASE = int(os.getenv("DELIVERY_LEASE", 300))
+
+# Исходящие вызовы Bot API: сообщений в секунду на бота и на чат, запас в чате и число повторов
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", 3))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 3))
+
+# Семплирующий профайлер на /debug/profile (выключен по умолчанию) и период семплов (сек)
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", 0.005))
+
+# Карта открытых заявок: полная пересборка индекса (сек), с какого зума отдавать точки без кластеров
+GEO_REFRESH_INTERVAL = int(os.getenv("GEO_REFRESH_INTERVAL", 600))
+GEO_POINTS_ZOOM = int(os.getenv("GEO_POINTS_ZOOM", 16))
+
+# Поиск дублей при подаче заявки: окно (сек), радиус (м), порог похожести текста рядом и без координат
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", 6 * 3600))
+DEDUP_RADIUS_M = float(os.getenv("DEDUP_RADIUS_M", 50))
+DEDUP_NEAR_SIMILARITY = float(os.getenv("DEDUP_NEAR_SIMILARITY", 0.1))
+DEDUP_TEXT_SIMILARITY = float(os.getenv("DEDUP_TEXT_SIMILARITY", 0.7))
+
+# Часовой пояс дней и часов в аналитике (Энгельс — UTC+4)
+STATS_UTC_OFFSET = int(os.getenv("STATS_UTC_OFFSET", 4))
+
+# Выгрузка /api/export: строк на страницу и токен доступа (без токена выгрузка выключена)
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", 1000))
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+
+# Сколько ждать остальные фото альбома после последнего пришедшего (сек)
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", 0.6))
+
+# Уменьшенные копии фото для дашборда: разрешенные размеры (px), процессы ресайза, качество
+THUMB_SIZES = sorted(int(x) for x in os.getenv("THUMB_SIZES", "128,256,512,1024").split(","))
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", 2))
+THUMB_QUALITY = int(os.getenv("THUMB_QUALITY", 80))
+
+# Жизненный цикл: лимит на прогрев и на каждый шаг остановки (сек), период проверки зависимостей для /health/ready
+STARTUP_TIMEOUT = float(os.getenv("STARTUP_TIMEOUT", 30))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 20))
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", 15))
+
+# Лента изменений для дашборда: размер буфера дельт, окно склейки пачек для SSE и период heartbeat (сек)
+CHANGES_BUFFER = int(os.getenv("CHANGES_BUFFER", 10000))
+CHANGES_COALESCE = float(os.getenv("CHANGES_COALESCE", 0.25))
+CHANGES_HEARTBEAT = float(os.getenv("CHANGES_HEARTBEAT", 15))
+
+# Антифлуд: лимиты "действие:число/окно_сек" на пользователя (message, photo, callback, new_complaint),
+# сколько ключей держать в памяти, до скольких секунд откладывать апдейт вместо отбрасывания
+THROTTLE_ENABLED = os.getenv("THROTTLE_ENABLED", "1") == "1"
+THROTTLE_RULES = os.getenv("THROTTLE_RULES", "message:20/10,photo:20/30,callback:30/10,new_complaint:5/60")
+THROTTLE_MAX_KEYS = int(os.getenv("THROTTLE_MAX_KEYS", 50000))
+THROTTLE_DEFER_MAX = float(os.getenv("THROTTLE_DEFER_MAX", 1.0))
+# Заявок на пользователя за местные сутки (0 — без ограничения); счетчик у каждой реплики свой
+DAILY_COMPLAINT_QUOTA = int(os.getenv("DAILY_COMPLAINT_QUOTA", 10))
+
+# SLA: часы до эскалации — по приоритету, категории или паре "Категория/приоритет" (точнее — важнее)
+SLA_ENABLED = os.getenv("SLA_ENABLED", "1") == "1"
+# Эскалации и уведомления шлет только ведущая реплика: на остальных репликах выставить SLA_LEADER=0
+SLA_LEADER = os.getenv("SLA_LEADER", "1") == "1"
+SLA_RULES = os.getenv("SLA_RULES", "critical:4,high:24,medium:72,low:168")
+# Чат операторов для эскалаций (без него просрочки только пишутся в лог и метрики)
+OPERATOR_CHAT_ID = int(os.getenv("OPERATOR_CHAT_ID", 0)) or None
+# Уведомлять жителей о смене статуса в дашборде; изменения копятся столько секунд и уходят одним сообщением
+SLA_NOTIFY_CITIZENS = os.getenv("SLA_NOTIFY_CITIZENS", "1") == "1"
+SLA_NOTIFY_DELAY = float(os.getenv("SLA_NOTIFY_DELAY", 10))
+
 # Полная матрица категорий (синхронизирована с фронтендом)
 CATEGORIES = {
     'roads': {
@@ -1,19 +1,129 @@
+import asyncio
 import logging
-from supabase import create_client, Client
-from config import SUPABASE_URL, SUPABASE_KEY
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+import httpx
+from supabase import acreate_client, AsyncClient
+from supabase.lib.client_options import AsyncClientOptions
+from config import (SUPABASE_URL, SUPABASE_KEY, DB_MAX_CONCURRENCY, DB_TIMEOUT,
+                    HISTORY_CACHE_SIZE, HISTORY_CACHE_TTL)
+import outbox
+from cache import TTLCache
+import metrics
 
 logger = logging.getLogger(__name__)
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    logger.error("Supabase credentials missing!")
-    supabase = None
-else:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Один асинхронный клиент на процесс: внутри него пул HTTP-соединений к PostgREST
+_client: AsyncClient = None
+_client_lock = asyncio.Lock()
+# Ограничение одновременных запросов, чтобы всплеск заявок не положил базу
+_semaphore = asyncio.Semaphore(DB_MAX_CONCURRENCY)
+
+# История заявок: user_id -> {(cursor, limit): rows}; сбрасывается при изменении заявок пользователя
+_history = TTLCache(HISTORY_CACHE_SIZE, HISTORY_CACHE_TTL)
+# Заявки, созданные этим процессом: user_id -> [rows]. Пока строка в outbox, в БД ее еще нет,
+# поэтому история подмешивает их к ответу БД, а не кэширует страницу без новой заявки
+_recent = TTLCache(HISTORY_CACHE_SIZE, HISTORY_CACHE_TTL)
+RECENT_PER_USER = 10
+HISTORY_COLUMNS = ("id", "category", "status", "created_at", "description")
+# Владелец заявки не меняется, поэтому ticket_id -> user_id можно держать долго
+_ticket_owners = TTLCache(HISTORY_CACHE_SIZE, 24 * 3600)
+
+# Подписчики на записи бота и изменения из realtime: callback(event, row)
+# События: complaint_created, message_saved, status_changed, complaint_updated
+_listeners = []
+
+def add_listener(callback):
+    """Подписывает in-process индекс (карта, статистика и т.п.) на изменения заявок"""
+    _listeners.append(callback)
+
+def _notify(event, row):
+    for callback in _listeners:
+        try:
+            callback(event, row)
+        except Exception as e:
+            logger.error(f"Listener {getattr(callback, '__name__', callback)} failed on {event}: {e}")
+
+async def get_client():
+    """Лениво создает асинхронный клиент Supabase"""
+    global _client
+    if _client is None:
+        async with _client_lock:
+            if _client is None:
+                if not SUPABASE_URL or not SUPABASE_KEY:
+                    raise RuntimeError("Supabase credentials missing!")
+                _client = await acreate_client(
+                    SUPABASE_URL, SUPABASE_KEY,
+                    options=AsyncClientOptions(postgrest_client_timeout=DB_TIMEOUT)
+                )
+    return _client
+
+async def ping():
+    """Дешевый запрос для проверки готовности"""
+    await _execute("ping", lambda db: db.table("complaints").select("id").limit(1))
+
+async def close():
+    """Закрывает realtime-сокет и HTTP-пул PostgREST"""
+    global _client, _watching
+    client, _client = _client, None
+    _watching = False
+    if client is None:
+        return
+    try:
+        if client.realtime.is_connected:
+            await client.realtime.close()
+    except Exception as e:
+        logger.warning(f"Realtime close failed: {e}")
+    await client.postgrest.aclose()
+
+async def _execute(op, build):
+    """
+    Выполняет запрос build(client) без блокировки event loop, с лимитом параллелизма и таймаутом.
+    op — имя операции для метрик.
+    """
+    client = await get_client()
+    async with _semaphore:
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(build(client).execute(), DB_TIMEOUT)
+        except Exception:
+            metrics.DB_ERRORS.inc(op=op)
+            raise
+        finally:
+            metrics.DB_LATENCY.observe(time.perf_counter() - start, op=op)
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+# --- Пакетная запись из outbox ---
+# id генерируется на нашей стороне и служит ключом идемпотентности при повторе пачки
+
+async def _insert_complaints(rows):
+    await _execute("insert_complaints", lambda db: db.table("complaints").upsert(rows, on_conflict="id", ignore_duplicates=True))
+
+async def _insert_messages(rows):
+    await _execute("insert_messages", lambda db: db.table("ticket_messages").upsert(rows, on_conflict="id", ignore_duplicates=True))
+
+async def _update_statuses(items):
+    by_status = {}
+    for item in items:
+        by_status.setdefault(item["status"], []).append(item["id"])
+    for status, ids in by_status.items():
+        await _execute("update_statuses", lambda db: db.table("complaints").update({"status": status}).in_("id", list(set(ids))))
+
+outbox.journal.register_sink("complaints", _insert_complaints)
+outbox.journal.register_sink("ticket_messages", _insert_messages)
+outbox.journal.register_sink("status", _update_statuses)
+# Сетевые ошибки PostgREST — недоступность БД, а не плохая запись
+outbox.journal.register_transient_errors(httpx.TransportError)
 
 async def create_complaint(user_id, username, phone, category, sub_category, location, description, extra_data, photo_ids):
-    """Создает новую заявку в таблице complaints"""
+    """Создает новую заявку: пишет в outbox и сразу возвращает строку, в БД она уйдет пачкой"""
     try:
         data = {
+            "id": str(uuid.uuid4()),
+            "created_at": _now(),
             "user_id": user_id,
             "username": f"@{username}" if username else "Anonymous",
             "contact_phone": phone,
@@ -26,67 +136,259 @@ async def create_complaint(user_id, username, phone, category, sub_category, loc
             "status": "new",
             "priority": "medium"
         }
-        response = supabase.table("complaints").insert(data).execute()
-        return response.data
+        await outbox.journal.enqueue("complaints", data)
+        _ticket_owners.set(data["id"], user_id)
+        recent = _recent.get(user_id) or []
+        _recent.set(user_id, [{k: data[k] for k in HISTORY_COLUMNS}] + recent[:RECENT_PER_USER - 1])
+        invalidate_user_history(user_id)
+        _notify("complaint_created", data)
+        return [data]
     except Exception as e:
-        logger.error(f"DB Insert Error: {e}")
+        logger.error(f"Outbox Insert Error: {e}")
         return None
 
 async def get_ticket_user_id(ticket_id):
     """Получает Telegram ID пользователя по ID заявки"""
     try:
-        res = supabase.table("complaints").select("user_id").eq("id", ticket_id).single().execute()
-        return res.data['user_id'] if res.data else None
+        user_id = _ticket_owners.get(ticket_id)
+        if user_id is not None:
+            return user_id
+        res = await _execute("get_ticket_user_id", lambda db: db.table("complaints").select("user_id").eq("id", ticket_id).single())
+        user_id = res.data['user_id'] if res.data else None
+        if user_id is not None:
+            _ticket_owners.set(ticket_id, user_id)
+        return user_id
     except Exception as e:
         logger.error(f"DB Fetch User Error: {e}")
         return None
 
 async def save_operator_message(ticket_id, text, file_ids):
-    """Сохраняет сообщение оператора с file_id вместо ссылок"""
+    """Сохраняет сообщение оператора с file_id вместо ссылок (через outbox)"""
     try:
         data = {
+            "id": str(uuid.uuid4()),
+            "created_at": _now(),
             "ticket_id": ticket_id,
             "sender": "operator",
             "message_text": text,
             "attachments": file_ids, # Массив file_id
             "is_sent_to_telegram": True # Мы отправляем его сразу через бота
         }
-        supabase.table("ticket_messages").insert(data).execute()
+        await outbox.journal.enqueue("ticket_messages", data)
         # Обновляем статус заявки
-        supabase.table("complaints").update({"status": "in_work"}).eq("id", ticket_id).execute()
+        await outbox.journal.enqueue("status", {"id": ticket_id, "status": "in_work"})
+        _notify("message_saved", data)
+        _notify("status_changed", {"id": ticket_id, "status": "in_work"})
+        # Если владелец неизвестен, кэш его истории просто доживет до TTL
+        owner = _ticket_owners.get(ticket_id)
+        if owner is not None:
+            invalidate_user_history(owner)
+        return True
+    except Exception as e:
+        logger.error(f"Outbox Message Save Error: {e}")
+        return False
+
+async def save_user_message(ticket_id, text, file_ids):
+    """Сообщение жителя в существующую заявку (например, объединенный дубликат)"""
+    try:
+        data = {
+            "id": str(uuid.uuid4()),
+            "created_at": _now(),
+            "ticket_id": ticket_id,
+            "sender": "user",
+            "message_text": text,
+            "attachments": file_ids,
+            "is_sent_to_telegram": True # Пришло из Telegram, доставлять некуда
+        }
+        await outbox.journal.enqueue("ticket_messages", data)
+        _notify("message_saved", data)
+        return True
+    except Exception as e:
+        logger.error(f"Outbox User Message Save Error: {e}")
+        return False
+
+async def save_bot_notes(notes):
+    """Служебные заметки бота в историю заявок (например, эскалации SLA): [(ticket_id, text)]"""
+    try:
+        for ticket_id, text in notes:
+            data = {
+                "id": str(uuid.uuid4()),
+                "created_at": _now(),
+                "ticket_id": ticket_id,
+                "sender": "bot",
+                "message_text": text,
+                "attachments": [],
+                "is_sent_to_telegram": True # Жителю не отправляется
+            }
+            await outbox.journal.enqueue("ticket_messages", data)
+            _notify("message_saved", data)
         return True
     except Exception as e:
-        logger.error(f"DB Message Save Error: {e}")
+        logger.error(f"Outbox Bot Note Save Error: {e}")
         return False
 
 async def get_unsent_operator_messages():
     """Legacy: Получает ответы (если вдруг записаны старым способом)"""
     try:
-        res = supabase.table("ticket_messages")\
-            .select("*, complaints(user_id)")\
-            .eq("sender", "operator")\
-            .eq("is_sent_to_telegram", False)\
-            .execute()
+        res = await _execute("get_unsent_operator_messages", lambda db: db.table("ticket_messages")
+            .select("*, complaints(user_id)")
+            .eq("sender", "operator")
+            .eq("is_sent_to_telegram", False))
         return res.data
     except Exception as e:
         logger.error(f"DB Fetch Error: {e}")
         return []
 
+async def claim_unsent_operator_messages(limit, lease):
+    """
+    Берет в аренду на lease секунд пачку неотправленных ответов операторов (колонка delivery_claimed_at).
+    Захват — один условный UPDATE ... WHERE аренды нет или она истекла: строку получает только тот процесс,
+    чей UPDATE ее изменил, поэтому несколько реплик не шлют одно сообщение одновременно.
+    Отправленной строка отмечается только после отправки (mark_operator_messages_sent); если процесс упал
+    раньше, аренда истекает и сообщение уходит повторно — доставка «хотя бы раз».
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(seconds=lease)).isoformat()
+    free = f'delivery_claimed_at.is.null,delivery_claimed_at.lt."{cutoff}"'
+    try:
+        res = await _execute("claim_unsent_operator_messages", lambda db: db.table("ticket_messages")
+            .select("id, ticket_id, message_text, attachments, complaints(user_id)")
+            .eq("sender", "operator")
+            .eq("is_sent_to_telegram", False)
+            .or_(free)
+            .order("created_at")
+            .limit(limit))
+        if not res.data:
+            return []
+        ids = [row["id"] for row in res.data]
+        claimed = await _execute("claim_unsent_operator_messages", lambda db: db.table("ticket_messages")
+            .update({"delivery_claimed_at": _now()})
+            .in_("id", ids)
+            .eq("is_sent_to_telegram", False)
+            .or_(free))
+        claimed_ids = {row["id"] for row in claimed.data}
+        return [row for row in res.data if row["id"] in claimed_ids]
+    except Exception as e:
+        logger.error(f"DB Claim Error: {e}")
+        return []
+
+async def mark_operator_messages_sent(msg_ids):
+    """Отмечает отправленные (или не подлежащие отправке) сообщения одним UPDATE"""
+    try:
+        await _execute("mark_operator_messages_sent", lambda db: db.table("ticket_messages").update({"is_sent_to_telegram": True}).in_("id", msg_ids))
+    except Exception as e:
+        # Аренда истечет, и сообщения уйдут еще раз
+        logger.error(f"DB Mark Sent Error: {e}")
+
+async def release_operator_messages(msg_ids):
+    """Снимает аренду с неотправленных сообщений одним UPDATE — они вернутся в очередь"""
+    try:
+        await _execute("release_operator_messages", lambda db: db.table("ticket_messages").update({"delivery_claimed_at": None}).in_("id", msg_ids))
+    except Exception as e:
+        logger.error(f"DB Release Error: {e}")
+
+async def subscribe_changes(table, callback, event="*"):
+    """Подписка на изменения таблицы через Supabase Realtime; callback(payload) вызывается в event loop"""
+    client = await get_client()
+    if not client.realtime.is_connected:
+        await client.realtime.connect()
+    channel = client.channel(f"bot-{table}-{event.lower()}")
+    channel.on_postgres_changes(event, schema="public", table=table, callback=callback)
+    await channel.subscribe()
+    return channel
+
+def realtime_record(payload):
+    """Строка из события Realtime (формат payload отличается между версиями realtime-py)"""
+    data = payload.get("data", payload) if isinstance(payload, dict) else {}
+    return data.get("record") or data.get("new")
+
+_watching = False
+# geo и sla подписываются параллельно: без замка оба успели бы подписаться до установки флага
+_watch_lock = asyncio.Lock()
+
+async def watch_complaints():
+    """Изменения complaints из дашборда (статус, удаление) -> слушатели, событие complaint_updated"""
+    global _watching
+    async with _watch_lock:
+        if _watching:
+            return
+        def on_change(payload):
+            record = realtime_record(payload)
+            if record and record.get("id"):
+                _notify("complaint_updated", record)
+        await subscribe_changes("complaints", on_change, event="UPDATE")
+        _watching = True
+
+async def iter_rows(table, columns="*", where=None, page_size=1000, op="iter_rows"):
+    """
+    Обходит таблицу страницами по ключу (created_at, id) без OFFSET: каждая страница — индексный поиск.
+    where(query) добавляет фильтры. Отдает списки строк.
+    """
+    cursor = None
+    while True:
+        def build(db):
+            query = db.table(table).select(columns)
+            if where:
+                query = where(query)
+            if cursor:
+                created_at, row_id = cursor
+                query = query.or_(f'created_at.gt."{created_at}",and(created_at.eq."{created_at}",id.gt."{row_id}")')
+            return query.order("created_at").order("id").limit(page_size)
+        res = await _execute(op, build)
+        rows = res.data or []
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        cursor = (rows[-1]["created_at"], rows[-1]["id"])
+
 async def mark_message_as_sent(msg_id):
     try:
-        supabase.table("ticket_messages").update({"is_sent_to_telegram": True}).eq("id", msg_id).execute()
+        await _execute("mark_message_as_sent", lambda db: db.table("ticket_messages").update({"is_sent_to_telegram": True}).eq("id", msg_id))
     except Exception as e:
         logger.error(f"DB Update Error: {e}")
 
-async def get_user_complaints(user_id, limit=5):
+def invalidate_user_history(user_id):
+    _history.pop(user_id)
+
+def _history_key(row):
+    return datetime.fromisoformat(row["created_at"]), row["id"]
+
+async def get_user_complaints(user_id, limit=5, before=None):
+    """
+    Последние заявки пользователя, новые сверху.
+    before — курсор (created_at, id) последней показанной заявки для следующей страницы без OFFSET;
+    id различает заявки с одинаковым created_at. Курсор старых кнопок — (created_at, None).
+    """
+    pages = _history.get(user_id)
+    if pages is not None and (before, limit) in pages:
+        return pages[(before, limit)]
     try:
-        res = supabase.table("complaints")\
-            .select("category, status, created_at, description")\
-            .eq("user_id", user_id)\
-            .order("created_at", desc=True)\
-            .limit(limit)\
-            .execute()
-        return res.data
+        def build(db):
+            query = db.table("complaints")\
+                .select(", ".join(HISTORY_COLUMNS))\
+                .eq("user_id", user_id)
+            if before:
+                created_at, row_id = before
+                if row_id:
+                    query = query.or_(f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt."{row_id}")')
+                else:
+                    query = query.lt("created_at", created_at)
+            return query.order("created_at", desc=True).order("id", desc=True).limit(limit)
+        res = await _execute("get_user_complaints", build)
+        rows = res.data or []
+        # Свои недавние заявки, которые могут быть еще в outbox
+        known = {row["id"] for row in rows}
+        recent = [
+            row for row in _recent.get(user_id) or []
+            if row["id"] not in known and (not before or _history_key(row) < _history_key({"created_at": before[0], "id": before[1] or ""}))
+        ]
+        if recent:
+            rows = sorted(rows + recent, key=_history_key, reverse=True)[:limit]
+        if pages is None:
+            pages = {}
+            _history.set(user_id, pages)
+        pages[(before, limit)] = rows
+        return rows
     except Exception as e:
         logger.error(f"DB History Error: {e}")
         return []
@@ -0,0 +1,210 @@
+import logging
+import math
+import re
+import time
+import zlib
+from collections import deque
+from datetime import datetime, timezone, timedelta
+import database
+import geo
+from config import (DEDUP_ENABLED, DEDUP_WINDOW, DEDUP_RADIUS_M, DEDUP_NEAR_SIMILARITY,
+                    DEDUP_TEXT_SIMILARITY)
+
+logger = logging.getLogger(__name__)
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE = 4
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 32) - 1
+# Фиксированные коэффициенты, чтобы сигнатуры совпадали между перезапусками
+_PERMS = [((i * 0x9E3779B1 + 0x7F4A7C15) % _PRIME | 1, (i * 0x85EBCA77 + 0xC2B2AE3D) % _PRIME) for i in range(1, NUM_PERM + 1)]
+_WORD_RE = re.compile(r"[0-9a-zа-я]+")
+EARTH_RADIUS_M = 6371000
+
+def _normalize(text):
+    return " ".join(_WORD_RE.findall((text or "").lower().replace("ё", "е")))
+
+def signature(text):
+    """MinHash-сигнатура по символьным 4-граммам нормализованного текста"""
+    text = _normalize(text)
+    if len(text) < SHINGLE:
+        text = text.ljust(SHINGLE)
+    hashes = {zlib.crc32(text[i:i + SHINGLE].encode()) for i in range(len(text) - SHINGLE + 1)}
+    return tuple(min(((a * h + b) % _PRIME) & _MASK for h in hashes) for a, b in _PERMS)
+
+def similarity(sig_a, sig_b):
+    """Оценка коэффициента Жаккара по совпадающим позициям сигнатур"""
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / NUM_PERM
+
+def distance_m(a, b):
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(h))
+
+def _place(coords, location, extra):
+    """(нормализованный введенный адрес — только без координат, нормализованные маршрут/номер)"""
+    return (None if coords is not None else _normalize(location)), _normalize(extra)
+
+def _parse_time(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+class DuplicateDetector:
+    """
+    Недавние открытые заявки в памяти: LSH-корзины MinHash по тексту и сетка с шагом ~радиус по координатам,
+    обе с ключом по категории. Проверка новой заявки смотрит только кандидатов из своих корзин и соседних ячеек.
+    Дубликат: рядом (radius_m) и хоть немного похож текст — или у одной из заявок нет координат, но тот же
+    введенный адрес и почти тот же текст. Заявки с координатами дальше radius_m друг от друга, с разными
+    адресами или с разными маршрутом/номером (extra) не склеиваются никогда.
+    """
+    def __init__(self, window, radius_m, near_similarity, text_similarity, listen=True):
+        self.window = window
+        self.radius_m = radius_m
+        self.near_similarity = near_similarity
+        self.text_similarity = text_similarity
+        # Шаг сетки ~ радиус (в градусах широты), так что все соседи в пределах 3x3 ячеек
+        self._cell_deg = radius_m / 111000
+        self._entries = {}  # id -> (category, sub_category, coords, sig, created, place)
+        self._order = deque()  # (created, id) в порядке поступления — для вытеснения по окну
+        self._bands = {}  # (category, band, hash) -> {id}
+        self._cells = {}  # (category, x, y) -> {id}
+        self.ready = False
+        self.stats = {"checks": 0, "duplicates": 0, "check_seconds_total": 0.0}
+        if listen:
+            database.add_listener(self.on_event)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _cell(self, category, coords):
+        lat, lon = coords
+        # Шаг по долготе считается от целого градуса широты, чтобы соседние ряды сетки совпадали
+        lon_step = self._cell_deg / max(math.cos(math.radians(round(lat))), 0.01)
+        return category, int(lat // self._cell_deg), int(lon // lon_step)
+
+    def _band_keys(self, category, sig):
+        return [(category, b, hash(sig[b * ROWS:(b + 1) * ROWS])) for b in range(BANDS)]
+
+    def add(self, ticket_id, category, sub_category, coords, description, created=None, location=None, extra=None):
+        if ticket_id in self._entries:
+            return
+        # Вытесняем и здесь: без проверок (find) индекс иначе рос бы без ограничений
+        self._expire()
+        created = created or time.time()
+        sig = signature(description)
+        self._entries[ticket_id] = (category, sub_category, coords, sig, created, _place(coords, location, extra))
+        self._order.append((created, ticket_id))
+        for key in self._band_keys(category, sig):
+            self._bands.setdefault(key, set()).add(ticket_id)
+        if coords is not None:
+            self._cells.setdefault(self._cell(category, coords), set()).add(ticket_id)
+
+    def remove(self, ticket_id):
+        entry = self._entries.pop(ticket_id, None)
+        if entry is None:
+            return
+        category, _, coords, sig, _, _ = entry
+        for key in self._band_keys(category, sig):
+            bucket = self._bands.get(key)
+            if bucket is not None:
+                bucket.discard(ticket_id)
+                if not bucket:
+                    del self._bands[key]
+        if coords is not None:
+            key = self._cell(category, coords)
+            bucket = self._cells.get(key)
+            if bucket is not None:
+                bucket.discard(ticket_id)
+                if not bucket:
+                    del self._cells[key]
+
+    def _expire(self):
+        horizon = time.time() - self.window
+        while self._order and self._order[0][0] < horizon:
+            _, ticket_id = self._order.popleft()
+            self.remove(ticket_id)
+
+    def find(self, category, sub_category, coords, description, location=None, extra=None):
+        """id похожей открытой заявки или None"""
+        start = time.perf_counter()
+        self._expire()
+        sig = signature(description)
+        address, extra = _place(coords, location, extra)
+        candidates = set()
+        for key in self._band_keys(category, sig):
+            candidates |= self._bands.get(key, set())
+        if coords is not None:
+            _, cy, cx = self._cell(category, coords)
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    candidates |= self._cells.get((category, cy + dy, cx + dx), set())
+
+        best, best_score = None, 0.0
+        for ticket_id in candidates:
+            _, other_sub, other_coords, other_sig, _, (other_address, other_extra) = self._entries[ticket_id]
+            # Другой маршрут или госномер — другая проблема, как бы ни был похож текст
+            if extra != other_extra:
+                continue
+            score = similarity(sig, other_sig)
+            if coords is not None and other_coords is not None:
+                # Обе точки известны: шаблонный текст в другом конце города — не дубликат
+                if distance_m(coords, other_coords) > self.radius_m:
+                    continue
+                threshold = self.near_similarity if other_sub == sub_category else self.text_similarity
+            elif address and address == other_address:
+                threshold = self.text_similarity
+            else:
+                # Место не сравнить (точка против адреса, разные или пустые адреса) — не склеиваем
+                continue
+            is_dup = score >= threshold
+            if is_dup and score >= best_score:
+                best, best_score = ticket_id, score
+
+        self.stats["checks"] += 1
+        self.stats["check_seconds_total"] += time.perf_counter() - start
+        if best is not None:
+            self.stats["duplicates"] += 1
+        return best
+
+    def _add_row(self, row):
+        coords = geo.coordinates(row)
+        self.add(row["id"], row.get("category"), row.get("sub_category"), coords, row.get("description"),
+                 _parse_time(row.get("created_at")), row.get("location"), (row.get("extra_data") or {}).get("info"))
+
+    def on_event(self, event, row):
+        if event == "complaint_created":
+            self._add_row(row)
+        elif event in ("status_changed", "complaint_updated"):
+            if row.get("status") in geo.CLOSED_STATUSES or row.get("is_deleted"):
+                self.remove(row["id"])
+
+    async def rebuild(self):
+        """Заявки за окно — одним проходом по БД при старте"""
+        since = (datetime.now(timezone.utc) - timedelta(seconds=self.window)).isoformat()
+        async for rows in database.iter_rows(
+            "complaints", "id, created_at, category, sub_category, status, location, description, extra_data",
+            where=lambda q: q.gte("created_at", since).not_.in_("status", sorted(geo.CLOSED_STATUSES)).eq("is_deleted", False),
+            op="dedup_rebuild",
+        ):
+            for row in rows:
+                self._add_row(row)
+        self.ready = True
+        logger.info(f"Dedup index: {len(self)} recent open complaints")
+
+    def snapshot(self):
+        checks = self.stats["checks"]
+        return {
+            **self.stats, "entries": len(self),
+            "check_seconds_avg": round(self.stats["check_seconds_total"] / checks, 6) if checks else 0.0,
+        }
+
+detector = DuplicateDetector(DEDUP_WINDOW, DEDUP_RADIUS_M, DEDUP_NEAR_SIMILARITY, DEDUP_TEXT_SIMILARITY,
+                             listen=DEDUP_ENABLED)
+
+async def warm_up():
+    if DEDUP_ENABLED:
+        await detector.rebuild()
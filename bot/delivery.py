@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+import database
+import sender
+
+logger = logging.getLogger(__name__)
+
+class DeliveryEngine:
+    """
+    Доставка сообщений операторов, записанных в ticket_messages напрямую (дашбордом или старым кодом).
+    Сообщения берутся в аренду пачкой (один условный bulk UPDATE), рассылаются параллельно
+    через sender.scheduler с низким приоритетом; отправленные чата отмечаются сразу после его отправки,
+    неудачные одной пачкой возвращаются в очередь. Доставка «хотя бы раз»: упавший после отправки, но до отметки
+    процесс не теряет ответ — после истечения аренды он уйдет повторно.
+    Бот заблокирован или Telegram отверг само сообщение — повтор не поможет: такие отмечаются как отправленные.
+    Новые сообщения будят движок через realtime-подписку; опрос раз в poll_interval — страховка.
+    """
+    def __init__(self, bot, batch_size, poll_interval, concurrency, lease):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wake = asyncio.Event()
+        self._task = None
+        self.stats = {"delivered": 0, "failed": 0, "rejected": 0, "skipped": 0, "batches": 0}
+
+    def wake(self, *_):
+        self._wake.set()
+
+    def start(self, realtime=True):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(realtime), name="operator-delivery")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, realtime):
+        if realtime:
+            try:
+                await database.subscribe_changes("ticket_messages", self.wake, event="INSERT")
+                logger.info("Delivery: subscribed to ticket_messages changes")
+            except Exception as e:
+                logger.warning(f"Delivery: realtime unavailable, polling every {self.poll_interval}s ({e})")
+        while True:
+            try:
+                # Следующую пачку берем сразу, только если эта полностью обработана; иначе
+                # возвращенные в очередь ждут опроса, а не крутятся в цикле
+                while await self.deliver_batch() >= self.batch_size:
+                    pass
+            except Exception as e:
+                logger.error(f"Delivery Error: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def deliver_batch(self):
+        """Захватывает и рассылает одну пачку; возвращает число обработанных (не возвращенных в очередь)"""
+        rows = await database.claim_unsent_operator_messages(self.batch_size, self.lease)
+        if not rows:
+            return 0
+        self.stats["batches"] += 1
+
+        by_chat, skipped = {}, []
+        for row in rows:
+            user_id = (row.get("complaints") or {}).get("user_id")
+            if not user_id:
+                logger.warning(f"Delivery: no user for message {row['id']}, dropping")
+                skipped.append(row["id"])
+                continue
+            by_chat.setdefault(user_id, []).append(row)
+        if skipped:
+            self.stats["skipped"] += len(skipped)
+            await database.mark_operator_messages_sent(skipped)
+
+        results = await asyncio.gather(*(self._deliver_chat(chat_id, msgs) for chat_id, msgs in by_chat.items()))
+        failed = [msg_id for chat_failed in results for msg_id in chat_failed]
+        if failed:
+            self.stats["failed"] += len(failed)
+            await database.release_operator_messages(failed)
+        return len(rows) - len(failed)
+
+    async def _deliver_chat(self, chat_id, messages):
+        """Сообщения одного чата — по порядку; отмечает отправленные и возвращает id для повтора"""
+        done, failed = [], []
+        async with self._semaphore:
+            for msg in messages:
+                try:
+                    await self._send(chat_id, msg)
+                    self.stats["delivered"] += 1
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    logger.error(f"Delivery: message {msg['id']} to {chat_id} rejected, not retrying: {e}")
+                    self.stats["rejected"] += 1
+                except Exception as e:
+                    logger.error(f"Delivery to {chat_id} failed: {e}")
+                    failed.append(msg["id"])
+                    continue
+                done.append(msg["id"])
+        if done:
+            await database.mark_operator_messages_sent(done)
+        return failed
+
+    async def _send(self, chat_id, msg):
+        text = msg.get("message_text") or ""
+        attachments = msg.get("attachments") or []
+        with sender.bulk():
+            await self._send_parts(chat_id, text, attachments)
+
+    async def _send_parts(self, chat_id, text, attachments):
+        # В альбоме не больше 10 фото: больше — несколькими альбомами, подпись у первого фото
+        for start in range(0, len(attachments), 10):
+            chunk = attachments[start:start + 10]
+            caption = text[:1000] if start == 0 and text else None
+            if len(chunk) == 1:
+                await self.bot.send_photo(chat_id=chat_id, photo=chunk[0], caption=caption)
+            else:
+                media = [types.InputMediaPhoto(media=att, caption=caption if i == 0 else None) for i, att in enumerate(chunk)]
+                await self.bot.send_media_group(chat_id=chat_id, media=media)
+        if attachments:
+            text = text[1000:]
+        if text:
+            await self.bot.send_message(chat_id=chat_id, text=text)
@@ -0,0 +1,116 @@
+import csv
+import io
+import json
+import logging
+from datetime import date, datetime, time, timezone, timedelta
+from aiohttp import web
+import database
+
+logger = logging.getLogger(__name__)
+
+# Выгружаемые колонки; вложенные (extra_data, photos, attachments) в CSV пишутся JSON-строкой
+COLUMNS = {
+    "complaints": ["id", "created_at", "user_id", "username", "contact_phone", "category", "sub_category",
+                   "status", "priority", "location", "description", "extra_data", "photos", "is_deleted"],
+    "ticket_messages": ["id", "created_at", "ticket_id", "sender", "message_text", "attachments", "is_sent_to_telegram"],
+}
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+    # Колоночные группы строк: одна JSON-строка на страницу, {"columns": {колонка: [значения]}}
+    "columnar": ("application/x-ndjson", "columns.ndjson"),
+}
+
+class ExportError(Exception):
+    pass
+
+def parse_filters(table, query, utc_offset_hours=0):
+    """Фильтры из query string -> функция where(query) для database.iter_rows; даты from/to — местные"""
+    if table not in COLUMNS:
+        raise ExportError(f"Unknown table '{table}'")
+    tz = timezone(timedelta(hours=utc_offset_hours))
+    bounds = {}
+    for name in ("from", "to"):
+        if query.get(name):
+            try:
+                day = date.fromisoformat(query[name])
+            except ValueError:
+                raise ExportError(f"'{name}' must be YYYY-MM-DD")
+            # to — включительно: до начала следующих местных суток
+            if name == "to":
+                day += timedelta(days=1)
+            bounds[name] = datetime.combine(day, time.min, tzinfo=tz).isoformat()
+    categories = [c for c in query.get("category", "").split(",") if c]
+    statuses = [s for s in query.get("status", "").split(",") if s]
+    ticket_id = query.get("ticket_id")
+    if table == "ticket_messages" and (categories or statuses):
+        raise ExportError("category/status filters apply to complaints only")
+
+    def where(q):
+        if "from" in bounds:
+            q = q.gte("created_at", bounds["from"])
+        if "to" in bounds:
+            q = q.lt("created_at", bounds["to"])
+        if categories:
+            q = q.in_("category", categories)
+        if statuses:
+            q = q.in_("status", statuses)
+        if table == "complaints" and query.get("include_deleted") != "1":
+            q = q.eq("is_deleted", False)
+        if table == "ticket_messages" and ticket_id:
+            q = q.eq("ticket_id", ticket_id)
+        return q
+    return where
+
+def _cell(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+    return "" if value is None else value
+
+def encode_page(fmt, columns, rows):
+    if fmt == "ndjson":
+        return "".join(json.dumps({c: row.get(c) for c in columns}, ensure_ascii=False, separators=(",", ":")) + "\n" for row in rows)
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows([_cell(row.get(c)) for c in columns] for row in rows)
+        return buffer.getvalue()
+    return json.dumps({"rows": len(rows), "columns": {c: [row.get(c) for row in rows] for c in columns}},
+                      ensure_ascii=False, separators=(",", ":")) + "\n"
+
+async def stream(request, table, fmt, where, page_size):
+    """
+    Пишет выгрузку в ответ страница за страницей (keyset по created_at, id):
+    в памяти одновременно только одна страница, медленный клиент тормозит чтение из БД через drain.
+    """
+    content_type, extension = FORMATS[fmt]
+    columns = COLUMNS[table]
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    response = web.StreamResponse(headers={
+        "Content-Type": f"{content_type}; charset=utf-8",
+        "Content-Disposition": f'attachment; filename="{table}-{stamp}.{extension}"',
+        "Cache-Control": "no-store",
+    })
+    response.enable_compression()
+    await response.prepare(request)
+
+    if fmt == "csv":
+        # BOM — чтобы Excel открыл кириллицу без мастера импорта
+        await response.write(("\ufeff" + encode_page(fmt, columns, [dict(zip(columns, columns))])).encode())
+    elif fmt == "columnar":
+        await response.write((json.dumps({"table": table, "columns": columns}) + "\n").encode())
+
+    total = 0
+    try:
+        async for rows in database.iter_rows(table, ", ".join(columns), where=where, page_size=page_size, op="export"):
+            await response.write(encode_page(fmt, columns, rows).encode())
+            total += len(rows)
+    except Exception as e:
+        # Заголовки уже ушли, статус не поменять: рвем соединение, чтобы клиент не принял обрезанный файл за целый
+        logger.error(f"Export of {table} failed after {total} rows: {e}")
+        if request.transport is not None:
+            request.transport.close()
+        return response
+    await response.write_eof()
+    logger.info(f"Exported {total} rows of {table} as {fmt}")
+    return response
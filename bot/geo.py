@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import math
+import time
+from collections import Counter
+import database
+
+logger = logging.getLogger(__name__)
+
+# Закрытые заявки на карте открытых не показываем
+CLOSED_STATUSES = frozenset({"resolved", "measures_taken", "not_confirmed", "rejected"})
+# Уровень самой мелкой ячейки (тайлы Web Mercator, на 20-м уровне — десятки метров)
+LEAF_LEVEL = 20
+# Кластер ~ четверть тайла 256px, т.е. ~64px на экране
+CLUSTER_LEVEL_OFFSET = 2
+
+def parse_location(value):
+    """'lat,lon' -> (lat, lon) или None, если это адрес текстом"""
+    if not value or "," not in value:
+        return None
+    try:
+        lat, lon = (float(part.strip()) for part in value.split(",", 1))
+    except ValueError:
+        return None
+    if -90 <= lat <= 90 and -180 <= lon <= 180:
+        return lat, lon
+    return None
+
+def coordinates(row):
+    """Координаты заявки: extra_data.geo (новые заявки), иначе строка location (старые)"""
+    geo = (row.get("extra_data") or {}).get("geo")
+    if isinstance(geo, dict) and "lat" in geo and "lon" in geo:
+        return float(geo["lat"]), float(geo["lon"])
+    return parse_location(row.get("location"))
+
+def _project(lat, lon):
+    """Web Mercator в [0, 1) x [0, 1)"""
+    lat = max(-85.05112878, min(85.05112878, lat))
+    x = (lon + 180.0) / 360.0
+    s = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)
+    return min(max(x, 0.0), 0.999999999), min(max(y, 0.0), 0.999999999)
+
+class GeoIndex:
+    """
+    Пирамида сеток по уровням тайлов 0..LEAF_LEVEL.
+    В каждой ячейке каждого уровня — готовый агрегат (число точек, сумма координат, категории),
+    поэтому кластеры для экрана собираются из ~сотни ячеек, а не из всех заявок.
+    Точки хранятся только в листовых ячейках.
+    """
+    def __init__(self):
+        self._points = {}  # id -> (lat, lon, category, status, key)
+        # (x, y) -> [count, sum_lat, sum_lon, Counter категорий, xor ключей точек]
+        self._levels = [{} for _ in range(LEAF_LEVEL + 1)]
+        self._leaves = {}  # (x, y) -> {id}
+        # Целочисленные ключи точек: в ячейке из одной точки xor ключей и есть ее ключ
+        self._keys = {}  # key -> id
+        self._next_key = 1
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cells(self, lat, lon):
+        x, y = _project(lat, lon)
+        for level in range(LEAF_LEVEL + 1):
+            n = 1 << level
+            yield level, (int(x * n), int(y * n))
+
+    def _leaf(self, lat, lon):
+        x, y = _project(lat, lon)
+        n = 1 << LEAF_LEVEL
+        return int(x * n), int(y * n)
+
+    def add(self, ticket_id, lat, lon, category, status="new"):
+        if ticket_id in self._points:
+            self.remove(ticket_id)
+        key = self._next_key
+        self._next_key += 1
+        self._keys[key] = ticket_id
+        self._points[ticket_id] = (lat, lon, category, status, key)
+        for level, cell in self._cells(lat, lon):
+            agg = self._levels[level].get(cell)
+            if agg is None:
+                agg = self._levels[level][cell] = [0, 0.0, 0.0, Counter(), 0]
+            agg[0] += 1
+            agg[1] += lat
+            agg[2] += lon
+            agg[3][category] += 1
+            agg[4] ^= key
+        self._leaves.setdefault(self._leaf(lat, lon), set()).add(ticket_id)
+
+    def remove(self, ticket_id):
+        point = self._points.pop(ticket_id, None)
+        if point is None:
+            return
+        lat, lon, category, _, key = point
+        del self._keys[key]
+        for level, cell in self._cells(lat, lon):
+            agg = self._levels[level][cell]
+            agg[0] -= 1
+            if agg[0] == 0:
+                del self._levels[level][cell]
+                continue
+            agg[1] -= lat
+            agg[2] -= lon
+            agg[3][category] -= 1
+            if not agg[3][category]:
+                del agg[3][category]
+            agg[4] ^= key
+        leaf_cell = self._leaf(lat, lon)
+        leaf = self._leaves[leaf_cell]
+        leaf.discard(ticket_id)
+        if not leaf:
+            del self._leaves[leaf_cell]
+
+    def set_status(self, ticket_id, status):
+        point = self._points.get(ticket_id)
+        if point is not None:
+            self._points[ticket_id] = point[:3] + (status, point[4])
+
+    def _cells_in_bbox(self, level, bbox):
+        """Непустые ячейки уровня в пределах bbox = (min_lon, min_lat, max_lon, max_lat)"""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        n = 1 << level
+        x0, y1 = _project(min_lat, min_lon)
+        x1, y0 = _project(max_lat, max_lon)
+        x0, x1, y0, y1 = int(x0 * n), int(x1 * n), int(y0 * n), int(y1 * n)
+        cells = self._levels[level]
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(cells):
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    if (x, y) in cells:
+                        yield (x, y), cells[(x, y)]
+        else:
+            for (x, y), agg in cells.items():
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    yield (x, y), agg
+
+    def _point(self, ticket_id):
+        lat, lon, category, status, _ = self._points[ticket_id]
+        return {"id": ticket_id, "lat": lat, "lon": lon, "category": category, "status": status}
+
+    def query(self, bbox, zoom, points_zoom):
+        """Кластеры и одиночные точки для окна карты; с points_zoom и ближе — только точки"""
+        zoom = max(0, min(int(zoom), LEAF_LEVEL))
+        min_lon, min_lat, max_lon, max_lat = bbox
+        clusters, points = [], []
+        if zoom >= points_zoom:
+            for cell, _ in self._cells_in_bbox(LEAF_LEVEL, bbox):
+                for ticket_id in self._leaves.get(cell, ()):
+                    lat, lon = self._points[ticket_id][:2]
+                    if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                        points.append(self._point(ticket_id))
+        else:
+            level = min(zoom + CLUSTER_LEVEL_OFFSET, LEAF_LEVEL)
+            for _, (count, sum_lat, sum_lon, cats, keys) in self._cells_in_bbox(level, bbox):
+                if count == 1:
+                    points.append(self._point(self._keys[keys]))
+                else:
+                    clusters.append({"lat": sum_lat / count, "lon": sum_lon / count, "count": count, "categories": dict(cats)})
+        return {"zoom": zoom, "total": sum(c["count"] for c in clusters) + len(points), "clusters": clusters, "points": points}
+
+class GeoService:
+    """Индекс открытых заявок: строится одним проходом по БД, живет на событиях database, периодически сверяется"""
+    def __init__(self, refresh_interval, points_zoom):
+        self.refresh_interval = refresh_interval
+        self.points_zoom = points_zoom
+        self.index = GeoIndex()
+        self.ready = False
+        self._task = None
+        # События, пришедшие во время пересборки: применяются к новому индексу после подмены
+        self._pending = None
+        self.stats = {"rebuilds": 0, "rebuild_seconds": 0.0}
+        database.add_listener(self.on_event)
+
+    def _apply(self, row):
+        ticket_id = row.get("id")
+        if not ticket_id:
+            return
+        if row.get("status") in CLOSED_STATUSES or row.get("is_deleted"):
+            self.index.remove(ticket_id)
+            return
+        coords = coordinates(row)
+        if coords is not None and row.get("category"):
+            self.index.add(ticket_id, coords[0], coords[1], row["category"], row.get("status") or "new")
+        elif "status" in row:
+            self.index.set_status(ticket_id, row["status"])
+
+    def on_event(self, event, row):
+        if self._pending is not None:
+            self._pending.append((event, row))
+        if event in ("complaint_created", "complaint_updated"):
+            self._apply(row)
+        elif event == "status_changed":
+            if row["status"] in CLOSED_STATUSES:
+                self.index.remove(row["id"])
+            else:
+                self.index.set_status(row["id"], row["status"])
+
+    async def rebuild(self):
+        start = time.perf_counter()
+        index = GeoIndex()
+        self._pending = []
+        try:
+            await self._scan(index)
+        finally:
+            pending, self._pending = self._pending, None
+        self.index = index
+        for event, row in pending:
+            self.on_event(event, row)
+        self.ready = True
+        self.stats["rebuilds"] += 1
+        self.stats["rebuild_seconds"] = round(time.perf_counter() - start, 3)
+        logger.info(f"Geo index: {len(index)} open complaints in {self.stats['rebuild_seconds']}s")
+
+    async def _scan(self, index):
+        async for rows in database.iter_rows(
+            "complaints", "id, created_at, category, status, location, extra_data",
+            where=lambda q: q.not_.in_("status", sorted(CLOSED_STATUSES)).eq("is_deleted", False),
+            op="geo_rebuild",
+        ):
+            for row in rows:
+                coords = coordinates(row)
+                if coords is not None:
+                    index.add(row["id"], coords[0], coords[1], row["category"], row["status"])
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="geo-index")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        # Статусы, которые меняет дашборд, приходят через realtime; полная пересборка — страховка
+        try:
+            await database.watch_complaints()
+        except Exception as e:
+            logger.warning(f"Geo index: realtime unavailable, relying on rebuilds ({e})")
+        while True:
+            try:
+                await self.rebuild()
+            except Exception as e:
+                logger.error(f"Geo index rebuild failed: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def query(self, bbox, zoom):
+        return self.index.query(bbox, zoom, self.points_zoom)
+
+    def snapshot(self):
+        return {**self.stats, "points": len(self.index), "ready": int(self.ready)}
@@ -1,12 +1,19 @@
+import uuid
+from datetime import datetime, timezone
 from aiogram import Router, F, types
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import Command
 import database
 import keyboards
-from config import CATEGORIES
+import categories
+import dedup
+import albums
+import throttling
+from config import DEDUP_ENABLED, ALBUM_WINDOW
 
 router = Router()
+album_collector = albums.AlbumCollector(ALBUM_WINDOW)
 
 class NewComplaint(StatesGroup):
     category = State()
@@ -21,13 +28,39 @@ class NewComplaint(StatesGroup):
 async def cmd_start(message: types.Message):
     await message.answer("Добро пожаловать в Городской Помощник! 🏙️\nЧто вы хотите сделать?", reply_markup=keyboards.get_main_menu())
 
-@router.message(F.text == "📂 Мои заявки")
-async def cmd_history(message: types.Message):
-    items = await database.get_user_complaints(message.from_user.id)
+HISTORY_PAGE_SIZE = 5
+
+def encode_history_cursor(row):
+    """(created_at, id) в callback_data: микросекунды и hex id, чтобы уложиться в 64 байта"""
+    created = datetime.fromisoformat(row['created_at'])
+    micros = (created - datetime(1970, 1, 1, tzinfo=timezone.utc)) // datetime.resolution
+    try:
+        row_id = uuid.UUID(row['id']).hex
+    except ValueError:
+        row_id = row['id']
+    return f"{micros}:{row_id}"
+
+def decode_history_cursor(value):
+    """Обратно в (created_at, id); кнопки старого формата несут только created_at"""
+    micros, sep, row_id = value.partition(":")
+    if not sep or not micros.isdigit():
+        return value, None
+    created = datetime(1970, 1, 1, tzinfo=timezone.utc) + int(micros) * datetime.resolution
+    try:
+        row_id = str(uuid.UUID(row_id))
+    except ValueError:
+        pass
+    return created.isoformat(), row_id
+
+async def render_history(user_id, before=None):
+    """Текст и клавиатура одной страницы истории; курсор — (created_at, id) последней заявки"""
+    items = await database.get_user_complaints(user_id, limit=HISTORY_PAGE_SIZE + 1, before=before)
     if not items:
-        return await message.answer("У вас пока нет активных заявок.")
-    
-    text = "📂 <b>Ваши последние заявки:</b>\n\n"
+        return None, None
+    has_more = len(items) > HISTORY_PAGE_SIZE
+    items = items[:HISTORY_PAGE_SIZE]
+
+    text = "📂 <b>Ваши последние заявки:</b>\n\n" if not before else "📂 <b>Более ранние заявки:</b>\n\n"
     status_map = {
         'new': '🔴 Новая', 'in_work': '🟡 В работе', 'resolved': '🟢 Решено', 
         'rejected': '⚪ Отклонено', 'clarification_needed': '🟠 Уточнение'
@@ -36,8 +69,25 @@ async def cmd_history(message: types.Message):
         status = status_map.get(item['status'], item['status'])
         desc = item['description'][:30] + "..." if len(item['description']) > 30 else item['description']
         text += f"▪️ {item['category']} ({status})\n<i>{desc}</i>\n\n"
+
+    kb = keyboards.get_history_kb(encode_history_cursor(items[-1])) if has_more else None
+    return text, kb
+
+@router.message(F.text == "📂 Мои заявки")
+async def cmd_history(message: types.Message):
+    text, kb = await render_history(message.from_user.id)
+    if not text:
+        return await message.answer("У вас пока нет активных заявок.")
     
-    await message.answer(text, parse_mode="HTML")
+    await message.answer(text, reply_markup=kb, parse_mode="HTML")
+
+@router.callback_query(F.data.startswith("hist:"))
+async def history_next_page(callback: types.CallbackQuery):
+    before = decode_history_cursor(callback.data.split(":", 1)[1])
+    text, kb = await render_history(callback.from_user.id, before=before)
+    await callback.answer()
+    if text:
+        await callback.message.answer(text, reply_markup=kb, parse_mode="HTML")
 
 @router.message(F.text == "📝 Новая заявка")
 async def start_complaint(message: types.Message, state: FSMContext):
@@ -45,14 +95,28 @@ async def start_complaint(message: types.Message, state: FSMContext):
     await message.answer("Выберите категорию обращения:", reply_markup=keyboards.get_categories_kb())
     await state.set_state(NewComplaint.category)
 
-@router.callback_query(F.data.startswith("cat_"))
+RESTART_TEXT = "Эта кнопка устарела. Нажмите «📝 Новая заявка», чтобы начать заново."
+
+async def restart_wizard(callback: types.CallbackQuery, state: FSMContext):
+    """Кнопка со старым или неизвестным кодом категории: мастер начинается заново"""
+    await state.clear()
+    await callback.answer(RESTART_TEXT, show_alert=True)
+
+# Кнопки старого формата (cat_<ключ>, sub_<индекс>) в уже отправленных сообщениях
+@router.callback_query(F.data.startswith("cat_") | F.data.startswith("sub_"))
+async def legacy_category_button(callback: types.CallbackQuery, state: FSMContext):
+    await restart_wizard(callback, state)
+
+@router.callback_query(F.data.startswith(categories.CATEGORY_PREFIX))
 async def process_category(callback: types.CallbackQuery, state: FSMContext):
-    cat_key = callback.data.split("_")[1]
-    cat_data = CATEGORIES[cat_key]
-    await state.update_data(cat_key=cat_key, category_name=cat_data['name'])
+    decoded = categories.decode(callback.data)
+    if decoded is None:
+        return await restart_wizard(callback, state)
+    cat, _ = decoded
+    await state.update_data(cat_key=cat.key, category_name=cat.name)
     
-    await callback.message.edit_text(f"Категория: <b>{cat_data['name']}</b>.\nУточните проблему:", 
-                                     reply_markup=keyboards.get_subcategories_kb(cat_key),
+    await callback.message.edit_text(f"Категория: <b>{cat.name}</b>.\nУточните проблему:", 
+                                     reply_markup=keyboards.get_subcategories_kb(cat.key),
                                      parse_mode="HTML")
     await state.set_state(NewComplaint.subcategory)
 
@@ -60,23 +124,24 @@ async def process_category(callback: types.CallbackQuery, state: FSMContext):
 async def back_to_cats(callback: types.CallbackQuery, state: FSMContext):
     await start_complaint(callback.message, state)
 
-@router.callback_query(F.data.startswith("sub_"))
+@router.callback_query(F.data.startswith(categories.SUB_PREFIX))
 async def process_subcategory(callback: types.CallbackQuery, state: FSMContext):
-    sub_idx = int(callback.data.split("_")[1])
-    data = await state.get_data()
-    cat_conf = CATEGORIES[data['cat_key']]
-    sub_name = cat_conf['subs'][sub_idx]
+    decoded = categories.decode(callback.data)
+    if decoded is None:
+        return await restart_wizard(callback, state)
+    # Категория закодирована в самой кнопке — состояние для нее читать не нужно
+    cat, sub_name = decoded
     
-    await state.update_data(sub_category=sub_name)
+    await state.update_data(cat_key=cat.key, category_name=cat.name, sub_category=sub_name)
     
     # 1. Если это простая категория (Благодарность/Обратная связь)
-    if cat_conf.get('simple'):
+    if cat.simple:
         await callback.message.answer("📝 Напишите ваш текст:", reply_markup=types.ReplyKeyboardRemove())
         await state.set_state(NewComplaint.description)
         return
 
     # 2. Если требует доп данных (Транспорт)
-    if cat_conf.get("req_extra"):
+    if cat.req_extra:
         await callback.message.answer("🚌 Укажите номер маршрута и госномер (если есть):", reply_markup=types.ReplyKeyboardRemove())
         await state.set_state(NewComplaint.extra_data)
         return
@@ -93,20 +158,20 @@ async def ask_photo(message: types.Message, state: FSMContext):
     await message.answer("📸 Пришлите фото (можно до 3-х штук) или нажмите Пропустить:", reply_markup=keyboards.get_skip_kb())
     await state.set_state(NewComplaint.photo)
 
+MAX_PHOTOS = 3
+# Шаги, на которых фото еще относятся к текущей заявке
+PHOTO_STEPS = {NewComplaint.photo.state, NewComplaint.location.state, NewComplaint.description.state, NewComplaint.phone.state}
+
 @router.message(NewComplaint.photo)
 async def process_photo(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    photos = data.get('photos', [])
-    
     if message.photo:
-        # Сохраняем file_id самого большого фото
-        photos.append(message.photo[-1].file_id)
-        await state.update_data(photos=photos)
-        
-        if len(photos) >= 3:
-            await ask_location(message, state)
+        # Сохраняем file_id самого большого фото и file_unique_id — чтобы одно фото не прикрепить дважды
+        item = (message.photo[-1].file_id, message.photo[-1].file_unique_id)
+        if message.media_group_id:
+            # Альбом приходит пачкой апдейтов: копим и обрабатываем разом — одна запись состояния и один ответ
+            album_collector.add((message.chat.id, message.media_group_id), item, lambda items: add_photos(message, state, items))
         else:
-            await message.answer(f"Фото добавлено ({len(photos)}/3). Еще?", reply_markup=keyboards.get_skip_kb())
+            await add_photos(message, state, [item])
         return
 
     if message.text == "Пропустить":
@@ -114,10 +179,38 @@ async def process_photo(message: types.Message, state: FSMContext):
     else:
         await message.answer("Пожалуйста, пришлите фото или нажмите кнопку Пропустить.")
 
+async def add_photos(message: types.Message, state: FSMContext, items):
+    async with albums.chat_lock(message.chat.id):
+        # Пока копился альбом, житель мог нажать Пропустить (фото все равно сохраним)
+        # или начать заявку заново (тогда фото уже не к чему прикреплять)
+        current = await state.get_state()
+        if current not in PHOTO_STEPS:
+            return
+        data = await state.get_data()
+        photos = list(data.get('photos', []))
+        uids = list(data.get('photo_uids', []))
+        added = 0
+        for file_id, uid in items:
+            if uid in uids or len(photos) >= MAX_PHOTOS:
+                continue
+            photos.append(file_id)
+            uids.append(uid)
+            added += 1
+        if added:
+            await state.update_data(photos=photos, photo_uids=uids)
+
+        if current != NewComplaint.photo.state:
+            return
+        if len(photos) >= MAX_PHOTOS:
+            await ask_location(message, state)
+        elif added:
+            await message.answer(f"Фото добавлено ({len(photos)}/{MAX_PHOTOS}). Еще?", reply_markup=keyboards.get_skip_kb())
+        else:
+            await message.answer("Это фото уже добавлено. Пришлите другое или нажмите Пропустить.", reply_markup=keyboards.get_skip_kb())
+
 async def ask_location(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    cat_conf = CATEGORIES[data['cat_key']]
-    req_geo = cat_conf.get("req_geo", False)
+    req_geo = categories.BY_KEY[data['cat_key']].req_geo
     
     text = "📍 Где это произошло?\n(Отправьте геопозицию или напишите адрес)"
     if req_geo:
@@ -129,12 +222,13 @@ async def ask_location(message: types.Message, state: FSMContext):
 @router.message(NewComplaint.location)
 async def process_location(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    cat_conf = CATEGORIES[data['cat_key']]
-    req_geo = cat_conf.get("req_geo", False)
+    req_geo = categories.BY_KEY[data['cat_key']].req_geo
 
     loc_str = None
+    geo = None
     if message.location:
         loc_str = f"{message.location.latitude},{message.location.longitude}"
+        geo = {"lat": message.location.latitude, "lon": message.location.longitude}
     elif message.text and not req_geo:
         loc_str = message.text
     elif message.text and message.text == "Пропустить" and not req_geo:
@@ -143,7 +237,7 @@ async def process_location(message: types.Message, state: FSMContext):
         await message.answer("⛔ Для этой категории нужна именно Геопозиция (точка на карте). Попробуйте еще раз.")
         return
 
-    await state.update_data(location=loc_str)
+    await state.update_data(location=loc_str, geo=geo)
     await message.answer("📝 Опишите проблему подробно:", reply_markup=types.ReplyKeyboardRemove())
     await state.set_state(NewComplaint.description)
 
@@ -153,6 +247,10 @@ async def process_description(message: types.Message, state: FSMContext):
     await message.answer("📞 Оставьте номер для связи:", reply_markup=keyboards.get_phone_kb())
     await state.set_state(NewComplaint.phone)
 
+def geo_coords(data):
+    geo = data.get('geo')
+    return (geo['lat'], geo['lon']) if geo else None
+
 @router.message(NewComplaint.phone)
 async def process_phone(message: types.Message, state: FSMContext):
     phone = message.contact.phone_number if message.contact else message.text
@@ -162,6 +260,30 @@ async def process_phone(message: types.Message, state: FSMContext):
     extra = {}
     if 'extra_text' in data:
         extra['info'] = data['extra_text']
+    # Координаты числами — для карты и поиска рядом, строка location остается для дашборда
+    if data.get('geo'):
+        extra['geo'] = data['geo']
+
+    # Такая же проблема рядом уже заявлена — дописываем жителя в нее вместо новой заявки
+    if DEDUP_ENABLED and not categories.BY_KEY[data['cat_key']].simple:
+        duplicate_of = dedup.detector.find(data['category_name'], data['sub_category'], geo_coords(data), data['description'],
+                                           data.get('location'), data.get('extra_text'))
+        if duplicate_of:
+            username = f"@{message.from_user.username}" if message.from_user.username else "Anonymous"
+            text = f"Повторное обращение от {username}, тел. {phone}:\n{data['description']}"
+            if data.get('location'):
+                text += f"\n📍 {data['location']}"
+            if await database.save_user_message(duplicate_of, text, data.get('photos', [])):
+                await message.answer("✅ <b>Об этой проблеме уже сообщили.</b>\nМы добавили ваше обращение к существующей заявке — так ее решат быстрее.",
+                                     reply_markup=keyboards.get_main_menu(), parse_mode="HTML")
+                await state.clear()
+                return
+
+    # Квота проверяется и здесь: мастер мог начаться со старой клавиатуры категорий, минуя «Новую заявку»
+    if throttling.quota.exceeded(message.from_user.id):
+        await message.answer(throttling.quota.message(), reply_markup=keyboards.get_main_menu())
+        await state.clear()
+        return
 
     # Запись в БД
     res = await database.create_complaint(
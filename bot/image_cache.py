@@ -0,0 +1,279 @@
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from aiohttp import web
+from config import IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, IMAGE_MEMORY_CACHE_MAX_BYTES, IMAGE_MEMORY_ITEM_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# file_id в Telegram неизменяем: содержимое по нему никогда не меняется
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+class FetchCancelled(Exception):
+    """Запрос, который качал картинку, отменили — ожидавшие его качают сами"""
+    pass
+
+class CachedImage:
+    """
+    Результат поиска в кэше: байты из памяти или уже открытый файл на диске.
+    Файл открывается при поиске: вытеснение может удалить его до отправки, но открытый дескриптор
+    остается читаемым. Закрывает его send_image (или вызывающий — close()).
+    """
+    def __init__(self, size, data=None, file=None):
+        self.size = size
+        self.data = data
+        self.file = file
+
+    def read(self):
+        """Все содержимое (блокирующее чтение для файла — вызывать в потоке)"""
+        if self.data is not None:
+            return self.data
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class ImageCache:
+    """
+    Двухуровневый кэш фото по file_id:
+    - LRU в памяти для горячих миниатюр;
+    - каталог на диске с ограничением по объему и вытеснением самых старых.
+    Одновременные промахи по одному ключу объединяются в одно скачивание.
+    """
+    def __init__(self, directory, disk_max_bytes, memory_max_bytes, memory_item_max_bytes):
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self.memory_item_max_bytes = memory_item_max_bytes
+
+        self._memory = OrderedDict()  # key -> bytes
+        self._memory_bytes = 0
+        self._disk = None  # OrderedDict: имя файла -> размер (в порядке обращения)
+        self._disk_bytes = 0
+        self._inflight = {}  # key -> Future
+        self.stats = {
+            "memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0,
+            "bytes_served": 0, "bytes_downloaded": 0, "evictions": 0,
+        }
+
+    def _name(self, key):
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name[:2], name)
+
+    def _scan_disk(self):
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                st = os.stat(os.path.join(root, name))
+                files.append((st.st_mtime, name, st.st_size))
+        files.sort()
+        return OrderedDict((name, size) for _, name, size in files)
+
+    async def warm_up(self):
+        """Построить индекс дискового кэша заранее, а не на первом запросе"""
+        await self._ensure_index()
+
+    async def _ensure_index(self):
+        if self._disk is None:
+            disk = await asyncio.to_thread(self._scan_disk)
+            if self._disk is None:
+                self._disk = disk
+                self._disk_bytes = sum(disk.values())
+                logger.info(f"Image cache: {len(disk)} files, {self._disk_bytes} bytes on disk")
+
+    def _remember(self, key, data):
+        if len(data) > self.memory_item_max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _write_file(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _remove_files(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # Windows: файл еще открыт на отдачу; останется на диске до следующего сканирования
+                logger.warning(f"Image cache: cannot remove {path}: {e}")
+
+    async def _store(self, name, data):
+        await asyncio.to_thread(self._write_file, self._path(name), data)
+        self._disk_bytes -= self._disk.pop(name, 0)
+        self._disk[name] = len(data)
+        self._disk_bytes += len(data)
+
+        evicted = []
+        while self._disk_bytes > self.disk_max_bytes and len(self._disk) > 1:
+            old_name, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            evicted.append(self._path(old_name))
+        if evicted:
+            self.stats["evictions"] += len(evicted)
+            await asyncio.to_thread(self._remove_files, evicted)
+
+    async def get(self, key, fetch):
+        """Возвращает CachedImage; при промахе вызывает fetch() -> bytes (один раз на ключ)"""
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return CachedImage(len(data), data=data)
+
+        await self._ensure_index()
+        name = self._name(key)
+        size = self._disk.get(name)
+        if size is not None:
+            path = self._path(name)
+            self._disk.move_to_end(name)
+            try:
+                if size <= self.memory_item_max_bytes:
+                    data = await asyncio.to_thread(_read_file, path)
+                else:
+                    f = await asyncio.to_thread(open, path, "rb")
+            except FileNotFoundError:
+                # Файл удалили снаружи — считаем промахом
+                self._disk_bytes -= self._disk.pop(name, 0)
+            else:
+                self.stats["disk_hits"] += 1
+                if size > self.memory_item_max_bytes:
+                    return CachedImage(size, file=f)
+                self._remember(key, data)
+                return CachedImage(len(data), data=data)
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+            try:
+                data = await asyncio.shield(future)
+            except FetchCancelled:
+                return await self.get(key, fetch)
+            return CachedImage(len(data), data=data)
+
+        self.stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            data = await fetch()
+            self.stats["bytes_downloaded"] += len(data)
+            await self._store(name, data)
+            self._remember(key, data)
+            future.set_result(data)
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже отдано ожидающим; помечаем как полученное, чтобы не было warning
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+            if not future.done():
+                # Отмена (CancelledError — не Exception): ожидающие не должны зависнуть
+                future.set_exception(FetchCancelled())
+                future.exception()
+        return CachedImage(len(data), data=data)
+
+    def snapshot(self):
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"] + self.stats["coalesced"]
+        return {
+            **self.stats,
+            "hit_rate": round(hits / total, 4) if total else None,
+            "memory_items": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_items": len(self._disk or ()),
+            "disk_bytes": self._disk_bytes,
+        }
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def etag_for(key):
+    return '"' + hashlib.sha1(key.encode()).hexdigest()[:20] + '"'
+
+def is_not_modified(request, etag):
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [t.strip() for t in header.split(",")]
+
+async def send_image(request, image, etag, content_type, extra_headers=None):
+    """Отдает изображение чанками с ETag/Cache-Control и поддержкой Range; файл image закрывает"""
+    try:
+        return await _send_image(request, image, etag, content_type, extra_headers)
+    finally:
+        image.close()
+
+async def _send_image(request, image, etag, content_type, extra_headers):
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes", **(extra_headers or {})}
+    if is_not_modified(request, etag):
+        return web.Response(status=304, headers=headers)
+
+    start, end, status = 0, image.size, 200
+    if "Range" in request.headers:
+        try:
+            rng = request.http_range
+        except ValueError:
+            rng = None
+        if rng is not None and (rng.start is not None or rng.stop is not None):
+            if rng.start is None:
+                start = 0
+            elif rng.start < 0:
+                start = max(image.size + rng.start, 0)
+            else:
+                start = rng.start
+            end = min(rng.stop, image.size) if rng.stop is not None else image.size
+            if start >= image.size or start >= end:
+                headers["Content-Range"] = f"bytes */{image.size}"
+                return web.Response(status=416, headers=headers)
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{image.size}"
+
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_type = content_type
+    response.content_length = end - start
+    await response.prepare(request)
+
+    if image.data is not None:
+        view = memoryview(image.data)
+        for offset in range(start, end, CHUNK_SIZE):
+            await response.write(view[offset:min(offset + CHUNK_SIZE, end)])
+    else:
+        await asyncio.to_thread(image.file.seek, start)
+        left = end - start
+        while left > 0:
+            chunk = await asyncio.to_thread(image.file.read, min(CHUNK_SIZE, left))
+            if not chunk:
+                break
+            left -= len(chunk)
+            await response.write(chunk)
+
+    cache.stats["bytes_served"] += end - start
+    await response.write_eof()
+    return response
+
+cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, IMAGE_MEMORY_CACHE_MAX_BYTES, IMAGE_MEMORY_ITEM_MAX_BYTES)
@@ -1,40 +1,57 @@
+from types import MappingProxyType
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from config import CATEGORIES
+import categories
 
-def get_main_menu():
-    return ReplyKeyboardMarkup(keyboard=[
-        [KeyboardButton(text="📝 Новая заявка"), KeyboardButton(text="📂 Мои заявки")]
-    ], resize_keyboard=True)
+# Клавиатуры строятся один раз при импорте: объекты aiogram неизменяемы, их можно переиспользовать
 
-def get_categories_kb():
-    buttons = []
-    for key, val in CATEGORIES.items():
-        buttons.append(InlineKeyboardButton(text=f"{val['emoji']} {val['name']}", callback_data=f"cat_{key}"))
-    
+MAIN_MENU = ReplyKeyboardMarkup(keyboard=[
+    [KeyboardButton(text="📝 Новая заявка"), KeyboardButton(text="📂 Мои заявки")]
+], resize_keyboard=True)
+
+def _build_categories_kb():
+    buttons = [InlineKeyboardButton(text=f"{cat.emoji} {cat.name}", callback_data=cat.callback) for cat in categories.ALL]
     # Разбиваем на 2 колонки
     rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
-def get_subcategories_kb(cat_key):
-    cat = CATEGORIES.get(cat_key)
-    if not cat: return None
-    
-    buttons = [[InlineKeyboardButton(text=sub, callback_data=f"sub_{i}")] for i, sub in enumerate(cat['subs'])]
+def _build_subcategories_kb(cat):
+    buttons = [[InlineKeyboardButton(text=sub, callback_data=code)] for sub, code in zip(cat.subs, cat.sub_callbacks)]
     buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_cats")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+CATEGORIES_KB = _build_categories_kb()
+SUBCATEGORIES_KB = MappingProxyType({cat.key: _build_subcategories_kb(cat) for cat in categories.ALL})
+
+SKIP_KB = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Пропустить")]], resize_keyboard=True)
+
+_GEO_BUTTON = KeyboardButton(text="📍 Отправить геопозицию", request_location=True)
+GEO_KB_REQUIRED = ReplyKeyboardMarkup(keyboard=[[_GEO_BUTTON]], resize_keyboard=True)
+GEO_KB_OPTIONAL = ReplyKeyboardMarkup(keyboard=[[_GEO_BUTTON], [KeyboardButton(text="Пропустить")]], resize_keyboard=True)
+
+PHONE_KB = ReplyKeyboardMarkup(keyboard=[
+    [KeyboardButton(text="📱 Отправить мой номер", request_contact=True)],
+    [KeyboardButton(text="Пропустить")]
+], resize_keyboard=True)
+
+def get_main_menu():
+    return MAIN_MENU
+
+def get_categories_kb():
+    return CATEGORIES_KB
+
+def get_subcategories_kb(cat_key):
+    return SUBCATEGORIES_KB.get(cat_key)
+
 def get_skip_kb():
-    return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Пропустить")]], resize_keyboard=True)
+    return SKIP_KB
 
 def get_geo_kb(required=False):
-    row = [KeyboardButton(text="📍 Отправить геопозицию", request_location=True)]
-    keyboard = [row]
-    if not required:
-        keyboard.append([KeyboardButton(text="Пропустить")])
-    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
+    return GEO_KB_REQUIRED if required else GEO_KB_OPTIONAL
 
 def get_phone_kb():
-    return ReplyKeyboardMarkup(keyboard=[
-        [KeyboardButton(text="📱 Отправить мой номер", request_contact=True)],
-        [KeyboardButton(text="Пропустить")]
-    ], resize_keyboard=True)
+    return PHONE_KB
+
+def get_history_kb(cursor):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⬇️ Показать еще", callback_data=f"hist:{cursor}")]
+    ])
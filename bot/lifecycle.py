@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+# Пауза между попытками фонового прогрева
+RETRY_INTERVAL = 60
+
+class Health:
+    """
+    Состояние процесса для проб:
+    live — event loop жив и отвечает; ready — прогрев закончен, не идет остановка и критичные зависимости доступны.
+    """
+    def __init__(self, critical=()):
+        self.critical = set(critical)
+        self.started = False
+        self.draining = False
+        self.checks = {}  # имя -> {"ok", "detail", "checked_at"}
+
+    def set(self, name, ok, detail=None):
+        previous = self.checks.get(name, {}).get("ok")
+        self.checks[name] = {"ok": ok, "detail": detail, "checked_at": time.time()}
+        if previous is not None and previous != ok:
+            log = logger.info if ok else logger.warning
+            log(f"Health check '{name}' is now {'ok' if ok else 'failing'}{f': {detail}' if detail else ''}")
+
+    @property
+    def ready(self):
+        if not self.started or self.draining:
+            return False
+        return all(self.checks.get(name, {}).get("ok") for name in self.critical)
+
+    def snapshot(self):
+        return {"ready": self.ready, "started": self.started, "draining": self.draining, "checks": self.checks}
+
+async def warm_up(steps, timeout):
+    """
+    Параллельный прогрев: steps — {имя: корутина}. Возвращает {имя: исключение или None}.
+    Общее время — время самого медленного шага, а не сумма.
+    """
+    async def run(name, coro):
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(coro, timeout)
+            logger.info(f"Warm-up '{name}' done in {time.perf_counter() - start:.2f}s")
+            return None
+        except Exception as e:
+            logger.error(f"Warm-up '{name}' failed after {time.perf_counter() - start:.2f}s: {e!r}")
+            return e
+    results = await asyncio.gather(*(run(name, coro) for name, coro in steps.items()))
+    return dict(zip(steps, results))
+
+async def background(name, factory, retry_interval=RETRY_INTERVAL):
+    """
+    Долгий прогрев (индексы в памяти) вне readiness: factory() дает новую корутину на каждую попытку,
+    ошибка не останавливает процесс, а повторяется через retry_interval. Запускать через create_task.
+    """
+    while True:
+        start = time.perf_counter()
+        try:
+            await factory()
+            logger.info(f"Warm-up '{name}' done in {time.perf_counter() - start:.2f}s")
+            return
+        except Exception as e:
+            logger.error(f"Warm-up '{name}' failed after {time.perf_counter() - start:.2f}s, retrying in {retry_interval}s: {e!r}")
+        await asyncio.sleep(retry_interval)
+
+async def monitor(health, checks, interval):
+    """Периодически проверяет зависимости: checks — {имя: async-функция без аргументов}"""
+    async def run(name, check):
+        try:
+            await asyncio.wait_for(check(), interval)
+            health.set(name, True)
+        except Exception as e:
+            health.set(name, False, repr(e))
+    while True:
+        await asyncio.gather(*(run(name, check) for name, check in checks.items()))
+        await asyncio.sleep(interval)
+
+def install_signal_handlers(stop):
+    """SIGTERM/SIGINT -> stop.set(): остановку ведет main, а не KeyboardInterrupt посреди обработки"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остается KeyboardInterrupt
+            pass
+
+async def wait_until(predicate, timeout, interval=0.05):
+    """Ждет predicate() не дольше timeout; True, если дождались"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+async def step(name, coro, timeout):
+    """Шаг остановки: ошибка или таймаут одного шага не мешают остальным"""
+    try:
+        await asyncio.wait_for(coro, timeout)
+    except Exception as e:
+        logger.error(f"Shutdown step '{name}' failed: {e!r}")
@@ -1,94 +1,328 @@
 import asyncio
+import datetime
+import hmac
+import json
 import logging
-import os
 import sys
+import time
 from aiohttp import web
 from aiogram import Bot, Dispatcher, types
-from config import BOT_TOKEN, PORT
+from aiogram.exceptions import TelegramRetryAfter
+from config import (BOT_TOKEN, PORT, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET,
+                    UPDATE_WORKERS, UPDATE_QUEUE_SIZE, UPDATE_ENQUEUE_TIMEOUT,
+                    UPLOAD_MAX_BYTES, UPLOAD_SPOOL_BYTES, UPLOAD_MAX_FILES,
+                    DELIVERY_ENABLED, DELIVERY_REALTIME, DELIVERY_BATCH_SIZE, DELIVERY_POLL_INTERVAL,
+                    DELIVERY_CONCURRENCY, DELIVERY_LEASE, PROFILER_ENABLED, PROFILER_INTERVAL,
+                    GEO_REFRESH_INTERVAL, GEO_POINTS_ZOOM, STATS_UTC_OFFSET,
+                    EXPORT_PAGE_SIZE, EXPORT_TOKEN,
+                    STARTUP_TIMEOUT, SHUTDOWN_TIMEOUT, HEALTH_CHECK_INTERVAL,
+                    CHANGES_BUFFER, CHANGES_COALESCE, CHANGES_HEARTBEAT,
+                    THROTTLE_ENABLED, THROTTLE_RULES, THROTTLE_MAX_KEYS, THROTTLE_DEFER_MAX,
+                    SLA_ENABLED, SLA_LEADER, SLA_RULES, OPERATOR_CHAT_ID, SLA_NOTIFY_CITIZENS, SLA_NOTIFY_DELAY)
 import handlers
 import database
+import image_cache
+import webhook
+import storage
+import outbox
+import categories
+import uploads
+import delivery
+import sender
+import metrics
+import geo
+import dedup
+import analytics
+import export
+import thumbnails
+import lifecycle
+import search
+import changes
+import throttling
+import sla
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-if not BOT_TOKEN:
-    logger.error("BOT_TOKEN is missing!")
-    sys.exit(1)
+# Импорт модуля ничего не подключает и не завершает процесс: клиенты создаются в main()
+BOT = web.AppKey("bot", Bot)
+HEALTH = web.AppKey("health", lifecycle.Health)
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-dp.include_router(handlers.router)
+profiler = metrics.SamplingProfiler(PROFILER_INTERVAL)
+geo_service = geo.GeoService(GEO_REFRESH_INTERVAL, GEO_POINTS_ZOOM)
+rollups = analytics.Rollups(STATS_UTC_OFFSET)
+search_service = search.SearchService()
+change_feed = changes.ChangeFeed(CHANGES_BUFFER)
+throttle = throttling.ThrottleMiddleware(
+    throttling.parse_rules(THROTTLE_RULES), THROTTLE_MAX_KEYS, THROTTLE_DEFER_MAX, throttling.quota,
+)
 
-# --- CORS MIDDLEWARE ---
+metrics.register_stats("image_cache", image_cache.cache.snapshot)
+metrics.register_stats("sender", sender.scheduler.snapshot)
+metrics.register_stats("outbox", outbox.journal.snapshot)
+metrics.register_stats("geo", geo_service.snapshot)
+metrics.register_stats("dedup", dedup.detector.snapshot)
+metrics.register_stats("analytics", rollups.snapshot)
+metrics.register_stats("search", search_service.snapshot)
+metrics.register_stats("changes", change_feed.snapshot)
+metrics.register_stats("throttle", throttle.snapshot)
+
+def create_bot():
+    bot = Bot(token=BOT_TOKEN)
+    # Все исходящие вызовы Bot API идут через общий планировщик с лимитами и повторами;
+    # замер времени — внутри планировщика, чтобы мерить сам Telegram, а не очередь
+    bot.session.middleware(sender.scheduler)
+    bot.session.middleware(metrics.TelegramTimingMiddleware())
+    return bot
+
+def create_dispatcher():
+    # FSM-middleware регистрируем сами, после антифлуда: отброшенный апдейт не читает состояние из хранилища
+    dp = Dispatcher(storage=storage.build_storage(), disable_fsm=True)
+    if THROTTLE_ENABLED:
+        dp.update.outer_middleware(throttle)
+    dp.update.outer_middleware(dp.fsm)
+    handlers.router.message.middleware(metrics.HandlerTimingMiddleware())
+    handlers.router.callback_query.middleware(metrics.HandlerTimingMiddleware())
+    dp.include_router(handlers.router)
+    return dp
+
+# --- TIMING / CORS MIDDLEWARE ---
 @web.middleware
-async def cors_middleware(request, handler):
-    if request.method == "OPTIONS":
-        response = web.Response(status=200)
-    else:
-        try:
-            response = await handler(request)
-        except Exception as e:
-            logger.error(f"Handler Error: {e}")
-            response = web.Response(status=500, text=str(e))
-            
+async def timing_middleware(request, handler):
+    """CORS preflight, перехват ошибок и гистограмма времени ответа по маршруту"""
+    start = time.perf_counter()
+    status = 500
+    try:
+        if request.method == "OPTIONS":
+            response = web.Response(status=200)
+        else:
+            try:
+                response = await handler(request)
+            except web.HTTPException as e:
+                status = e.status
+                raise
+            except Exception as e:
+                logger.error(f"Handler Error: {e}")
+                response = web.Response(status=500, text=str(e))
+        status = response.status
+        return response
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        metrics.HTTP_LATENCY.observe(time.perf_counter() - start, route=route, method=request.method, status=status)
+
+async def add_cors_headers(request, response):
+    """Заголовки ставим перед отправкой, чтобы они попадали и в стриминговые ответы"""
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'POST, GET, OPTIONS'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-    return response
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Range, If-None-Match, Authorization'
+    response.headers['Access-Control-Expose-Headers'] = 'ETag, Content-Length, Content-Range, Content-Disposition'
 
 # --- PROXY & API LOGIC ---
 async def handle_health(request):
+    """Liveness: процесс и event loop отвечают"""
     return web.Response(text="OK")
 
+async def handle_ready(request):
+    """Readiness: прогрев закончен, нет остановки, база и Telegram доступны"""
+    health = request.app[HEALTH]
+    return web.json_response(health.snapshot(), status=200 if health.ready else 503)
+
+async def download_telegram_file(bot, file_id):
+    file = await bot.get_file(file_id)
+    # Получаем поток байтов
+    file_bytes = await bot.download_file(file.file_path)
+
+    # Читаем данные
+    if hasattr(file_bytes, 'read'):
+        return file_bytes.read()
+    return file_bytes
+
 async def handle_image_proxy(request):
     """
-    GET /images/{file_id}
-    Скачивает файл из Telegram и стримит его в ответ.
+    GET /images/{file_id}[?size=256&format=webp|jpeg|auto]
+    Отдает фото из кэша (память -> диск), при промахе скачивает из Telegram.
+    С size — уменьшенная копия (генерируется в пуле процессов и кэшируется).
+    Поддерживает ETag/304 и Range.
     """
     file_id = request.match_info.get('file_id')
     if not file_id:
         return web.Response(status=404, text="No file_id")
-    
+
+    variant = None
+    if 'size' in request.query:
+        try:
+            size = thumbnails.pick_size(int(request.query['size']))
+        except ValueError:
+            return web.Response(status=400, text="size must be an integer")
+        fmt = thumbnails.pick_format(request.query.get('format', 'auto'), request.headers.get('Accept'))
+        variant = (size, fmt)
+
+    key = f"{file_id}:{variant[0]}.{variant[1]}" if variant else file_id
+    etag = image_cache.etag_for(key)
+    # При format=auto ответ зависит от Accept — кэши не должны отдавать WebP тем, кто его не понимает
+    extra = {"Vary": "Accept"} if variant and request.query.get('format', 'auto') == 'auto' else None
+    if image_cache.is_not_modified(request, etag):
+        return web.Response(status=304, headers={"ETag": etag, "Cache-Control": image_cache.CACHE_CONTROL, **(extra or {})})
+
+    bot = request.app[BOT]
+    fetch = lambda: download_telegram_file(bot, file_id)
     try:
-        file = await bot.get_file(file_id)
-        # Получаем поток байтов
-        file_bytes = await bot.download_file(file.file_path)
-        
-        # Читаем данные
-        if hasattr(file_bytes, 'read'):
-            data = file_bytes.read()
+        if variant:
+            try:
+                image = await thumbnails.get_variant(file_id, variant[0], variant[1], fetch)
+                content_type = thumbnails.CONTENT_TYPES[variant[1]]
+            except Exception as e:
+                # Не получилось уменьшить (не картинка, битый файл) — отдаем оригинал
+                logger.warning(f"Thumbnail {key} failed, serving original: {e}")
+                image, content_type = await image_cache.cache.get(file_id, fetch), "image/jpeg"
+                etag = image_cache.etag_for(file_id)
         else:
-            data = file_bytes 
-            
-        return web.Response(body=data, content_type="image/jpeg")
+            image, content_type = await image_cache.cache.get(file_id, fetch), "image/jpeg"
     except Exception as e:
         logger.error(f"Proxy Error: {e}")
         return web.Response(status=500, text="Image proxy error")
+    return await image_cache.send_image(request, image, etag, content_type, extra)
+
+async def handle_image_stats(request):
+    """GET /api/images/stats — счетчики попаданий/промахов кэша фото"""
+    return web.json_response(image_cache.cache.snapshot())
+
+async def handle_sender_stats(request):
+    """GET /api/sender/stats — глубина очереди отправки, ожидание и повторы"""
+    return web.json_response(sender.scheduler.snapshot())
+
+async def handle_map(request):
+    """
+    GET /api/map?bbox=min_lon,min_lat,max_lon,max_lat&zoom=12
+    Кластеры и точки открытых заявок в окне карты из индекса в памяти.
+    """
+    try:
+        bbox = [float(v) for v in request.query['bbox'].split(',')]
+        zoom = int(request.query.get('zoom', 12))
+        if len(bbox) != 4:
+            raise ValueError("bbox must have 4 numbers")
+    except (KeyError, ValueError) as e:
+        return web.Response(status=400, text=f"Bad bbox/zoom: {e}")
+    if not geo_service.ready:
+        return web.Response(status=503, headers={"Retry-After": "5"}, text="Map index is warming up")
+    return web.json_response(geo_service.query(bbox, zoom))
+
+async def handle_stats(request):
+    """
+    GET /api/stats?since=YYYY-MM-DD
+    Свертки для аналитики (по категориям, статусам, дням, часам, время первого ответа) из памяти.
+    """
+    since = request.query.get('since') or None
+    if since:
+        try:
+            since = datetime.date.fromisoformat(since).isoformat()
+        except ValueError:
+            return web.Response(status=400, text="since must be YYYY-MM-DD")
+    if not rollups.ready:
+        return web.Response(status=503, headers={"Retry-After": "5"}, text="Analytics are warming up")
+    return web.Response(body=rollups.render(since), content_type="application/json")
+
+async def handle_search(request):
+    """
+    GET /api/search?q=ленина 15&status=new,in_work&category=&include_deleted=0&offset=0&limit=20
+    Поиск по описанию, адресу и госномеру (префикс, кириллица и латиница) по индексу в памяти; телефоны не ищутся.
+    """
+    query = request.query.get('q', '').strip()
+    if not query:
+        return web.Response(status=400, text="q is required")
+    try:
+        offset = max(int(request.query.get('offset', 0)), 0)
+        limit = min(max(int(request.query.get('limit', 20)), 1), 100)
+    except ValueError:
+        return web.Response(status=400, text="offset/limit must be integers")
+    if not search_service.ready:
+        return web.Response(status=503, headers={"Retry-After": "5"}, text="Search index is warming up")
+    return web.json_response(search_service.search(
+        query, offset=offset, limit=limit,
+        statuses={s for s in request.query.get('status', '').split(',') if s},
+        categories={c for c in request.query.get('category', '').split(',') if c},
+        include_deleted=request.query.get('include_deleted') == '1',
+    ))
+
+async def handle_changes(request):
+    """
+    GET /api/changes?since=<cursor>
+    Дельты заявок и сообщений после курсора (по одной на строку). reset=true — курсор устарел, перечитайте все.
+    """
+    try:
+        return web.json_response(change_feed.since(request.query.get('since')), dumps=lambda d: json.dumps(d, ensure_ascii=False, default=str))
+    except changes.CursorError as e:
+        return web.Response(status=400, text=str(e))
+
+async def handle_changes_stream(request):
+    """GET /api/changes/stream?since=<cursor> — то же самое потоком SSE; EventSource сам передает Last-Event-ID"""
+    cursor = request.headers.get('Last-Event-ID') or request.query.get('since')
+    try:
+        change_feed.since(cursor)
+    except changes.CursorError as e:
+        return web.Response(status=400, text=str(e))
+    return await change_feed.stream(request, cursor, CHANGES_COALESCE, CHANGES_HEARTBEAT)
+
+async def handle_export(request):
+    """
+    GET /api/export?table=complaints|ticket_messages&format=ndjson|csv|columnar&from=&to=&category=&status=
+    Потоковая выгрузка с keyset-пагинацией; память не зависит от числа строк.
+    Требует заголовок Authorization: Bearer <EXPORT_TOKEN>.
+    """
+    # Выгрузка отдает персональные данные: без настроенного токена она выключена
+    if not EXPORT_TOKEN:
+        return web.Response(status=403, text="Export is disabled: EXPORT_TOKEN is not set")
+    # Только заголовок: токен в query оседает в логах прокси и истории браузера
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    # compare_digest на str не принимает не-ASCII — сравниваем байты
+    if not hmac.compare_digest(supplied.encode(), EXPORT_TOKEN.encode()):
+        return web.Response(status=401, text="Invalid export token")
+    table = request.query.get('table', 'complaints')
+    fmt = request.query.get('format', 'ndjson')
+    if fmt not in export.FORMATS:
+        return web.Response(status=400, text=f"format must be one of: {', '.join(export.FORMATS)}")
+    try:
+        where = export.parse_filters(table, request.query, STATS_UTC_OFFSET)
+    except export.ExportError as e:
+        return web.Response(status=400, text=str(e))
+    return await export.stream(request, table, fmt, where, EXPORT_PAGE_SIZE)
+
+async def handle_metrics(request):
+    """GET /metrics — метрики в текстовом формате Prometheus"""
+    return web.Response(text=metrics.render(), content_type="text/plain", headers={"X-Content-Type-Options": "nosniff"})
+
+async def handle_profile(request):
+    """
+    GET /debug/profile?seconds=10 — семплирующий профиль главного потока (collapsed stacks).
+    Доступен только при PROFILER_ENABLED=1.
+    """
+    if not PROFILER_ENABLED:
+        return web.Response(status=404, text="Profiler disabled")
+    if profiler.running:
+        return web.Response(status=409, text="Profiler already running")
+    seconds = min(float(request.query.get("seconds", 10)), 120)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stacks = profiler.stop()
+    return web.Response(text=stacks, content_type="text/plain")
 
 async def handle_reply_api(request):
     """
     POST /api/reply
-    Принимает multipart/form-data: ticket_id, text, file (опционально)
+    Принимает multipart/form-data: ticket_id, text, file (опционально, можно несколько)
     1. Находит user_id по ticket_id
-    2. Отправляет сообщение (и фото) пользователю в Telegram
+    2. Отправляет сообщение (и фото) пользователю в Telegram; несколько фото — одним альбомом
     3. Сохраняет file_id и сообщение в БД
     """
     try:
-        reader = await request.multipart()
-        data = {}
-        file_data = None
-        filename = "image.jpg"
-        
-        while True:
-            part = await reader.next()
-            if part is None: break
-            if part.name == 'file':
-                file_data = await part.read()
-                filename = part.filename or "image.jpg"
-            else:
-                text = await part.read(decode=True)
-                data[part.name] = text.decode('utf-8')
-        
+        data, files = await uploads.read_reply_form(request, UPLOAD_MAX_BYTES, UPLOAD_SPOOL_BYTES, UPLOAD_MAX_FILES)
+    except uploads.UploadTooLarge as e:
+        return web.Response(status=413, text=str(e))
+
+    try:
         ticket_id = data.get('ticket_id')
         text = data.get('text', '')
         
@@ -99,51 +333,212 @@ async def handle_reply_api(request):
         if not user_id:
             return web.Response(status=404, text="User not found for ticket")
         
-        file_ids = []
-        # Если есть файл, шлем как фото
-        if file_data:
-            input_file = types.BufferedInputFile(file_data, filename=filename)
-            # Отправляем фото с подписью (или без, если текст длинный)
-            caption = text[:1000] if text else None
-            msg = await bot.send_photo(chat_id=user_id, photo=input_file, caption=caption)
-            file_ids.append(msg.photo[-1].file_id)
-            # Если текст был использован как капшн, обнуляем его, чтобы не дублировать
-            if caption:
-                text = "" 
-        
-        # Если остался текст (или файла не было)
-        if text:
-            await bot.send_message(chat_id=user_id, text=text)
+        # Ответы операторов — массовый трафик, интерактивные ответы мастера идут вперед
+        with sender.bulk():
+            file_ids = await send_operator_reply(request.app[BOT], user_id, text, files)
             
         # Сохраняем в БД
         await database.save_operator_message(ticket_id, data.get('text', ''), file_ids)
         
         return web.Response(text="OK")
         
+    except TelegramRetryAfter as e:
+        logger.warning(f"Reply API rate limited: retry after {e.retry_after}s")
+        return web.Response(status=503, headers={"Retry-After": str(e.retry_after)}, text="Telegram rate limit, retry later")
     except Exception as e:
         logger.error(f"Reply API Error: {e}")
         return web.Response(status=500, text=str(e))
+    finally:
+        uploads.close_files(files)
+
+async def send_operator_reply(bot, user_id, text, files):
+    """Отправляет ответ оператора в Telegram; возвращает file_id отправленных фото"""
+    file_ids = []
+    # Подпись (или без нее, если текст длинный) ставим к первому фото
+    caption = text[:1000] if text and files else None
+    if len(files) == 1:
+        filename, spool = files[0]
+        msg = await bot.send_photo(chat_id=user_id, photo=uploads.SpooledInputFile(spool, filename), caption=caption)
+        file_ids.append(msg.photo[-1].file_id)
+    elif files:
+        media = [
+            types.InputMediaPhoto(media=uploads.SpooledInputFile(spool, filename), caption=caption if i == 0 else None)
+            for i, (filename, spool) in enumerate(files)
+        ]
+        messages = await bot.send_media_group(chat_id=user_id, media=media)
+        file_ids.extend(m.photo[-1].file_id for m in messages if m.photo)
+    # Если текст был использован как капшн, обнуляем его, чтобы не дублировать
+    if caption:
+        text = ""
+    
+    # Если остался текст (или файла не было)
+    if text:
+        await bot.send_message(chat_id=user_id, text=text)
+    return file_ids
 
-async def start_web_server():
-    app = web.Application(middlewares=[cors_middleware])
+def build_web_app(bot, health, update_queue=None):
+    app = web.Application(middlewares=[timing_middleware])
+    app[BOT] = bot
+    app[HEALTH] = health
+    app.on_response_prepare.append(add_cors_headers)
     app.router.add_get('/', handle_health)
     app.router.add_get('/health', handle_health)
+    app.router.add_get('/health/live', handle_health)
+    app.router.add_get('/health/ready', handle_ready)
     app.router.add_get('/images/{file_id}', handle_image_proxy)
+    app.router.add_get('/api/images/stats', handle_image_stats)
+    app.router.add_get('/api/sender/stats', handle_sender_stats)
+    app.router.add_get('/api/map', handle_map)
+    app.router.add_get('/api/stats', handle_stats)
+    app.router.add_get('/api/search', handle_search)
+    app.router.add_get('/api/export', handle_export)
+    app.router.add_get('/api/changes', handle_changes)
+    app.router.add_get('/api/changes/stream', handle_changes_stream)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/debug/profile', handle_profile)
     app.router.add_post('/api/reply', handle_reply_api)
-    
+    if update_queue:
+        app.router.add_post(WEBHOOK_PATH, webhook.make_handler(update_queue, WEBHOOK_SECRET, UPDATE_ENQUEUE_TIMEOUT))
+    return app
+
+async def start_web_server(app):
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', PORT)
     await site.start()
     logger.info(f"🌍 Web Server running on port {PORT}")
+    return runner
 
 async def main():
-    await start_web_server()
-    logger.info("🚀 Bot started polling...")
-    await dp.start_polling(bot)
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN is missing!")
+        return 1
+    categories.validate_against_frontend()
+
+    stop = asyncio.Event()
+    lifecycle.install_signal_handlers(stop)
+    health = lifecycle.Health(critical=("database", "telegram"))
+    bot = create_bot()
+    dp = create_dispatcher()
+    delivery_engine = delivery.DeliveryEngine(bot, DELIVERY_BATCH_SIZE, DELIVERY_POLL_INTERVAL, DELIVERY_CONCURRENCY, DELIVERY_LEASE)
+    metrics.register_stats("delivery", lambda: delivery_engine.stats)
+    sla_engine = sla.SLAEngine(bot, sla.parse_rules(SLA_RULES), OPERATOR_CHAT_ID, SLA_NOTIFY_CITIZENS, SLA_NOTIFY_DELAY)
+    metrics.register_stats("sla", sla_engine.snapshot)
+
+    update_queue = None
+    if WEBHOOK_URL:
+        # Апдейты приходят POST-запросами на тот же web-сервер и разбираются пулом воркеров
+        update_queue = webhook.UpdateQueue(dp, bot, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+        update_queue.start()
+        metrics.register_stats("updates", lambda: {"queue_depth": update_queue.depth()})
+
+    # Сервер поднимается первым: liveness отвечает сразу, readiness — после прогрева
+    runner = await start_web_server(build_web_app(bot, health, update_queue))
+    tasks = [asyncio.create_task(metrics.monitor_loop_lag(), name="loop-lag")]
+    polling = None
+    try:
+        # Readiness ждет только быстрые проверки; независимые подключения проверяются параллельно
+        results = await lifecycle.warm_up({
+            "outbox": outbox.journal.start(),  # неотправленные записи прошлого запуска
+            "database": database.ping(),
+            "telegram": bot.get_me(),
+        }, timeout=STARTUP_TIMEOUT)
+        # Индексы в памяти строятся в фоне с повторами; до готовности их эндпоинты отвечают 503
+        for name, factory in {
+            "image_cache": image_cache.cache.warm_up,
+            "dedup": dedup.warm_up,
+            "analytics": rollups.rebuild,
+            "search": search_service.rebuild,
+            "quota": throttling.quota.warm_up,
+        }.items():
+            tasks.append(asyncio.create_task(lifecycle.background(name, factory), name=f"warm-up-{name}"))
+        if results["outbox"] is not None:
+            raise RuntimeError(f"Outbox is unavailable: {results['outbox']!r}")
+        for name in ("database", "telegram"):
+            health.set(name, results[name] is None, repr(results[name]) if results[name] else None)
+
+        if DELIVERY_ENABLED:
+            delivery_engine.start(realtime=DELIVERY_REALTIME)
+        geo_service.start()
+        if SLA_ENABLED and SLA_LEADER:
+            sla_engine.start()
+        tasks.append(asyncio.create_task(lifecycle.monitor(health, {
+            "database": database.ping,
+            "telegram": bot.get_me,
+        }, HEALTH_CHECK_INTERVAL), name="health-monitor"))
+
+        if update_queue:
+            await dp.emit_startup(bot=bot)
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            logger.info(f"🚀 Bot started in webhook mode ({UPDATE_WORKERS} workers)...")
+        else:
+            polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False), name="polling")
+            logger.info("🚀 Bot started polling...")
+        health.started = True
+
+        waiters = [asyncio.create_task(stop.wait())] + ([polling] if polling else [])
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        waiters[0].cancel()
+        if polling and polling.done() and not polling.cancelled() and polling.exception():
+            logger.error(f"Polling stopped unexpectedly: {polling.exception()!r}")
+        logger.info("Shutting down...")
+    finally:
+        await shutdown(bot, dp, health, runner, update_queue, polling, delivery_engine, sla_engine, tasks)
+    return 0
+
+async def finish_handlers(dp):
+    await asyncio.gather(*list(dp._handle_update_tasks), return_exceptions=True)
+    await throttle.drain()
+    await handlers.album_collector.flush_all()
+
+async def shutdown(bot, dp, health, runner, update_queue, polling, delivery_engine, sla_engine, tasks):
+    """
+    Плавная остановка (SIGTERM при деплое): перестаем быть ready, перестаем брать апдейты,
+    дорабатываем принятые, дожидаемся очереди отправки, сбрасываем outbox и только потом закрываем соединения.
+    """
+    health.draining = True
+    change_feed.close()
+    # 1. Новые апдейты не принимаем: вебхук отвечает 503 (Telegram переотправит), polling останавливается
+    if update_queue:
+        update_queue.close()
+        await lifecycle.step("drain updates", update_queue.join(), SHUTDOWN_TIMEOUT)
+        await update_queue.stop()
+        await lifecycle.step("dispatcher shutdown", dp.emit_shutdown(bot=bot), SHUTDOWN_TIMEOUT)
+    elif polling and not polling.done():
+        await lifecycle.step("stop polling", dp.stop_polling(), SHUTDOWN_TIMEOUT)
+        await lifecycle.step("polling finished", asyncio.shield(polling), SHUTDOWN_TIMEOUT)
+    # Polling не ждет хендлеров, запущенных задачами, а альбомы ждут своего окна — дорабатываем их до закрытия ресурсов
+    await lifecycle.step("handlers", finish_handlers(dp), SHUTDOWN_TIMEOUT)
+
+    # 2. Фоновые задачи
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await delivery_engine.stop()
+    await geo_service.stop()
+    # Накопленные уведомления о статусах уходят в очередь отправки до ее дренажа
+    await lifecycle.step("sla", sla_engine.stop(), SHUTDOWN_TIMEOUT)
+
+    # 3. Доотправляем то, что уже стоит в очереди к Telegram
+    if not await lifecycle.wait_until(sender.scheduler.idle, SHUTDOWN_TIMEOUT):
+        logger.warning(f"Sender still busy after {SHUTDOWN_TIMEOUT}s, dropping {sender.scheduler.depth()} queued calls")
+    await sender.scheduler.stop()
+
+    # 4. Сбрасываем записи и закрываем соединения
+    await lifecycle.step("outbox", outbox.journal.stop(), SHUTDOWN_TIMEOUT)
+    await lifecycle.step("fsm storage", dp.storage.close(), SHUTDOWN_TIMEOUT)
+    thumbnails.shutdown()
+    await lifecycle.step("bot session", bot.session.close(), SHUTDOWN_TIMEOUT)
+    await lifecycle.step("database", database.close(), SHUTDOWN_TIMEOUT)
+    await runner.cleanup()
+    logger.info("Bot stopped")
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
-    except (KeyboardInterrupt, SystemExit):
+        sys.exit(asyncio.run(main()))
+    except KeyboardInterrupt:
         logger.info("Bot stopped")
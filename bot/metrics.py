@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import Counter as _StackCounter
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(n, "") for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, value in list(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, (counts, total, count) in list(self._values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _labels(self.labelnames, key, [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _labels(self.labelnames, key, ['le="+Inf"'])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+REGISTRY = []
+# Функции, которые обновляют gauge'и перед отдачей /metrics
+COLLECTORS = []
+
+def render():
+    for collect in COLLECTORS:
+        try:
+            collect()
+        except Exception as e:
+            logger.error(f"Metrics collector failed: {e}")
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+HTTP_LATENCY = Histogram("bot_http_request_seconds", "Latency of aiohttp handlers", ("route", "method", "status"))
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Latency of aiogram handlers (wizard steps)", ("handler", "state"))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Exceptions raised by aiogram handlers", ("handler",))
+DB_LATENCY = Histogram("bot_db_seconds", "Latency of database calls", ("op",))
+DB_ERRORS = Counter("bot_db_errors_total", "Failed database calls", ("op",))
+TELEGRAM_LATENCY = Histogram("bot_telegram_api_seconds", "Latency of Telegram Bot API calls", ("method",))
+TELEGRAM_ERRORS = Counter("bot_telegram_api_errors_total", "Failed Telegram Bot API calls", ("method", "error"))
+LOOP_LAG = Histogram("bot_event_loop_lag_seconds", "Event loop scheduling lag", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+COMPONENT_STATS = Gauge("bot_component_stat", "Internal counters of caches and queues", ("component", "stat"))
+
+def register_stats(component, snapshot):
+    """Выгружает числовые поля snapshot() компонента в bot_component_stat"""
+    def collect():
+        for stat, value in _flatten(snapshot()):
+            COMPONENT_STATS.set(value, component=component, stat=stat)
+    COLLECTORS.append(collect)
+
+def _flatten(data, prefix=""):
+    for key, value in data.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}_")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Inner-middleware роутера: время каждого хендлера (шага мастера заявки)"""
+    async def __call__(self, handler, event, data):
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        state = data.get("raw_state") or ""
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, handler=name, state=state)
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    """Request-middleware сессии: чистое время вызова Bot API (без ожидания в планировщике)"""
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - start, method=name)
+
+async def monitor_loop_lag(interval=0.5):
+    """Насколько позже запланированного просыпается задача — задержка event loop"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
+
+class SamplingProfiler:
+    """
+    Семплирующий профайлер: фоновый поток раз в interval снимает стек главного потока.
+    Результат — collapsed stacks (формат flamegraph.pl / speedscope).
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+        self._samples = _StackCounter()
+
+    def _run(self, thread_id):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self._samples[";".join(reversed(stack))] += 1
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._samples.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(threading.get_ident(),), daemon=True, name="sampling-profiler")
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return ""
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return "\n".join(f"{stack} {count}" for stack, count in self._samples.most_common()) + "\n"
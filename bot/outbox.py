@@ -0,0 +1,273 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import OrderedDict
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from config import OUTBOX_PATH, OUTBOX_BATCH_SIZE, OUTBOX_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+MAX_BACKOFF = 60
+# Журнал обрезается, когда в нем не осталось неотправленного и он вырос больше этого
+COMPACT_BYTES = 1024 * 1024
+# Столько раз запись должна не пройти отдельно от соседних, прошедших успешно, чтобы уйти в dead-letter
+DEAD_LETTER_ATTEMPTS = 3
+# Сколько процессов на одном хосте могут держать свой журнал (path, path.1, ...)
+MAX_SLOTS = 64
+
+class Outbox:
+    """
+    Локальный outbox для записей в БД.
+    enqueue() дописывает запись в append-only журнал (JSONL, fsync) и сразу возвращает управление;
+    фоновая задача группирует записи по операции и отправляет их пачками в зарегистрированные sink'и,
+    после успеха в журнал дописывается подтверждение. После падения неподтвержденные записи
+    поднимаются из журнала и отправляются повторно — поэтому sink'и должны быть идемпотентными.
+    Журнал занимается flock'ом: второй процесс на том же хосте берет следующий свободный (outbox.1.jsonl, ...),
+    а перезапущенный — освободившийся, вместе с его неподтвержденными записями.
+    Непрошедшая пачка делится пополам до отдельных записей; запись, которая не проходит, когда другие
+    из пачки проходят, после DEAD_LETTER_ATTEMPTS попыток уходит в файл *.dead.jsonl и не блокирует остальные.
+    Если sink упал с сетевой ошибкой/таймаутом или не прошло ничего (кроме уже замеченных плохих записей),
+    это считается недоступностью БД: пачка повторяется с backoff, попытки записям не засчитываются.
+    """
+    def __init__(self, path, batch_size, flush_interval):
+        self.base_path = path
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._sinks = {}  # op -> async fn(list[payload])
+        self._pending = OrderedDict()  # entry id -> (op, payload)
+        self._file = None
+        self._write_lock = asyncio.Lock()
+        self._start_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task = None
+        self._lock_file = None
+        self._attempts = {}  # entry id -> сколько раз не прошла отдельно
+        self.stats = {"split_batches": 0, "dead_lettered": 0}
+        # Ошибки, означающие недоступность БД, а не плохую запись: пачка не делится
+        self._transient_errors = (asyncio.TimeoutError, TimeoutError, ConnectionError)
+
+    def register_sink(self, op, fn):
+        self._sinks[op] = fn
+
+    def register_transient_errors(self, *types):
+        self._transient_errors += types
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def snapshot(self):
+        return {**self.stats, "pending": len(self._pending)}
+
+    def _lock(self):
+        """Первый незанятый журнал из path, path.1, ...; блокировка держится до stop()"""
+        os.makedirs(os.path.dirname(self.base_path) or ".", exist_ok=True)
+        if fcntl is None:
+            return self.base_path
+        root, ext = os.path.splitext(self.base_path)
+        for slot in range(MAX_SLOTS):
+            path = self.base_path if slot == 0 else f"{root}.{slot}{ext}"
+            lock_file = open(path + ".lock", "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue
+            self._lock_file = lock_file
+            return path
+        raise RuntimeError(f"Outbox: all {MAX_SLOTS} journals near {self.base_path} are locked")
+
+    def _replay(self):
+        self.path = self._lock()
+        pending = OrderedDict()
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Недописанная строка при падении — пропускаем
+                        continue
+                    if "ack" in record:
+                        for entry_id in record["ack"]:
+                            pending.pop(entry_id, None)
+                    else:
+                        pending[record["id"]] = (record["op"], record["p"])
+        # Переписываем журнал только с неподтвержденными записями
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for entry_id, (op, payload) in pending.items():
+                f.write(_dumps({"id": entry_id, "op": op, "p": payload}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return pending
+
+    async def start(self):
+        async with self._start_lock:
+            if self._task is not None:
+                return
+            pending = await asyncio.to_thread(self._replay)
+            self._pending = OrderedDict(list(pending.items()) + list(self._pending.items()))
+            self._file = await asyncio.to_thread(open, self.path, "a", encoding="utf-8")
+            if pending:
+                logger.info(f"Outbox: replaying {len(pending)} pending entries from {self.path}")
+            self._task = asyncio.create_task(self._flush_loop(), name="outbox-flush")
+            self._wake.set()
+
+    def _append(self, lines):
+        self._file.write("".join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def _write(self, records):
+        async with self._write_lock:
+            await asyncio.to_thread(self._append, [_dumps(r) for r in records])
+
+    async def enqueue(self, op, payload):
+        """Надежно сохраняет запись в журнал; в БД она попадет фоновой пачкой"""
+        if self._task is None:
+            await self.start()
+        entry_id = uuid.uuid4().hex
+        await self._write([{"id": entry_id, "op": op, "p": payload}])
+        self._pending[entry_id] = (op, payload)
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+        return entry_id
+
+    def _next_batch(self):
+        groups = {}
+        for entry_id, (op, payload) in self._pending.items():
+            ids, payloads = groups.setdefault(op, ([], []))
+            if len(ids) < self.batch_size:
+                ids.append(entry_id)
+                payloads.append(payload)
+        return groups
+
+    async def flush(self):
+        """Одна попытка отправить накопленное; True, если все группы ушли успешно"""
+        ok = True
+        for op, (ids, payloads) in self._next_batch().items():
+            sink = self._sinks.get(op)
+            if sink is None:
+                logger.error(f"Outbox: no sink for '{op}'")
+                ok = False
+                continue
+            try:
+                acked, failures = await self._send(sink, ids, payloads)
+            except self._transient_errors as e:
+                logger.error(f"Outbox flush '{op}' ({len(ids)}) failed: {e!r}")
+                ok = False
+                continue
+            if not acked:
+                # Ничего не прошло: попытки засчитываются только записям, которые уже не проходили рядом с прошедшими
+                known = [(entry_id, error) for entry_id, error in failures if entry_id in self._attempts]
+                if not known:
+                    logger.error(f"Outbox flush '{op}' ({len(ids)}) failed: {failures[0][1]}")
+                    ok = False
+                    continue
+                failures = known
+            for entry_id, error in failures:
+                await self._reject(op, entry_id, error)
+                ok = False
+        if not self._pending:
+            await self._compact()
+        return ok
+
+    async def _send(self, sink, ids, payloads):
+        """
+        Отправляет пачку, при ошибке — обе половины по отдельности, вплоть до одиночных записей.
+        Возвращает (сколько подтверждено, [(id, ошибка)] непрошедших записей);
+        сетевые ошибки и таймауты пробрасывает сразу.
+        """
+        try:
+            await sink(payloads)
+        except self._transient_errors:
+            raise
+        except Exception as e:
+            if len(ids) == 1:
+                return 0, [(ids[0], e)]
+            self.stats["split_batches"] += 1
+            mid = len(ids) // 2
+            acked, failures = 0, []
+            for part_ids, part_payloads in ((ids[:mid], payloads[:mid]), (ids[mid:], payloads[mid:])):
+                part_acked, part_failures = await self._send(sink, part_ids, part_payloads)
+                acked += part_acked
+                failures += part_failures
+            return acked, failures
+        for entry_id in ids:
+            self._pending.pop(entry_id, None)
+            self._attempts.pop(entry_id, None)
+        await self._write([{"ack": ids}])
+        return len(ids), []
+
+    async def _reject(self, op, entry_id, error):
+        attempts = self._attempts[entry_id] = self._attempts.get(entry_id, 0) + 1
+        if attempts < DEAD_LETTER_ATTEMPTS:
+            logger.warning(f"Outbox: entry {entry_id} of '{op}' failed alone ({attempts}/{DEAD_LETTER_ATTEMPTS}): {error}")
+            return
+        _, payload = self._pending.pop(entry_id)
+        del self._attempts[entry_id]
+        root, ext = os.path.splitext(self.path)
+        record = {"id": entry_id, "op": op, "p": payload, "error": str(error)}
+        await asyncio.to_thread(_append_file, f"{root}.dead{ext}", _dumps(record))
+        await self._write([{"ack": [entry_id]}])
+        self.stats["dead_lettered"] += 1
+        logger.error(f"Outbox: entry {entry_id} of '{op}' moved to dead-letter after {attempts} attempts: {error}")
+
+    async def _compact(self):
+        async with self._write_lock:
+            if not self._pending and self._file.tell() > COMPACT_BYTES:
+                await asyncio.to_thread(self._file.truncate, 0)
+                await asyncio.to_thread(self._file.seek, 0)
+
+    async def _flush_loop(self):
+        backoff = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=backoff)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if not self._pending:
+                continue
+            if await self.flush():
+                backoff = self.flush_interval
+                if self._pending:
+                    self._wake.set()
+            else:
+                backoff = min(max(backoff * 2, 1), MAX_BACKOFF)
+
+    async def stop(self):
+        """Последняя попытка отправить накопленное; неотправленное останется в журнале"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        try:
+            while self._pending and await self.flush():
+                pass
+        finally:
+            await asyncio.to_thread(self._file.close)
+            self._file = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+def _append_file(path, line):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _dumps(record):
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+journal = Outbox(OUTBOX_PATH, OUTBOX_BATCH_SIZE, OUTBOX_FLUSH_INTERVAL)
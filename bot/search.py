@@ -0,0 +1,365 @@
+import bisect
+import heapq
+import logging
+import math
+import re
+import time
+import database
+
+logger = logging.getLogger(__name__)
+
+K1 = 1.2
+B = 0.75
+# Совпадение по номеру машины — точный идентификатор, весит больше любых слов
+EXACT_BOOST = 10.0
+# Сколько слов словаря разворачивает один префикс
+MAX_EXPANSIONS = 64
+MIN_PREFIX = 3
+# Сколько самых свежих совпадений ранжируется; страница не может уходить дальше
+RANK_WINDOW = 1000
+
+_WORD_RE = re.compile(r"[0-9a-zа-я]+")
+# Латиница, похожая на кириллицу в номерах: A123BC164 и А123ВС164 — один номер
+_PLATE_LETTERS = str.maketrans("abekmhopctyx", "авекмнорстух")
+_PLATE_RE = re.compile(r"[авекмнорстух]\d{3}[авекмнорстух]{2}\d{2,3}|[авекмнорстух]{2}\d{3}\d{2,3}")
+_PLATE_PREFIX_RE = re.compile(r"[авекмнорстух]{1,2}\d{1,3}[авекмнорстух]{0,2}\d{0,3}")
+_PLATE_JUNK_RE = re.compile(r"[\s\-]")
+
+# Окончания для легкого стемминга: длинные раньше коротких, чтобы «ами» снималось целиком
+_ENDINGS = sorted({
+    "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "иях", "ием", "ией",
+    "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ую", "юю", "ом", "ем", "ам", "ям",
+    "ах", "ях", "ов", "ев", "ию", "ия", "ье", "ья", "ью", "ть", "ет", "ит", "ут", "ют", "ат", "ят",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+}, key=len, reverse=True)
+MIN_STEM = 2
+# Служебные слова есть почти в каждой заявке и ничего не отбирают
+STOPWORDS = frozenset("""
+а без бы в во вот все всё да для до его ее её же за и из или их к как ко ли на над не нет ни но о об около от очень
+по под при про с со так там то тоже тут у уже что чтобы это я мы вы он она они
+""".replace("ё", "е").split())
+
+def normalize(text):
+    return (text or "").lower().replace("ё", "е")
+
+def stem(word):
+    """Снимает одно окончание у кириллических слов: «ямы», «ямой», «ямами» -> «ям»"""
+    if word.isdigit() or not ("а" <= word[0] <= "я"):
+        return word
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+def words(text):
+    return [word for word in _WORD_RE.findall(normalize(text)) if word not in STOPWORDS]
+
+def plates(text):
+    """Госномера из свободного текста, без пробелов и с кириллическими буквами"""
+    compact = re.sub(r"[\s\-]", "", normalize(text).translate(_PLATE_LETTERS))
+    return set(_PLATE_RE.findall(compact))
+
+def _extra_info(row):
+    extra = row.get("extra_data")
+    return extra.get("info") if isinstance(extra, dict) else None
+
+def _insort(vocab, term):
+    i = bisect.bisect_left(vocab, term)
+    if i == len(vocab) or vocab[i] != term:
+        vocab.insert(i, term)
+
+def _discard(vocab, term):
+    i = bisect.bisect_left(vocab, term)
+    if i < len(vocab) and vocab[i] == term:
+        del vocab[i]
+
+def _prefixed(vocab, prefix, limit=None):
+    """Слова словаря, начинающиеся с prefix: бинарный поиск по отсортированному списку"""
+    i = bisect.bisect_left(vocab, prefix)
+    result = []
+    while i < len(vocab) and vocab[i].startswith(prefix):
+        result.append(vocab[i])
+        if limit and len(result) >= limit:
+            break
+        i += 1
+    return result
+
+class SearchIndex:
+    """
+    Инвертированный индекс заявок в памяти: основы слов описания, адреса, доп. информации и категорий -> {doc: вес},
+    отдельный словарь госномеров (поиск по префиксу). Телефоны не индексируются: поиск открыт без авторизации.
+    Запрос — пересечение списков по всем словам с ранжированием BM25, так что время зависит от редкого слова запроса,
+    а не от числа заявок.
+    """
+    # Адрес и доп. информация короткие и почти всегда то, что ищут — весят вдвое больше описания
+    FIELDS = (("description", 1.0), ("location", 2.0), ("info", 2.0), ("category", 1.0), ("sub_category", 1.0))
+
+    def __init__(self):
+        self._ids = {}  # ticket_id -> doc
+        self._docs = {}  # doc -> [ticket_id, created_at, category, sub_category, status, location, is_deleted, length, keys, text_hash]
+        self._next_doc = 0
+        self._postings = {}  # основа -> {doc: вес}
+        self._vocab = []  # отсортированные основы — для префиксов
+        self._plates = {}  # номер -> {doc}
+        self._plate_vocab = []
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    @staticmethod
+    def _text_hash(row):
+        return hash((row.get("description"), row.get("location"), _extra_info(row),
+                     row.get("category"), row.get("sub_category")))
+
+    def add(self, row):
+        ticket_id = row.get("id")
+        if not ticket_id:
+            return
+        if ticket_id in self._ids:
+            self.remove(ticket_id)
+        doc = self._next_doc
+        self._next_doc += 1
+        self._ids[ticket_id] = doc
+
+        weights = {}
+        length = 0
+        texts = {"info": _extra_info(row)}
+        for field, weight in self.FIELDS:
+            for word in words(texts[field] if field == "info" else row.get(field)):
+                term = stem(word)
+                weights[term] = weights.get(term, 0.0) + weight
+                length += 1
+        for term, weight in weights.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                _insort(self._vocab, term)
+            postings[doc] = weight
+
+        plate_keys = plates(f"{texts['info'] or ''} {row.get('description') or ''}")
+        for plate in plate_keys:
+            self._add_key(self._plates, self._plate_vocab, plate, doc)
+
+        self._total_length += length
+        self._docs[doc] = [ticket_id, row.get("created_at") or "", row.get("category"), row.get("sub_category"),
+                           row.get("status") or "new", row.get("location"), bool(row.get("is_deleted")), length,
+                           (tuple(weights), tuple(plate_keys)), self._text_hash(row)]
+
+    @staticmethod
+    def _add_key(table, vocab, key, doc):
+        bucket = table.get(key)
+        if bucket is None:
+            bucket = table[key] = set()
+            _insort(vocab, key)
+        bucket.add(doc)
+
+    @staticmethod
+    def _remove_key(table, vocab, key, doc):
+        bucket = table.get(key)
+        if bucket is None:
+            return False
+        bucket.discard(doc)
+        if not bucket:
+            del table[key]
+            _discard(vocab, key)
+            return True
+        return False
+
+    def remove(self, ticket_id):
+        doc = self._ids.pop(ticket_id, None)
+        if doc is None:
+            return
+        entry = self._docs.pop(doc)
+        terms, plate_keys = entry[8]
+        for term in terms:
+            postings = self._postings[term]
+            del postings[doc]
+            if not postings:
+                del self._postings[term]
+                _discard(self._vocab, term)
+        for plate in plate_keys:
+            self._remove_key(self._plates, self._plate_vocab, plate, doc)
+        self._total_length -= entry[7]
+
+    def update(self, row):
+        """Полная строка (realtime): текст поменялся — переиндексируем, иначе только статус и удаление"""
+        doc = self._ids.get(row.get("id"))
+        if doc is None or self._docs[doc][9] != self._text_hash(row):
+            self.add(row)
+            return
+        entry = self._docs[doc]
+        if "status" in row:
+            entry[4] = row["status"]
+        if "is_deleted" in row:
+            entry[6] = bool(row["is_deleted"])
+
+    def set_status(self, ticket_id, status):
+        doc = self._ids.get(ticket_id)
+        if doc is not None:
+            self._docs[doc][4] = status
+
+    # --- запрос ---
+
+    def _word_group(self, word, prefix):
+        """Основа слова, а для последнего слова запроса — еще и все слова словаря с таким началом"""
+        terms = {stem(word)}
+        if prefix and len(word) >= MIN_PREFIX:
+            terms.update(_prefixed(self._vocab, word, MAX_EXPANSIONS))
+        return [(term, self._postings[term]) for term in terms if term in self._postings]
+
+    def _plate_docs(self, prefix):
+        docs = set()
+        for plate in _prefixed(self._plate_vocab, prefix, MAX_EXPANSIONS):
+            docs |= self._plates[plate]
+        return docs
+
+    def _parse(self, query):
+        """Запрос -> группы: (основы с постингами, документы с точным совпадением номера)"""
+        text = normalize(query)
+        plate = _PLATE_JUNK_RE.sub("", text).translate(_PLATE_LETTERS)
+        if len(plate) >= 4 and any(ch.isdigit() for ch in plate) and _PLATE_PREFIX_RE.fullmatch(plate):
+            return [([], self._plate_docs(plate))]
+        tokens = words(text)
+        groups = []
+        for i, word in enumerate(tokens):
+            exact = set()
+            mapped = word.translate(_PLATE_LETTERS)
+            if not word.isdigit() and any(ch.isdigit() for ch in word) and _PLATE_PREFIX_RE.fullmatch(mapped):
+                exact = self._plate_docs(mapped)
+            groups.append((self._word_group(word, prefix=i == len(tokens) - 1), exact))
+        return groups
+
+    def _stream(self, terms, exact):
+        """Документы группы от новых к старым: постинги упорядочены по doc, а doc растет со временем добавления"""
+        iters = [reversed(postings) for _, postings in terms]
+        if exact:
+            iters.append(sorted(exact, reverse=True))
+        if len(iters) == 1:
+            yield from iters[0]
+            return
+        last = None
+        for doc in heapq.merge(*iters, reverse=True):
+            if doc != last:
+                yield doc
+                last = doc
+
+    def search(self, query, offset=0, limit=20, statuses=None, categories=None, include_deleted=False):
+        """
+        (всего, страница результатов). Совпадения перебираются от новых к старым по самой редкой группе запроса;
+        ранжируются BM25 не больше RANK_WINDOW самых свежих — для очень общих запросов «всего» тогда оценка.
+        """
+        groups = self._parse(query)
+        if not groups or any(not terms and not exact for terms, exact in groups):
+            # Пустой запрос или слово, которого нет ни в одной заявке — пересечение пустое
+            return 0, [], True
+
+        sizes = [sum(len(p) for _, p in terms) + len(exact) for terms, exact in groups]
+        driver = min(range(len(groups)), key=sizes.__getitem__)
+        others = [group for i, group in enumerate(groups) if i != driver]
+        docs_meta = self._docs
+
+        window = []
+        scanned = 0
+        exhausted = True
+        for doc in self._stream(*groups[driver]):
+            scanned += 1
+            meta = docs_meta[doc]
+            if (meta[6] and not include_deleted) or (statuses and meta[4] not in statuses) \
+                    or (categories and meta[2] not in categories):
+                continue
+            if all(doc in exact or any(doc in postings for _, postings in terms) for terms, exact in others):
+                window.append(doc)
+                if len(window) >= RANK_WINDOW:
+                    exhausted = False
+                    break
+        if exhausted:
+            total = len(window)
+        else:
+            total = round(len(window) * sizes[driver] / scanned)
+
+        n = len(docs_meta)
+        avgdl = self._total_length / n if n else 1.0
+        scored_terms = [
+            [(math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5)), postings) for _, postings in terms]
+            for terms, _ in groups
+        ]
+        exacts = [exact for _, exact in groups]
+
+        def score(doc):
+            length_norm = K1 * (1 - B + B * docs_meta[doc][7] / avgdl)
+            total = 0.0
+            for terms, exact in zip(scored_terms, exacts):
+                best = EXACT_BOOST if doc in exact else 0.0
+                for idf, postings in terms:
+                    tf = postings.get(doc)
+                    if tf:
+                        best = max(best, idf * tf * (K1 + 1) / (tf + length_norm))
+                total += best
+            return total
+
+        # При равном счете выше более новые (больший doc)
+        top = heapq.nlargest(offset + limit, ((score(doc), doc) for doc in window))
+        results = []
+        for value, doc in top[offset:]:
+            ticket_id, created_at, category, sub_category, status, location, is_deleted = docs_meta[doc][:7]
+            results.append({
+                "id": ticket_id, "score": round(value, 4), "created_at": created_at, "category": category,
+                "sub_category": sub_category, "status": status, "location": location, "is_deleted": is_deleted,
+            })
+        return total, results, exhausted
+
+class SearchService:
+    """Индекс поиска: строится одним проходом по БД при старте и дальше живет на событиях database"""
+    COLUMNS = "id, created_at, category, sub_category, status, location, description, extra_data, is_deleted"
+
+    def __init__(self):
+        self.index = SearchIndex()
+        self.ready = False
+        self._pending = None
+        self.stats = {"queries": 0, "query_seconds_total": 0.0, "rebuilds": 0, "rebuild_seconds": 0.0}
+        database.add_listener(self.on_event)
+
+    def on_event(self, event, row):
+        if self._pending is not None:
+            self._pending.append((event, row))
+        if event == "complaint_created":
+            self.index.add(row)
+        elif event == "complaint_updated":
+            self.index.update(row)
+        elif event == "status_changed":
+            self.index.set_status(row["id"], row["status"])
+
+    async def rebuild(self):
+        start = time.perf_counter()
+        index = SearchIndex()
+        self._pending = []
+        try:
+            # Удаленные тоже индексируются: их можно найти с include_deleted=1
+            async for rows in database.iter_rows("complaints", self.COLUMNS, op="search_rebuild"):
+                for row in rows:
+                    index.add(row)
+        finally:
+            pending, self._pending = self._pending, None
+        self.index = index
+        for event, row in pending:
+            self.on_event(event, row)
+        self.ready = True
+        self.stats["rebuilds"] += 1
+        self.stats["rebuild_seconds"] = round(time.perf_counter() - start, 3)
+        logger.info(f"Search index: {len(index)} complaints, {len(index._postings)} terms in {self.stats['rebuild_seconds']}s")
+
+    def search(self, query, **kwargs):
+        start = time.perf_counter()
+        total, results, exact = self.index.search(query, **kwargs)
+        took = time.perf_counter() - start
+        self.stats["queries"] += 1
+        self.stats["query_seconds_total"] += took
+        return {"query": query, "total": total, "total_is_exact": exact, "took_ms": round(took * 1000, 2), "results": results}
+
+    def snapshot(self):
+        queries = self.stats["queries"]
+        return {
+            **self.stats, "documents": len(self.index), "terms": len(self.index._postings), "ready": int(self.ready),
+            "query_seconds_avg": round(self.stats["query_seconds_total"] / queries, 6) if queries else 0.0,
+        }
@@ -0,0 +1,229 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter, TelegramServerError
+from config import SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_MAX_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: чем меньше, тем раньше. Ответы мастера заявки важнее массовой рассылки операторов
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+_priority = contextvars.ContextVar("send_priority", default=INTERACTIVE)
+
+@contextmanager
+def bulk():
+    """Все вызовы Bot API внутри блока идут с низким приоритетом"""
+    token = _priority.set(BULK)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Через сколько секунд будет доступен токен (0 — уже есть)"""
+        self._refill(now)
+        token_wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(token_wait, self.blocked_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Общий планировщик исходящих вызовов Bot API (request-middleware сессии бота).
+    Глобальный и поканальный token bucket, приоритет интерактивных ответов над массовыми,
+    повтор после 429 (retry_after с джиттером) и 5xx. Вызовы без chat_id (getFile и т.п.) идут напрямую.
+    """
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate, chat_rate, chat_burst, max_retries):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+
+        self._buckets = OrderedDict()  # chat_id -> TokenBucket
+        self._queues = {}  # chat_id -> heap [(priority, seq, future, enqueued_at)]
+        self._ready = []  # heap [(priority, seq, chat_id)] — у чата есть токен
+        self._timers = []  # heap [(ready_at, chat_id)] — чат ждет своего токена
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Вызовы с chat_id от постановки в очередь до ответа Telegram (включая повторы)
+        self._in_flight = 0
+        self.stats = {
+            "granted": {name: 0 for name in PRIORITY_NAMES.values()},
+            "wait_seconds_total": {name: 0.0 for name in PRIORITY_NAMES.values()},
+            "wait_seconds_max": {name: 0.0 for name in PRIORITY_NAMES.values()},
+            "retry_after": 0, "server_errors": 0, "failed": 0,
+        }
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        priority = _priority.get()
+        self._in_flight += 1
+        try:
+            return await self._send_with_retries(make_request, bot, method, chat_id, priority)
+        finally:
+            self._in_flight -= 1
+
+    async def _send_with_retries(self, make_request, bot, method, chat_id, priority):
+        attempt = 0
+        while True:
+            await self.acquire(chat_id, priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1
+                if attempt >= self.max_retries:
+                    self.stats["failed"] += 1
+                    raise
+                delay = e.retry_after * random.uniform(1.0, 1.2)
+                logger.warning(f"429 for chat {chat_id}, retry in {delay:.1f}s")
+                self._bucket(chat_id).pause(time.monotonic() + delay)
+            except TelegramServerError:
+                self.stats["server_errors"] += 1
+                if attempt >= self.max_retries:
+                    self.stats["failed"] += 1
+                    raise
+                await asyncio.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.5))
+            attempt += 1
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._buckets) > self.MAX_CHAT_BUCKETS:
+                for old_chat in list(self._buckets)[:len(self._buckets) - self.MAX_CHAT_BUCKETS]:
+                    if old_chat not in self._queues:
+                        del self._buckets[old_chat]
+        else:
+            self._buckets.move_to_end(chat_id)
+        return bucket
+
+    def _schedule_chat(self, chat_id, now):
+        queue = self._queues[chat_id]
+        wait = self._bucket(chat_id).wait_time(now)
+        if wait > 0:
+            heapq.heappush(self._timers, (now + wait, chat_id))
+        else:
+            priority, seq, _, _ = queue[0]
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+
+    async def acquire(self, chat_id, priority=INTERACTIVE):
+        """Ждет разрешения на один вызов в чат chat_id"""
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), future, time.monotonic())
+        if chat_id in self._queues:
+            heapq.heappush(self._queues[chat_id], entry)
+        else:
+            self._queues[chat_id] = [entry]
+            self._schedule_chat(chat_id, time.monotonic())
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch(), name="send-scheduler")
+        self._wakeup.set()
+        await future
+
+    def _grant(self, chat_id, now):
+        wait = self._bucket(chat_id).wait_time(now)
+        if wait > 0:
+            # Чат успел получить паузу (429), пока стоял в очереди готовых
+            heapq.heappush(self._timers, (now + wait, chat_id))
+            return
+        queue = self._queues[chat_id]
+        while queue:
+            priority, _, future, enqueued = heapq.heappop(queue)
+            if future.done():
+                # Ожидающий отменен
+                continue
+            self.global_bucket.take(now)
+            self._bucket(chat_id).take(now)
+            name = PRIORITY_NAMES[priority]
+            waited = now - enqueued
+            self.stats["granted"][name] += 1
+            self.stats["wait_seconds_total"][name] += waited
+            self.stats["wait_seconds_max"][name] = max(self.stats["wait_seconds_max"][name], waited)
+            future.set_result(None)
+            break
+        if queue:
+            self._schedule_chat(chat_id, now)
+        else:
+            del self._queues[chat_id]
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, chat_id = heapq.heappop(self._timers)
+                if chat_id in self._queues:
+                    self._schedule_chat(chat_id, now)
+
+            timeout = None
+            if self._ready:
+                global_wait = self.global_bucket.wait_time(now)
+                if global_wait <= 0:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    self._grant(chat_id, now)
+                    continue
+                timeout = global_wait
+            if self._timers:
+                timer_wait = self._timers[0][0] - now
+                timeout = timer_wait if timeout is None else min(timeout, timer_wait)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def depth(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def idle(self):
+        """Нет ни ожидающих, ни выполняющихся отправок — можно закрывать сессию"""
+        return self._in_flight == 0
+
+    def snapshot(self):
+        avg = {
+            name: round(self.stats["wait_seconds_total"][name] / count, 4) if count else 0.0
+            for name, count in self.stats["granted"].items()
+        }
+        return {**self.stats, "queue_depth": self.depth(), "in_flight": self._in_flight,
+                "waiting_chats": len(self._queues), "wait_seconds_avg": avg}
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+scheduler = SendScheduler(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_MAX_RETRIES)
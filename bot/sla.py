@@ -0,0 +1,334 @@
+import asyncio
+import heapq
+import html
+import logging
+import time
+from datetime import datetime, timezone
+import database
+import geo
+import sender
+
+logger = logging.getLogger(__name__)
+
+# Как в STATUS_CONFIG фронтенда
+STATUS_LABELS = {
+    "new": "Новая", "in_work": "В работе", "clarification_needed": "На уточнении", "resolved": "Решено",
+    "measures_taken": "Приняты меры", "not_confirmed": "Не подтвердилось", "rejected": "Отклонено",
+}
+DEFAULT_PRIORITY = "medium"
+# Сколько заявок перечислять в одном сообщении об эскалации
+ESCALATION_LINES = 30
+# Пересобирать кучу, когда устаревших записей в ней больше, чем живых
+COMPACT_SLACK = 1024
+# Переход в «В работе» в течение стольких секунд после ответа оператора — следствие ответа, не уведомляем
+REPLY_QUIET = 120
+# Начало заметки об эскалации в истории заявки: по ней после перезапуска видно, что заявка уже эскалирована
+ESCALATION_NOTE = "⏰ Просрочен срок обработки"
+
+def parse_rules(spec):
+    """"critical:4,high:24,Дороги/high:12" -> {"critical": 14400.0, ...}: часы до эскалации по приоритету, категории или паре"""
+    rules = {}
+    for item in spec.split(","):
+        key, _, hours = item.rpartition(":")
+        if key.strip():
+            rules[key.strip()] = float(hours) * 3600
+    return rules
+
+def _parse_time(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+class SLAEngine:
+    """
+    Сроки открытых заявок в куче (дедлайн, версия, id): таймер спит до ближайшего дедлайна
+    и снимает с вершины только просроченные — без обходов таблицы complaints.
+    Изменение статуса или приоритета увеличивает версию заявки и кладет новую запись; старые
+    отбрасываются при снятии с вершины (ленивое удаление).
+    Смены статуса из дашборда (realtime) собираются за notify_delay секунд и уходят жителям
+    одним сообщением на человека с низким приоритетом.
+    Движок запускается только на одной реплике (SLA_LEADER): события других реплик он видит через realtime,
+    поэтому ответ оператора (ticket_messages) гасит уведомление о вызванном им переходе в «В работе».
+    Эскалация записывается заметкой бота в историю заявки; при загрузке заявка с заметкой позже текущего
+    дедлайна считается уже эскалированной, так что перезапуск не повторяет эскалаций.
+    """
+    def __init__(self, bot, rules, operator_chat_id, notify_citizens, notify_delay):
+        self.bot = bot
+        self.rules = rules
+        self.operator_chat_id = operator_chat_id
+        self.notify_citizens = notify_citizens
+        self.notify_delay = notify_delay
+        self._entries = {}  # id -> [версия, дедлайн, категория, приоритет, статус, user_id, created_at, эскалирована]
+        self._heap = []
+        self._wake = asyncio.Event()
+        self._pending = None
+        self._notifications = {}  # user_id -> {ticket_id: (категория, статус)}
+        self._notify_task = None
+        self._replied = {}  # ticket_id -> когда ответил оператор (monotonic), в порядке ответов
+        self._task = None
+        self.ready = False
+        self.stats = {"escalated": 0, "escalation_messages": 0, "notified": 0, "notify_failed": 0, "rebuild_seconds": 0.0}
+
+    def sla_seconds(self, category, priority):
+        for key in (f"{category}/{priority}", category, priority, DEFAULT_PRIORITY):
+            if key in self.rules:
+                return self.rules[key]
+        return None
+
+    def _track(self, row):
+        """Открытую заявку ставит (или переставляет) в кучу, закрытую — снимает"""
+        ticket_id = row["id"]
+        entry = self._entries.get(ticket_id)
+        status = row.get("status") or (entry[4] if entry else "new")
+        if status in geo.CLOSED_STATUSES or row.get("is_deleted"):
+            self._entries.pop(ticket_id, None)
+            return
+        category = row.get("category") or (entry[2] if entry else None)
+        priority = row.get("priority") or (entry[3] if entry else DEFAULT_PRIORITY)
+        created = entry[6] if entry else _parse_time(row.get("created_at"))
+        user_id = row.get("user_id") or (entry[5] if entry else None)
+        seconds = self.sla_seconds(category, priority)
+        deadline = created + seconds if seconds else None
+        if entry is None:
+            entry = self._entries[ticket_id] = [0, None, category, priority, status, user_id, created, False]
+        elif entry[1] == deadline:
+            entry[4] = status
+            return
+        entry[0] += 1
+        entry[1:6] = [deadline, category, priority, status, user_id]
+        # Срок сдвинули в будущее (например, понизили приоритет) — заявка снова может просрочиться
+        if deadline is not None and deadline > time.time():
+            entry[7] = False
+        if deadline is not None and not entry[7]:
+            self._push(deadline, entry[0], ticket_id)
+
+    def _push(self, deadline, version, ticket_id):
+        # Новый ближайший дедлайн — будим таймер, чтобы он пересчитал время сна
+        if not self._heap or deadline < self._heap[0][0]:
+            self._wake.set()
+        heapq.heappush(self._heap, (deadline, version, ticket_id))
+        if len(self._heap) > 2 * len(self._entries) + COMPACT_SLACK:
+            self._compact()
+
+    def _compact(self):
+        self._heap = [
+            (entry[1], entry[0], ticket_id) for ticket_id, entry in self._entries.items()
+            if entry[1] is not None and not entry[7]
+        ]
+        heapq.heapify(self._heap)
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, version, ticket_id = heapq.heappop(self._heap)
+            entry = self._entries.get(ticket_id)
+            if entry is None or entry[0] != version or entry[7]:
+                continue
+            entry[7] = True
+            due.append((ticket_id, entry))
+        return due
+
+    def on_event(self, event, row):
+        if self._pending is not None:
+            self._pending.append((event, row))
+        if event == "complaint_created":
+            self._track(row)
+        elif event == "status_changed":
+            # Ответ оператора: житель уже получил само сообщение, отдельное уведомление не нужно
+            self._track(row)
+        elif event == "message_saved" and row.get("sender") == "operator":
+            self._on_reply(row["ticket_id"])
+        elif event == "complaint_updated":
+            entry = self._entries.get(row["id"])
+            previous = entry[4] if entry else None
+            self._track(row)
+            status = row.get("status")
+            # Неизвестная после загрузки — закрытая заявка, вернувшаяся в работу, это тоже смена статуса.
+            # До загрузки неизвестны все заявки: правка одного приоритета не должна выглядеть сменой статуса
+            if entry:
+                changed = status != previous
+            else:
+                changed = self.ready and status not in geo.CLOSED_STATUSES
+            if status == "in_work" and time.monotonic() - self._replied.get(row["id"], -REPLY_QUIET) < REPLY_QUIET:
+                changed = False
+            if self.notify_citizens and changed and status and status != "new" and not row.get("is_deleted"):
+                self._queue_notification(row.get("user_id") or (entry[5] if entry else None), row["id"],
+                                         row.get("category") or (entry[2] if entry else ""), status)
+
+    # --- уведомления жителям ---
+
+    def _on_reply(self, ticket_id):
+        now = time.monotonic()
+        self._replied.pop(ticket_id, None)
+        self._replied[ticket_id] = now
+        while next(iter(self._replied.values())) < now - REPLY_QUIET:
+            self._replied.pop(next(iter(self._replied)))
+        # Статус мог прийти раньше сообщения — снимаем уже поставленное в очередь уведомление
+        for tickets in self._notifications.values():
+            if tickets.get(ticket_id, (None, None))[1] == "in_work":
+                del tickets[ticket_id]
+
+    def _on_message_insert(self, payload):
+        record = database.realtime_record(payload)
+        if record and record.get("sender") == "operator" and record.get("ticket_id"):
+            self._on_reply(record["ticket_id"])
+
+    def _queue_notification(self, user_id, ticket_id, category, status):
+        if not user_id:
+            return
+        self._notifications.setdefault(user_id, {})[ticket_id] = (category, status)
+        if self._notify_task is None:
+            self._notify_task = asyncio.create_task(self._flush_notifications(), name="sla-notify")
+
+    async def _flush_notifications(self):
+        try:
+            await asyncio.sleep(self.notify_delay)
+        finally:
+            self._notify_task = None
+        await self._send_notifications()
+
+    async def _send_notifications(self):
+        batch = {user_id: tickets for user_id, tickets in self._notifications.items() if tickets}
+        self._notifications = {}
+        with sender.bulk():
+            results = await asyncio.gather(
+                *(self._notify(user_id, tickets) for user_id, tickets in batch.items()), return_exceptions=True,
+            )
+        for user_id, result in zip(batch, results):
+            if isinstance(result, Exception):
+                self.stats["notify_failed"] += 1
+                logger.warning(f"SLA: status notification to {user_id} failed: {result}")
+            else:
+                self.stats["notified"] += 1
+
+    async def _notify(self, user_id, tickets):
+        lines = [
+            f"▪️ {html.escape(category or 'Заявка')}: <b>{STATUS_LABELS.get(status, status)}</b>"
+            for category, status in tickets.values()
+        ]
+        title = "🔔 <b>Статус вашей заявки изменен</b>" if len(lines) == 1 else "🔔 <b>Статусы ваших заявок изменены</b>"
+        await self.bot.send_message(chat_id=user_id, text=title + "\n\n" + "\n".join(lines), parse_mode="HTML")
+
+    # --- эскалации ---
+
+    async def _escalate(self, due):
+        self.stats["escalated"] += len(due)
+        now = time.time()
+        lines = []
+        for ticket_id, entry in due[:ESCALATION_LINES]:
+            _, deadline, category, priority, status, _, created, _ = entry
+            overdue_hours = (now - deadline) / 3600
+            lines.append(f"▪️ {html.escape(category or '—')} · {priority} · {STATUS_LABELS.get(status, status)} · "
+                         f"просрочена на {overdue_hours:.1f} ч · <code>{ticket_id}</code>")
+        if len(due) > ESCALATION_LINES:
+            lines.append(f"…и еще {len(due) - ESCALATION_LINES}")
+        logger.warning(f"SLA: {len(due)} complaints overdue")
+        await database.save_bot_notes([
+            (ticket_id, f"{ESCALATION_NOTE}: +{(now - entry[1]) / 3600:.1f} ч") for ticket_id, entry in due
+        ])
+        if not self.operator_chat_id:
+            return
+        text = f"⏰ <b>Просрочены заявки: {len(due)}</b>\n\n" + "\n".join(lines)
+        try:
+            with sender.bulk():
+                await self.bot.send_message(chat_id=self.operator_chat_id, text=text, parse_mode="HTML")
+            self.stats["escalation_messages"] += 1
+        except Exception as e:
+            logger.error(f"SLA: escalation message failed: {e}")
+
+    # --- жизненный цикл ---
+
+    async def rebuild(self):
+        """Все открытые заявки и заметки об эскалациях одним проходом по БД; события, пришедшие за это время, применяются после"""
+        start = time.perf_counter()
+        self._pending = []
+        entries, escalated = {}, {}
+        try:
+            async for rows in database.iter_rows(
+                "complaints", "id, created_at, user_id, category, priority, status",
+                where=lambda q: q.not_.in_("status", sorted(geo.CLOSED_STATUSES)).eq("is_deleted", False),
+                op="sla_rebuild",
+            ):
+                for row in rows:
+                    created = _parse_time(row.get("created_at"))
+                    priority = row.get("priority") or DEFAULT_PRIORITY
+                    seconds = self.sla_seconds(row.get("category"), priority)
+                    deadline = created + seconds if seconds else None
+                    entries[row["id"]] = [0, deadline, row.get("category"), priority, row.get("status") or "new",
+                                          row.get("user_id"), created, False]
+            if entries:
+                since = datetime.fromtimestamp(min(entry[6] for entry in entries.values()), timezone.utc).isoformat()
+                async for rows in database.iter_rows(
+                    "ticket_messages", "id, created_at, ticket_id",
+                    where=lambda q: q.eq("sender", "bot").like("message_text", f"{ESCALATION_NOTE}*").gte("created_at", since),
+                    op="sla_rebuild_escalations",
+                ):
+                    for row in rows:
+                        escalated[row["ticket_id"]] = max(escalated.get(row["ticket_id"], 0), _parse_time(row["created_at"]))
+        finally:
+            pending, self._pending = self._pending, None
+        heap = []
+        for ticket_id, entry in entries.items():
+            if entry[1] is None:
+                continue
+            if escalated.get(ticket_id, 0) >= entry[1]:
+                entry[7] = True
+            else:
+                heap.append((entry[1], 0, ticket_id))
+        heapq.heapify(heap)
+        self._entries, self._heap = entries, heap
+        for event, row in pending:
+            self.on_event(event, row)
+        self.ready = True
+        self._wake.set()
+        self.stats["rebuild_seconds"] = round(time.perf_counter() - start, 3)
+        logger.info(f"SLA: {len(entries)} open complaints in {self.stats['rebuild_seconds']}s")
+
+    def start(self):
+        if self._task is None:
+            database.add_listener(self.on_event)
+            self._task = asyncio.create_task(self._run(), name="sla-timer")
+
+    async def stop(self):
+        for task in (self._task, self._notify_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._task = self._notify_task = None
+        # Накопленные уведомления отправляем сразу, пока сессия бота еще открыта
+        if self._notifications:
+            await self._send_notifications()
+
+    async def _run(self):
+        try:
+            await database.watch_complaints()
+            # Ответы операторов с других реплик и из дашборда
+            await database.subscribe_changes("ticket_messages", self._on_message_insert, event="INSERT")
+        except Exception as e:
+            logger.warning(f"SLA: realtime unavailable, dashboard status changes will not be seen ({e})")
+        while not self.ready:
+            try:
+                await self.rebuild()
+            except Exception as e:
+                logger.error(f"SLA rebuild failed: {e}")
+                await asyncio.sleep(60)
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wake.clear()
+            due = self._pop_due(time.time())
+            if due:
+                await self._escalate(due)
+            # Спим до ближайшего дедлайна; новый более ранний дедлайн будит раньше через _wake
+            timer = loop.call_at(loop.time() + max(self._heap[0][0] - time.time(), 0), self._wake.set) if self._heap else None
+            try:
+                await self._wake.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+    def snapshot(self):
+        return {
+            **self.stats, "open": len(self._entries), "heap": len(self._heap), "ready": int(self.ready),
+            "pending_notifications": sum(len(t) for t in self._notifications.values()),
+        }
@@ -0,0 +1,182 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+from config import FSM_STORAGE, FSM_DB_PATH, FSM_TTL, FSM_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Черновики больше этого размера сжимаются
+COMPRESS_THRESHOLD = 256
+PURGE_INTERVAL = 60
+
+def dump_data(data):
+    """Компактная сериализация черновика: JSON без пробелов, крупные — через zlib"""
+    if not data:
+        return None
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+    if len(raw) > COMPRESS_THRESHOLD:
+        return b"z" + zlib.compress(raw)
+    return b"j" + raw
+
+def load_data(blob):
+    if not blob:
+        return {}
+    if blob[:1] == b"z":
+        return json.loads(zlib.decompress(blob[1:]))
+    return json.loads(blob[1:])
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в локальном файле SQLite (WAL), общее для нескольких процессов на одном хосте.
+    Записи копятся в памяти и сбрасываются одной транзакцией раз в flush_interval;
+    брошенные черновики удаляются через ttl секунд после последнего изменения.
+    """
+    def __init__(self, path, ttl, flush_interval):
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # Все операции с соединением — в одном потоке
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-sqlite")
+        self._conn = None
+        self._pending = {}  # key -> {"state": ..., "data": ...} (только измененные поля)
+        self._flush_task = None
+        self._last_purge = 0
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fsm ("
+                "key TEXT PRIMARY KEY, state TEXT, data BLOB, expires_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _key(self, key):
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    def _select(self, column, key):
+        row = self._connect().execute(
+            f"SELECT {column} FROM fsm WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _write(self, states, datas, purge):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if states:
+                conn.executemany(
+                    "INSERT INTO fsm (key, state, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at",
+                    states,
+                )
+            if datas:
+                conn.executemany(
+                    "INSERT INTO fsm (key, data, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+                    datas,
+                )
+            if purge:
+                conn.execute(
+                    "DELETE FROM fsm WHERE expires_at <= ? OR (state IS NULL AND data IS NULL)", (time.time(),)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def _schedule(self):
+        if self.flush_interval <= 0:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"FSM flush error: {e}")
+            await self._schedule()
+
+    async def flush(self):
+        """Сбрасывает накопленные изменения в базу одной транзакцией"""
+        pending, self._pending = self._pending, {}
+        now = time.time()
+        purge = now - self._last_purge > PURGE_INTERVAL
+        if not pending and not purge:
+            return
+        expires_at = now + self.ttl
+        states = [(k, v["state"], expires_at) for k, v in pending.items() if "state" in v]
+        datas = [(k, dump_data(v["data"]), expires_at) for k, v in pending.items() if "data" in v]
+        try:
+            await self._run(self._write, states, datas, purge)
+        except Exception:
+            # Возвращаем несохраненное, не затирая более свежие изменения
+            for k, v in pending.items():
+                self._pending[k] = {**v, **self._pending.get(k, {})}
+            raise
+        if purge:
+            self._last_purge = now
+
+    async def set_state(self, key, state=None):
+        value = state.state if isinstance(state, State) else state
+        self._pending.setdefault(self._key(key), {})["state"] = value
+        await self._schedule()
+
+    async def get_state(self, key):
+        k = self._key(key)
+        pending = self._pending.get(k)
+        if pending and "state" in pending:
+            return pending["state"]
+        return await self._run(self._select, "state", k)
+
+    async def set_data(self, key, data):
+        self._pending.setdefault(self._key(key), {})["data"] = copy.deepcopy(dict(data))
+        await self._schedule()
+
+    async def get_data(self, key):
+        k = self._key(key)
+        pending = self._pending.get(k)
+        if pending and "data" in pending:
+            return copy.deepcopy(pending["data"])
+        return load_data(await self._run(self._select, "data", k))
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        try:
+            await self.flush()
+        finally:
+            if self._conn is not None:
+                await self._run(self._conn.close)
+                self._conn = None
+            self._executor.shutdown(wait=False)
+
+def build_storage():
+    """Хранилище FSM по настройке FSM_STORAGE: sqlite (по умолчанию) или memory"""
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE == "sqlite":
+        return SQLiteStorage(FSM_DB_PATH, FSM_TTL, FSM_FLUSH_INTERVAL)
+    raise ValueError(f"Unknown FSM_STORAGE: {FSM_STORAGE}")
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+from aiogram import BaseMiddleware
+import database
+from config import DAILY_COMPLAINT_QUOTA, STATS_UTC_OFFSET, THROTTLE_MAX_KEYS
+
+logger = logging.getLogger(__name__)
+
+NEW_COMPLAINT_TEXT = "📝 Новая заявка"
+# Повторное предупреждение тому же пользователю — не чаще, чем раз в столько секунд
+WARN_INTERVAL = 30
+
+def parse_rules(spec):
+    """"message:20/10,photo:20/30" -> {"message": (20, 10.0), "photo": (20, 30.0)}"""
+    rules = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        action, _, limit = item.partition(":")
+        count, _, window = limit.partition("/")
+        rules[action.strip()] = (int(count), float(window))
+    return rules
+
+def classify(update):
+    """Действие апдейта для лимитов: photo, new_complaint, callback или message"""
+    if update.callback_query:
+        return "callback"
+    message = update.message
+    if message is None:
+        return None
+    if message.photo:
+        return "photo"
+    if message.text == NEW_COMPLAINT_TEXT:
+        return "new_complaint"
+    return "message"
+
+class SlidingWindows:
+    """
+    Приближенное скользящее окно на каждый ключ (пользователь, действие): два счетчика — текущее и прошлое
+    фиксированные окна, оценка = прошлое * (доля, еще попадающая в окно) + текущее.
+    Три числа на ключ вместо списка отметок времени; ключи вытесняются по LRU сверх max_keys.
+    """
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._counters = OrderedDict()  # key -> [номер текущего окна, прошлое, текущее]
+
+    def __len__(self):
+        return len(self._counters)
+
+    def hit(self, key, limit, window, now=None):
+        """Учитывает событие, если влезает в лимит; возвращает 0 или сколько секунд ждать"""
+        now = time.monotonic() if now is None else now
+        index = int(now // window)
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters[key] = [index, 0, 0]
+            if len(self._counters) > self.max_keys:
+                self._counters.popitem(last=False)
+        else:
+            self._counters.move_to_end(key)
+        if index != counter[0]:
+            # Сдвигаем окна; если прошло больше одного окна, прошлое пустое
+            counter[1] = counter[2] if index - counter[0] == 1 else 0
+            counter[2] = 0
+            counter[0] = index
+        start = index * window
+        weight = 1 - (now - start) / window
+        estimate = counter[1] * weight + counter[2]
+        if estimate + 1 <= limit:
+            counter[2] += 1
+            return 0.0
+        # Сколько ждать, пока вклад прошлого окна уменьшится на нужную величину (или начнется следующее)
+        if counter[1] and counter[2] < limit:
+            needed = estimate + 1 - limit
+            return min(needed / counter[1] * window, start + window - now)
+        # Ждем следующего окна и еще, пока вклад нынешнего (уже прошлого) окна не уменьшится до limit - 1
+        return start + window - now + window * max(0.0, 1 - (limit - 1) / max(counter[2], 1))
+
+class DailyQuota:
+    """
+    Заявки пользователя за текущие местные сутки.
+    Счетчики у каждой реплики свои (прогрев из БД + заявки, поданные через эту реплику), так что при
+    нескольких репликах пользователь может подать до limit заявок через каждую — квота мягкая.
+    """
+    def __init__(self, limit, utc_offset_hours, max_users, listen=True):
+        self.limit = limit
+        self.tz = timezone(timedelta(hours=utc_offset_hours))
+        self.max_users = max_users
+        self._counts = OrderedDict()  # user_id -> [день, число]
+        self.rejected = 0
+        if listen:
+            database.add_listener(self.on_event)
+
+    def on_event(self, event, row):
+        if event == "complaint_created" and row.get("user_id") is not None:
+            self.add(row["user_id"])
+
+    def _today(self):
+        return datetime.now(self.tz).date().isoformat()
+
+    def count(self, user_id):
+        entry = self._counts.get(user_id)
+        return entry[1] if entry and entry[0] == self._today() else 0
+
+    def add(self, user_id, n=1):
+        today = self._today()
+        entry = self._counts.get(user_id)
+        if entry is None or entry[0] != today:
+            entry = self._counts[user_id] = [today, 0]
+        self._counts.move_to_end(user_id)
+        entry[1] += n
+        if len(self._counts) > self.max_users:
+            self._counts.popitem(last=False)
+
+    def exceeded(self, user_id):
+        """Лимит исчерпан; отказ учитывается в статистике"""
+        if self.limit and self.count(user_id) >= self.limit:
+            self.rejected += 1
+            return True
+        return False
+
+    def message(self):
+        return f"⛔ Сегодня вы уже подали {self.limit} заявок. Новую можно будет подать завтра."
+
+    async def warm_up(self):
+        """Заявки, поданные сегодня до перезапуска, тоже считаются"""
+        if not self.limit:
+            return
+        midnight = datetime.now(self.tz).replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+        counts = {}
+        async for rows in database.iter_rows(
+            "complaints", "id, created_at, user_id", where=lambda q: q.gte("created_at", midnight), op="quota_warm_up",
+        ):
+            for row in rows:
+                counts[row["user_id"]] = counts.get(row["user_id"], 0) + 1
+        today = self._today()
+        for user_id, n in counts.items():
+            entry = self._counts.get(user_id)
+            # Запись за вчера (процесс пережил полночь) заменяем, а не дополняем
+            if entry is None or entry[0] != today:
+                entry = self._counts[user_id] = [today, 0]
+            entry[1] = max(entry[1], n)
+        logger.info(f"Daily quota: {len(counts)} users filed complaints today")
+
+class ThrottleMiddleware(BaseMiddleware):
+    """
+    Outer-middleware апдейтов, стоит перед FSM: лишние апдейты не читают состояние из хранилища
+    и не доходят до database. Небольшое превышение откладывается: апдейт обрабатывается в фоне через
+    до defer_max секунд, а middleware сразу возвращает управление (сон здесь держал бы воркер очереди вебхука).
+    Большее превышение отбрасывается с одним предупреждением пользователю.
+    Квота на заявки проверяется здесь на кнопке «Новая заявка» и еще раз при отправке (handlers.process_phone):
+    мастер можно начать и со старой клавиатуры категорий.
+    """
+    def __init__(self, rules, max_keys, defer_max, quota):
+        self.rules = rules
+        self.defer_max = defer_max
+        self.quota = quota
+        self.windows = SlidingWindows(max_keys)
+        self._warned = OrderedDict()  # user_id -> когда предупреждали
+        self._deferred = set()
+        self.stats = {
+            "passed": 0,
+            "deferred": {action: 0 for action in rules},
+            "dropped": {action: 0 for action in rules},
+        }
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        action = classify(event)
+        if user is None or action is None:
+            return await handler(event, data)
+
+        if action == "new_complaint" and self.quota.exceeded(user.id):
+            await self._warn(event, user.id, self.quota.message())
+            return None
+
+        rule = self.rules.get(action)
+        if rule is not None:
+            wait = self.windows.hit((user.id, action), *rule)
+            if wait:
+                if wait > self.defer_max:
+                    self.stats["dropped"][action] += 1
+                    await self._warn(event, user.id, "⏳ Слишком много сообщений. Подождите немного и повторите.")
+                    return None
+                self.stats["deferred"][action] += 1
+                task = asyncio.create_task(self._defer(handler, event, data, user.id, action, rule, wait))
+                self._deferred.add(task)
+                task.add_done_callback(self._deferred.discard)
+                return None
+        self.stats["passed"] += 1
+        return await handler(event, data)
+
+    async def _defer(self, handler, event, data, user_id, action, rule, wait):
+        await asyncio.sleep(wait)
+        # После ожидания место в окне занимаем заново
+        if self.windows.hit((user_id, action), *rule):
+            self.stats["dropped"][action] += 1
+            await self._warn(event, user_id, "⏳ Слишком много сообщений. Подождите немного и повторите.")
+            return
+        self.stats["passed"] += 1
+        try:
+            await handler(event, data)
+        except Exception as e:
+            logger.error(f"Deferred {action} update from {user_id} failed: {e}")
+
+    async def drain(self):
+        """При остановке: дождаться отложенных апдейтов"""
+        await asyncio.gather(*self._deferred, return_exceptions=True)
+
+    async def _warn(self, update, user_id, text):
+        """Одно предупреждение за WARN_INTERVAL: иначе ответы на флуд сами тратили бы лимиты Telegram"""
+        now = time.monotonic()
+        warn = now - self._warned.get(user_id, -WARN_INTERVAL) >= WARN_INTERVAL
+        if warn:
+            self._warned[user_id] = now
+            self._warned.move_to_end(user_id)
+            if len(self._warned) > self.windows.max_keys:
+                self._warned.popitem(last=False)
+        try:
+            if update.callback_query:
+                # Кнопку «отпускаем» всегда, иначе у пользователя крутятся часики
+                await update.callback_query.answer(text if warn else None)
+            elif warn:
+                await update.message.answer(text)
+        except Exception as e:
+            logger.warning(f"Throttle warning to {user_id} failed: {e}")
+
+    def snapshot(self):
+        return {**self.stats, "quota_rejected": self.quota.rejected, "tracked_keys": len(self.windows),
+                "deferred_pending": len(self._deferred)}
+
+quota = DailyQuota(DAILY_COMPLAINT_QUOTA, STATS_UTC_OFFSET, THROTTLE_MAX_KEYS)
@@ -0,0 +1,69 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import image_cache
+from config import THUMB_SIZES, THUMB_WORKERS, THUMB_QUALITY
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp"}
+
+_executor = None
+
+def _get_executor():
+    """Пул процессов создается при первом ресайзе; spawn — потому что в основном процессе есть потоки"""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=THUMB_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+def resize(data, size, fmt, quality):
+    """Выполняется в процессе пула: вписывает фото в квадрат size x size"""
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((size, size), Image.LANCZOS)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        if fmt == "webp":
+            img.save(out, "WEBP", quality=quality, method=4)
+        else:
+            img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+        return out.getvalue()
+
+def pick_size(requested):
+    """Ближайший разрешенный размер не меньше запрошенного — чтобы нельзя было наплодить вариантов"""
+    for size in THUMB_SIZES:
+        if requested <= size:
+            return size
+    return THUMB_SIZES[-1]
+
+def pick_format(requested, accept):
+    if requested in CONTENT_TYPES:
+        return requested
+    # auto: WebP тем, кто его понимает
+    return "webp" if "image/webp" in (accept or "") else "jpeg"
+
+async def _original_bytes(file_id, fetch_original):
+    image = await image_cache.cache.get(file_id, fetch_original)
+    try:
+        return await asyncio.to_thread(image.read)
+    finally:
+        image.close()
+
+async def get_variant(file_id, size, fmt, fetch_original):
+    """CachedImage варианта; генерируется один раз и дальше живет в image_cache под ключом file_id:256.webp"""
+    async def build():
+        original = await _original_bytes(file_id, fetch_original)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(), resize, original, size, fmt, THUMB_QUALITY)
+    return await image_cache.cache.get(f"{file_id}:{size}.{fmt}", build)
@@ -0,0 +1,92 @@
+import asyncio
+import tempfile
+from aiogram.types import InputFile
+
+CHUNK_SIZE = 64 * 1024
+# Текстовые поля формы (ticket_id, text) больше этого не бывают
+FIELD_MAX_BYTES = 64 * 1024
+
+class UploadTooLarge(Exception):
+    pass
+
+class SpooledInputFile(InputFile):
+    """InputFile поверх SpooledTemporaryFile: уходит в Telegram чанками, без копии в памяти"""
+    def __init__(self, spool, filename, chunk_size=CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.spool = spool
+
+    async def read(self, bot):
+        # С начала — чтобы повторная отправка после ошибки прочитала файл заново
+        await asyncio.to_thread(self.spool.seek, 0)
+        while True:
+            chunk = await asyncio.to_thread(self.spool.read, self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+async def _read_field(part):
+    data = bytearray()
+    while True:
+        chunk = await part.read_chunk(CHUNK_SIZE)
+        if not chunk:
+            break
+        data += chunk
+        if len(data) > FIELD_MAX_BYTES:
+            raise UploadTooLarge(f"Field '{part.name}' is too large")
+    return part.decode(bytes(data)).decode('utf-8')
+
+async def _spool_part(part, max_bytes, spool_bytes):
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    size = 0
+    try:
+        while True:
+            chunk = await part.read_chunk(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"File is larger than {max_bytes} bytes")
+            if size > spool_bytes:
+                # Уже на диске — пишем вне event loop
+                await asyncio.to_thread(spool.write, chunk)
+            else:
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    return spool, size
+
+async def read_reply_form(request, max_bytes, spool_bytes, max_files):
+    """
+    Потоково разбирает multipart/form-data ответа оператора.
+    Возвращает (поля, [(имя файла, SpooledTemporaryFile)]); файлы больше spool_bytes лежат на диске.
+    Превышение лимитов -> UploadTooLarge как можно раньше, не дочитывая тело.
+    """
+    if request.content_length and request.content_length > max_bytes * max_files + FIELD_MAX_BYTES:
+        raise UploadTooLarge("Request body is too large")
+
+    reader = await request.multipart()
+    fields, files = {}, []
+    try:
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            if part.name in ('file', 'files'):
+                if len(files) >= max_files:
+                    raise UploadTooLarge(f"Too many files (max {max_files})")
+                spool, size = await _spool_part(part, max_bytes, spool_bytes)
+                if size:
+                    files.append((part.filename or "image.jpg", spool))
+                else:
+                    spool.close()
+            else:
+                fields[part.name] = await _read_field(part)
+    except BaseException:
+        close_files(files)
+        raise
+    return fields, files
+
+def close_files(files):
+    for _, spool in files:
+        spool.close()
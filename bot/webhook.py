@@ -0,0 +1,94 @@
+import asyncio
+import hmac
+import logging
+from aiohttp import web
+from aiogram import types
+
+logger = logging.getLogger(__name__)
+
+def chat_key(data):
+    """Ключ упорядочивания для сырого апдейта: id чата (или пользователя), иначе update_id"""
+    for name, event in data.items():
+        if name == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+    return data.get("update_id", 0)
+
+class UpdateQueue:
+    """
+    Ограниченная очередь апдейтов, которую разбирают N воркеров.
+    Апдейты одного чата всегда попадают к одному воркеру и обрабатываются по порядку,
+    поэтому шаги FSM одного пользователя не переставляются.
+    """
+    def __init__(self, dp, bot, workers, maxsize):
+        self.dp = dp
+        self.bot = bot
+        per_worker = max(1, maxsize // workers)
+        self._queues = [asyncio.Queue(maxsize=per_worker) for _ in range(workers)]
+        self._tasks = []
+        self.accepting = True
+
+    def start(self):
+        for i, queue in enumerate(self._queues):
+            self._tasks.append(asyncio.create_task(self._worker(queue), name=f"update-worker-{i}"))
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    async def put(self, update, key, timeout):
+        """Кладет апдейт в очередь своего воркера; False, если места не дождались (backpressure)"""
+        queue = self._queues[hash(key) % len(self._queues)]
+        try:
+            await asyncio.wait_for(queue.put(update), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _worker(self, queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Update {update.update_id} failed: {e}")
+            finally:
+                queue.task_done()
+
+    def close(self):
+        """Перестать принимать новые апдейты (уже принятые будут обработаны)"""
+        self.accepting = False
+
+    async def join(self):
+        await asyncio.gather(*(q.join() for q in self._queues))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+def make_handler(update_queue, secret, enqueue_timeout):
+    """POST-обработчик вебхука для web.Application"""
+    async def handle_webhook(request):
+        if secret:
+            token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token, secret):
+                return web.Response(status=401)
+
+        if not update_queue.accepting:
+            # Процесс останавливается: Telegram повторит доставку, ее примет новый экземпляр
+            return web.Response(status=503, headers={"Retry-After": "1"})
+
+        data = await request.json()
+        update = types.Update.model_validate(data, context={"bot": update_queue.bot})
+        if not await update_queue.put(update, chat_key(data), enqueue_timeout):
+            # Telegram повторит доставку позже
+            logger.warning("Update queue is full, asking Telegram to retry")
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        return web.Response(text="OK")
+    return handle_webhook
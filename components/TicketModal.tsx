@@ -1,7 +1,7 @@
 import React, { useState, useEffect, useRef } from 'react';
 import { Ticket, TicketStatus, ChatMessage, Priority } from '../types';
 import { X, Send, User, Calendar, MessageSquare, MapPin, Tag, Paperclip, AlertCircle, Loader2, Bus, CreditCard, ChevronDown, UploadCloud, ChevronLeft, ChevronRight, Phone, Trash2 } from 'lucide-react';
-import { sendReplyViaBot, fetchTicketHistory, updateTicketStatus, updateTicketPriority, softDeleteTicket } from '../services/supabaseService';
+import { sendReplyViaBot, fetchTicketHistory, updateTicketStatus, updateTicketPriority, softDeleteTicket, thumbnailUrl } from '../services/supabaseService';
 import { CATEGORIES, PRIORITY_LABELS, STATUS_CONFIG } from '../constants';
 
 interface TicketModalProps {
@@ -41,6 +41,20 @@ export const TicketModal: React.FC<TicketModalProps> = ({ ticket, onClose, onUpd
      }
   }, [ticket.id]);
 
+  // Messages arriving through the change feed while the modal is open; a stored reply replaces
+  // its optimistic copy (local ids are Date.now() strings, stored ones are UUIDs)
+  useEffect(() => {
+     setLocalHistory(prev => {
+         let next = prev;
+         for (const message of ticket.history || []) {
+             if (next.some(m => m.id === message.id)) continue;
+             const local = next.findIndex(m => !m.id.includes('-') && m.sender === message.sender && m.text === message.text);
+             next = local >= 0 ? next.map((m, i) => i === local ? message : m) : [...next, message];
+         }
+         return next;
+     });
+  }, [ticket.history]);
+
   // Init Map if Location is Valid
   useEffect(() => {
       if (!ticket.location) return;
@@ -232,7 +246,7 @@ export const TicketModal: React.FC<TicketModalProps> = ({ ticket, onClose, onUpd
                     <div className="grid grid-cols-2 gap-2">
                         {ticket.attachments.map((att, idx) => (
                              <div key={idx} onClick={() => openLightbox(att.url)} className="aspect-square bg-slate-100 rounded-lg overflow-hidden border border-slate-200 relative group cursor-pointer hover:ring-2 hover:ring-indigo-500">
-                                <img src={att.url} alt="Evidence" className="w-full h-full object-cover transition-transform group-hover:scale-105" />
+                                <img src={thumbnailUrl(att.url, 256)} alt="Evidence" loading="lazy" className="w-full h-full object-cover transition-transform group-hover:scale-105" />
                              </div>
                         ))}
                     </div>
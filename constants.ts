@@ -17,19 +17,19 @@ export const CATEGORIES = {
       reqGeo: true 
   },
   'trash': { 
-      name: 'Мусор', 
+      name: 'Мусор и уборка', 
       emoji: '🗑', 
       subs: ['Невывоз мусора', 'Переполненная урна', 'Свалка', 'Грязь на контейнерной площадке'],
       reqGeo: true 
   },
   'transport': { 
-      name: 'Транспорт', 
+      name: 'Общественный транспорт', 
       emoji: '🚌', 
       subs: ['Нарушение графика', 'Хамство водителя', 'Грязный салон', 'Проезд остановки', 'Неисправность ТС'],
       reqExtra: true 
   },
   'light': { 
-      name: 'Освещение', 
+      name: 'Уличное освещение', 
       emoji: '💡', 
       subs: ['Не горит фонарь', 'Мигает свет', 'Поврежден столб', 'Оголенные провода'] 
   },
@@ -39,12 +39,12 @@ export const CATEGORIES = {
       subs: ['Упавшее дерево', 'Необходим покос травы', 'Сухостой', 'Сломаны ветки'] 
   },
   'facades': { 
-      name: 'Фасады и крыши', 
+      name: 'Фасады и здания', 
       emoji: '🏢', 
       subs: ['Граффити/Надписи', 'Осыпается фасад', 'Сосульки/Снег на крыше', 'Незаконная реклама'] 
   },
   'cleaning': { 
-      name: 'Уборка снега', 
+      name: 'Зимняя уборка', 
       emoji: '❄️', 
       subs: ['Нечищеный двор', 'Гололед', 'Снежный вал', 'Нечищеный тротуар'] 
   },
@@ -70,7 +70,7 @@ export const CATEGORIES = {
       subs: ['Холодно в квартире', 'Слишком жарко (перетоп)', 'Течь батареи'] 
   },
   'electricity': { 
-      name: 'Электричество', 
+      name: 'Электроснабжение', 
       emoji: '🔌', 
       subs: ['Отключение света', 'Искрит щиток', 'Открыт щиток в подъезде'] 
   },
@@ -80,7 +80,7 @@ export const CATEGORIES = {
       subs: ['Сломан инвентарь', 'Повреждено покрытие', 'Мусор'] 
   },
   'ads': { 
-      name: 'Реклама', 
+      name: 'Реклама и торговля', 
       emoji: '📢', 
       subs: ['Незаконная вывеска', 'Расклейка листовок', 'Штендер на тротуаре'] 
   },
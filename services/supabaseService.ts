@@ -18,6 +18,10 @@ export const getBotUrl = () => BOT_URL;
 
 export const isSupabaseConfigured = () => !!supabase;
 
+// Resized variant of a bot-proxied photo (the bot picks WebP when the browser supports it)
+export const thumbnailUrl = (url: string, size: number) =>
+    BOT_URL && url.startsWith(`${BOT_URL}/images/`) ? `${url}?size=${size}` : url;
+
 // Map DB row to Frontend Ticket
 const mapRowToTicket = (row: any): Ticket => {
   const mapPhoto = (idOrUrl: string, idx: number) => {
@@ -69,6 +73,26 @@ export const fetchTickets = async (): Promise<Ticket[]> => {
   return data.map(mapRowToTicket);
 };
 
+// Map ticket_messages row to a chat message
+const mapRowToMessage = (msg: any): ChatMessage => ({
+    id: msg.id,
+    sender: msg.sender,
+    text: msg.message_text,
+    timestamp: msg.created_at,
+    attachments: (msg.attachments || []).map((idOrUrl: string, idx: number) => {
+         let url = idOrUrl;
+         if (url && !url.startsWith('http') && BOT_URL) {
+             url = `${BOT_URL}/images/${idOrUrl}`;
+         }
+         return {
+             id: `att-${idx}`,
+             type: 'image',
+             url: url,
+             name: 'Вложение'
+         };
+    })
+});
+
 export const fetchTicketHistory = async (ticketId: string): Promise<ChatMessage[]> => {
     if (!supabase) throw new Error("Supabase not configured");
 
@@ -80,35 +104,18 @@ export const fetchTicketHistory = async (ticketId: string): Promise<ChatMessage[
     
     if (error) throw error;
 
-    return data.map((msg: any) => ({
-        id: msg.id,
-        sender: msg.sender,
-        text: msg.message_text,
-        timestamp: msg.created_at,
-        attachments: (msg.attachments || []).map((idOrUrl: string, idx: number) => {
-             let url = idOrUrl;
-             if (url && !url.startsWith('http') && BOT_URL) {
-                 url = `${BOT_URL}/images/${idOrUrl}`;
-             }
-             return {
-                 id: `att-${idx}`,
-                 type: 'image',
-                 url: url,
-                 name: 'Вложение'
-             };
-        })
-    }));
-};
-
-export const sendReplyViaBot = async (ticketId: string, text: string, file?: File) => {
+    return data.map(mapRowToMessage);
+};
+
+export const sendReplyViaBot = async (ticketId: string, text: string, file?: File | File[]) => {
     if (!BOT_URL) throw new Error("Bot URL not configured in Integration settings");
     
     const formData = new FormData();
     formData.append('ticket_id', ticketId);
     formData.append('text', text);
-    if (file) {
-        formData.append('file', file);
-    }
+    // Several files are sent by the bot as one album
+    const files = Array.isArray(file) ? file : file ? [file] : [];
+    files.forEach(f => formData.append('file', f));
     
     const response = await fetch(`${BOT_URL}/api/reply`, {
         method: 'POST',
@@ -121,6 +128,134 @@ export const sendReplyViaBot = async (ticketId: string, text: string, file?: Fil
     }
 };
 
+// Pre-clustered open complaints for the visible map area (bbox = [minLon, minLat, maxLon, maxLat])
+export const fetchMapClusters = async (bbox: number[], zoom: number) => {
+    if (!BOT_URL) throw new Error("Bot URL not configured in Integration settings");
+    const response = await fetch(`${BOT_URL}/api/map?bbox=${bbox.join(',')}&zoom=${Math.round(zoom)}`);
+    if (!response.ok) throw new Error(`Bot API Error: ${await response.text()}`);
+    return await response.json() as {
+        zoom: number;
+        total: number;
+        clusters: { lat: number; lon: number; count: number; categories: Record<string, number> }[];
+        points: { id: string; lat: number; lon: number; category: string; status: string }[];
+    };
+};
+
+// Server-side rollups for AnalyticsView (since = 'YYYY-MM-DD', optional)
+export const fetchStats = async (since?: string) => {
+    if (!BOT_URL) throw new Error("Bot URL not configured in Integration settings");
+    const response = await fetch(`${BOT_URL}/api/stats${since ? `?since=${since}` : ''}`);
+    if (!response.ok) throw new Error(`Bot API Error: ${await response.text()}`);
+    return await response.json();
+};
+
+// Server-side search by address, description or plate number (ranked, paginated)
+export const searchTickets = async (q: string, opts: { offset?: number; limit?: number; status?: string[]; category?: string[] } = {}) => {
+    if (!BOT_URL) throw new Error("Bot URL not configured in Integration settings");
+    const params = new URLSearchParams({ q, offset: String(opts.offset ?? 0), limit: String(opts.limit ?? 20) });
+    if (opts.status?.length) params.set('status', opts.status.join(','));
+    if (opts.category?.length) params.set('category', opts.category.join(','));
+    const response = await fetch(`${BOT_URL}/api/search?${params}`);
+    if (!response.ok) throw new Error(`Bot API Error: ${await response.text()}`);
+    return await response.json() as {
+        query: string;
+        total: number;
+        total_is_exact: boolean;
+        took_ms: number;
+        results: { id: string; score: number; created_at: string; category: string; sub_category: string; status: string; location: string | null; is_deleted: boolean }[];
+    };
+};
+
+// --- Delta sync via the bot's change feed (/api/changes) ---
+export interface TicketChange {
+    table: 'complaints' | 'ticket_messages';
+    op: 'insert' | 'upsert' | 'delete';
+    id: string;
+    fields?: Record<string, any>;
+}
+export interface ChangeBatch { cursor: string; reset: boolean; changes: TicketChange[] }
+
+const TICKET_FIELDS: Record<string, (row: any) => Partial<Ticket>> = {
+    status: row => ({ status: row.status as TicketStatus }),
+    priority: row => ({ priority: row.priority as Priority }),
+    is_deleted: row => ({ isDeleted: !!row.is_deleted }),
+    category: row => ({ category: row.category }),
+    sub_category: row => ({ subCategory: row.sub_category }),
+    location: row => ({ location: row.location }),
+    description: row => ({ originalMessage: row.description || '' }),
+    extra_data: row => ({ extraData: row.extra_data }),
+};
+
+// Applies complaint and message deltas to the board; returns null when a full refetch is needed.
+// Idempotent, so the same row may arrive from both the bot feed and Supabase realtime.
+export const applyTicketChanges = (tickets: Ticket[], batch: ChangeBatch): Ticket[] | null => {
+    if (batch.reset) return null;
+    let result = tickets;
+    for (const change of batch.changes) {
+        if (change.table === 'ticket_messages') {
+            const ticketId = change.fields?.ticket_id;
+            const index = result.findIndex(t => t.id === ticketId);
+            if (change.op === 'delete' || index < 0 || result[index].history.some(m => m.id === change.id)) continue;
+            const message = mapRowToMessage({ ...change.fields, id: change.id });
+            result = result.map((t, i) => i === index ? { ...t, history: [...t.history, message] } : t);
+            continue;
+        }
+        const index = result.findIndex(t => t.id === change.id);
+        if (change.op === 'delete' || change.fields?.is_deleted) {
+            if (index >= 0) result = result.filter(t => t.id !== change.id);
+            continue;
+        }
+        const fields = change.fields || {};
+        if (index < 0) {
+            // New complaint (or one the board has not loaded): the delta carries the whole row (realtime or hydrateChanges)
+            if (change.op === 'insert' || fields.created_at) result = [mapRowToTicket(fields), ...result];
+            continue;
+        }
+        const patch = Object.keys(fields).reduce((acc, key) => TICKET_FIELDS[key] ? { ...acc, ...TICKET_FIELDS[key](fields) } : acc, {});
+        result = result.map((t, i) => i === index ? { ...t, ...patch } : t);
+    }
+    return result;
+};
+
+export const fetchChanges = async (since?: string): Promise<ChangeBatch> => {
+    if (!BOT_URL) throw new Error("Bot URL not configured in Integration settings");
+    const response = await fetch(`${BOT_URL}/api/changes${since ? `?since=${encodeURIComponent(since)}` : ''}`);
+    if (!response.ok) throw new Error(`Bot API Error: ${await response.text()}`);
+    return await response.json();
+};
+
+// The bot feed carries no personal data (phones, Telegram ids, texts): new complaints and messages are read
+// from Supabase by id. Rows the outbox has not written yet are skipped; realtime delivers them later.
+export const hydrateChanges = async (batch: ChangeBatch): Promise<ChangeBatch> => {
+    if (!supabase || batch.reset) return batch;
+    const rows: Record<string, any> = {};
+    for (const table of ['complaints', 'ticket_messages'] as const) {
+        const ids = batch.changes.filter(c => c.table === table && c.op === 'insert').map(c => c.id);
+        if (!ids.length) continue;
+        const { data, error } = await supabase.from(table).select('*').in('id', ids);
+        if (error) throw error;
+        data.forEach(row => { rows[row.id] = row; });
+    }
+    const changes = batch.changes.flatMap(c =>
+        c.op !== 'insert' ? [c] : rows[c.id] ? [{ ...c, fields: { ...rows[c.id], ...c.fields } }] : []);
+    return { ...batch, changes };
+};
+
+// Supabase realtime payload as a change-feed delta
+export const realtimeToChange = (table: TicketChange['table'], payload: any): TicketChange => {
+    const row = payload.eventType === 'DELETE' ? payload.old : payload.new;
+    const op = payload.eventType === 'DELETE' ? 'delete' : payload.eventType === 'INSERT' ? 'insert' : 'upsert';
+    return { table, op, id: row?.id, fields: row };
+};
+
+// SSE push channel from a cursor taken before the initial load; EventSource resumes from the last cursor on reconnect
+export const subscribeToChanges = (callback: (batch: ChangeBatch) => void, since?: string) => {
+    if (!BOT_URL) return null;
+    const source = new EventSource(`${BOT_URL}/api/changes/stream${since ? `?since=${encodeURIComponent(since)}` : ''}`);
+    source.addEventListener('changes', (event) => callback(JSON.parse((event as MessageEvent).data)));
+    return source;
+};
+
 export const updateTicketStatus = async (id: string, status: string) => {
   if (!supabase) throw new Error("Supabase not configured");
   return await supabase.from('complaints').update({ status }).eq('id', id);
@@ -241,4 +376,12 @@ export const subscribeToTickets = (callback: (payload: any) => void) => {
         .channel('tickets_channel')
         .on('postgres_changes', { event: '*', schema: 'public', table: 'complaints' }, callback)
         .subscribe();
+};
+
+export const subscribeToMessages = (callback: (payload: any) => void) => {
+    if (!supabase) return;
+    return supabase
+        .channel('messages_channel')
+        .on('postgres_changes', { event: 'INSERT', schema: 'public', table: 'ticket_messages' }, callback)
+        .subscribe();
 };
\ No newline at end of file